@@ -20,3 +20,4 @@ __license__ = "anything you want"
 import py4web
 
 from . import controllers
+from . import tasks
@@ -3,19 +3,22 @@
 import os
 from datetime import datetime
 
-from py4web import action, request, abort, redirect, URL
+from py4web import action, request, response, abort, redirect, URL
 from yatl.helpers import A
 from .common import (
     db, session, T, cache, auth, logger,
     authenticated, unauthenticated, flash
 )
+from . import settings
 from .models import DEVICE_ROLES
-from .modules.devices import DBDevices
+from .modules.devices import DBDevice, DBDevices
 from .modules.commands import DBCommands
 from .modules.results import DBResults
 from .modules.device_manager import DeviceManager
 from .modules.result_reviewer import ResultsReview
 from .modules.network_poller import NetworkPoller
+from .modules.unit_of_work import unit_of_work
+from .modules.conditional_get import conditional_get
 
 """
 @action('index')
@@ -39,7 +42,7 @@ def my_callback():
     return dict(devices=devices)
 
 @action("devices")
-@action.uses("devices.html")
+@action.uses("devices.html", db, unit_of_work)
 def devices():
     devices = DeviceManager().get_devices(max_results=10)
     # COMPLETE: return here any signed URLs you need.
@@ -49,33 +52,87 @@ def devices():
     )
 
 @action('results')
-@action.uses("results.html")
+@action.uses("results.html", db, unit_of_work)
 def results():
     results = ResultsReview().get_results_by_device()
     return dict(results=results)
 
 @action("get_devices")
+@action.uses(db, unit_of_work)
 def get_devices():
+    conditional_get.check(conditional_get.catalog_version(), conditional_get.results_version())
     devices = DeviceManager().get_devices()
     return dict(devices=devices)
 
+def results_page(device=None, command=None, limit=None):
+    """
+    Return a page of results for the request query 'after' or 'before' (page cursors) and
+    'limit' (page size), see ResultsReview.get_results_page()
+    """
+    try:
+        return ResultsReview.get_results_page(device=device, command=command,
+            limit=limit if limit else request.query.get('limit'),
+            after=request.query.get('after'), before=request.query.get('before'))
+    except ValueError as page_error:
+        abort(400, str(page_error))
+
 @action('get_results')
+@action.uses(db, unit_of_work)
 def get_results():
-    results = ResultsReview().get_results()
-    return dict(results=results)
+    conditional_get.check(conditional_get.catalog_version(), conditional_get.results_version())
+    return results_page()
+
+def export_filters():
+    """
+    Return the DBResults.export_results() filters of the request query 'device', 'command',
+    'job' (DB ids), 'since' and 'until' ('YYYY-mm-dd HH:MM:SS')
+    """
+    filters = dict()
+    try:
+        for key in ('device', 'command', 'job'):
+            if request.query.get(key):
+                filters.update({key: int(request.query.get(key))})
+        for key in ('since', 'until'):
+            if request.query.get(key):
+                filters.update({key: datetime.strptime(request.query.get(key), "%Y-%m-%d %H:%M:%S")})
+    except ValueError as filter_error:
+        abort(400, str(filter_error))
+    return filters
+
+@action('export_results')
+@action.uses(db)
+def export_results():
+    filters = export_filters()
+    response.headers["Content-Type"] = "application/x-ndjson"
+    response.headers["Content-Disposition"] = 'attachment; filename="results.ndjson"'
+    def stream():
+        # the body is sent after the action returns and its DB connection is recycled,
+        # the stream holds its own connection until the last chunk is sent
+        db.get_connection_from_pool_or_new()
+        try:
+            yield from DBResults.export_results(**filters)
+        finally:
+            db.recycle_connection_in_pool_or_close("rollback")
+    return stream()
 
 @action('device_results_by_command/<device_id:int>/<command_id:int>')
+@action.uses(db, unit_of_work)
 def device_results_by_command(device_id, command_id):
-    results = ResultsReview().get_results_by_device(device=device_id, command=command_id)
-    return dict(results=results)
+    page = results_page(device=device_id, command=command_id)
+    # {device: {result id: result}} as before paging, 'next' and 'previous' page cursors
+    results = {device_id: {result['id']: result for result in page['results']}}
+    return dict(results=results, next=page['next'], previous=page['previous'])
 
 @action("selected_device/<device_id:int>")
+@action.uses(db, unit_of_work)
 def selected_device(device_id):
+    conditional_get.check(conditional_get.catalog_version(), conditional_get.results_version())
     device = DeviceManager().get_devices(device=device_id)
     return dict(device=device)
 
 @action("get_device_roles")
 def get_device_roles():
+    conditional_get.check(conditional_get.constant_version(DEVICE_ROLES))
     return dict(roles=DEVICE_ROLES)
 
 #@action("get_devices_by_role/:device_role")
@@ -84,7 +141,7 @@ def get_device_roles():
 #    return dict(devices_by_role=devices)
 
 @action("devices/<device_id:int>")
-@action.uses("device.html")
+@action.uses("device.html", db, unit_of_work)
 def device(device_id):
     device = DeviceManager().get_devices(device=device_id)[0]
     last_res = list(device['results'])
@@ -93,21 +150,26 @@ def device(device_id):
     url=URL("run_commands")
     return dict(device=device, url=url)
 
+def device_results_page(device_id, limit=None):
+    """Return the device_results.html variables of a page of a device results"""
+    try:
+        device = DBDevice.get(device_id)
+    except TypeError:
+        abort(404, f"Device id={device_id} not found")
+    page = results_page(device=device_id, limit=limit)
+    return dict(device_id=device_id, device_name=device.name, limit=limit,
+        page_size=settings.RESULTS_PAGE_SIZE, results=page['results'],
+        next=page['next'], previous=page['previous'])
+
 @action("devices/<device_id:int>/results")
-@action.uses("device_results.html")
+@action.uses("device_results.html", db, unit_of_work)
 def device_results(device_id):
-    results = ResultsReview().get_results_by_device(device=device_id)
-    results_list = [results[device_id][result] for result in results[device_id]]
-    return dict(device_id=device_id, limit=None, results=results_list)
+    return device_results_page(device_id)
 
 @action("devices/<device_id:int>/partialresults/<limit:int>")
-@action.uses("device_results.html")
+@action.uses("device_results.html", db, unit_of_work)
 def device_results(device_id, limit):
-    results = ResultsReview().get_results_by_device(device=device_id)
-    results_list = [results[device_id][result] for result in results[device_id]]
-    if limit and limit <= len(results_list):
-        results_list = results_list[-limit:]
-    return dict(device_id=device_id, limit=limit, results=results_list)
+    return device_results_page(device_id, limit=limit)
 
 @action("run_commands/<device_id:int>", method=["GET", "POST"])
 def run_commands(device_id):
@@ -147,13 +209,14 @@ def run_commands_by_role(device_role):
     return dict()
 
 @action("roles/:device_role")
-@action.uses("devices_by_role.html")
+@action.uses("devices_by_role.html", db, unit_of_work)
 def devices_by_role(device_role):
     devices = DeviceManager().get_devices(roles=device_role, max_results=10)
     url=URL("run_commands_by_role")
     return dict(dev_role=device_role, devices=devices, url=url)
 
 @action("compare_results/:results")
+@action.uses(db, unit_of_work)
 def compare_results(results):
     ordered_results = sorted([int(result_id) for result_id in results.split("n")])
     results_list = [str(result_id) for result_id in ordered_results]
@@ -2,6 +2,8 @@
 This file defines the database models
 """
 
+import logging
+import re
 from datetime import datetime
 
 from .common import db, Field
@@ -33,6 +35,14 @@ if DEVELOPMENT:
         db.results.drop()
 """
 
+# indexes declared with each table, index fields are field names and '~field' for descending
+# order, unique indexes are natural keys (BCMDb.upsert conflict targets) not declared unique
+# on the field. Created, upgraded and dropped at startup by migrate_indexes()
+INDEXES = dict()
+# (table, fields) of the unique indexes missing in the DB (e.g. duplicate records), found at
+# startup by check_indexes(), BCMDb.upsert falls back to select then insert on these natural keys
+MISSING_UNIQUE_KEYS = set()
+
 db.define_table(
     'commands',
     Field('syntax', 'string', notnull=True),
@@ -40,11 +50,15 @@ db.define_table(
     Field('device_functions', 'list:string', requires=IS_IN_SET(DEVICE_FUNCTIONS), notnull=True),
     Field('device_roles', 'list:string', requires=IS_IN_SET(DEVICE_ROLES)),
     Field('comment', 'string'),
+    # legacy storage of the command 'output_parsers', migrated to 'command_parsers'
     Field('output_parsers', 'list:reference output_parsers'),
     Field('created_at', 'datetime', notnull=True),
     Field('modified_on', 'datetime'),
     format='%(syntax)s'
 )
+INDEXES['commands'] = [
+    dict(fields=('syntax',), unique=True),
+]
 
 db.define_table(
     'output_parsers',
@@ -60,6 +74,11 @@ db.define_table(
     Field('modified_on', 'datetime'),
     format='%(vendor)s %(device_os)s %(name)s'
 )
+INDEXES['output_parsers'] = [
+    # natural key, also the parser lookup by 'vendor', 'device_os' & 'command'
+    dict(fields=('vendor', 'device_os', 'command', 'is_json'), unique=True),
+    dict(fields=('name',), unique=True),
+]
 
 db.define_table(
     'devices',
@@ -69,6 +88,7 @@ db.define_table(
     Field('os', 'string', requires=IS_IN_SET(DEVICE_OS), notnull=True),
     Field('device_function', 'string', requires=IS_IN_SET(DEVICE_FUNCTIONS), notnull=True),
     Field('device_roles', 'list:string', requires=IS_IN_SET(DEVICE_ROLES), notnull=True),
+    # legacy storage of the device 'commands', migrated to 'device_commands'
     Field('commands', 'list:reference commands'),
     Field('region', 'string', requires=IS_IN_SET(REGIONS), notnull=True),
     Field('site_code', 'string', requires=IS_IN_SET(SITE_CODES), notnull=True),
@@ -81,6 +101,7 @@ db.define_table(
 db.define_table(
     'jobs',
     Field('name', 'string', length=128, notnull=True, unique=True),
+    # legacy storage of the job 'devices' and 'results', migrated to 'job_devices' and 'job_results'
     Field('devices', 'list:reference devices'),
     Field('results', 'list:reference results'),
     Field('started_at', 'datetime'),
@@ -98,9 +119,317 @@ db.define_table(
     Field('status', 'string', requires=IS_IN_SET(COMMAND_STATUSES), notnull=True),
     Field('job', 'reference jobs', notnull=True),
     Field('result', 'text'),
-    Field('last_result', 'reference results'),
+    # storage format of 'result', None for plain text (see modules/result_codec.py)
+    Field('result_format', 'string', length=32),
+    # content hash of the result stored in 'result_blobs', 'result' is None when set
+    Field('result_hash', 'string', length=32),
+    # 'results' DB id, not a reference as the last result may be in an archive partition
+    Field('last_result', 'integer'),
     Field('comment', 'string'),
     format='%(comment)s'
 )
+INDEXES['results'] = [
+    # natural key, also the latest results of a device (and command)
+    dict(fields=('device', 'command', '~completed_at'), unique=True),
+    dict(fields=('completed_at',)),
+    # pages of the results of a device by (completed_at, id), see ResultPartitions.select_page()
+    dict(fields=('device', 'completed_at')),
+    dict(fields=('job',)),
+    dict(fields=('result_hash',)),
+]
+
+# result payloads stored once per distinct result text (see modules/result_blobs.py)
+db.define_table(
+    'result_blobs',
+    Field('hash', 'string', length=32, notnull=True),
+    Field('result', 'text'),
+    # storage format of 'result', None for plain text (see modules/result_codec.py)
+    Field('result_format', 'string', length=32),
+    Field('size', 'integer'),
+    Field('created_at', 'datetime', notnull=True),
+    # last write of a 'results' record using the payload, collect() spares recently used payloads
+    Field('used_at', 'datetime'),
+)
+INDEXES['result_blobs'] = [
+    dict(fields=('hash',), unique=True),
+]
+
+# compression dictionaries of the results of a command (see modules/result_codec.py)
+db.define_table(
+    'result_dictionaries',
+    Field('command', 'reference commands', notnull=True),
+    Field('codec', 'string', length=8, notnull=True),
+    Field('dictionary', 'blob', notnull=True),
+    Field('num_samples', 'integer'),
+    Field('created_at', 'datetime', notnull=True),
+)
+
+# version of the catalog tables 'devices', 'commands' and 'output_parsers', bumped by every change
+# (see modules/catalog_cache.py)
+db.define_table(
+    'catalog_versions',
+    Field('name', 'string', length=32, notnull=True, unique=True),
+    Field('version', 'integer', notnull=True, default=0),
+)
+
+# monthly archive partitions of table 'results' (see modules/partitions.py), the partition
+# 'results_YYYYMM' holds the archived results completed from 'starts_at' to 'ends_at'
+db.define_table(
+    'result_partitions',
+    Field('name', 'string', length=32, notnull=True, unique=True),
+    Field('starts_at', 'datetime', notnull=True),
+    Field('ends_at', 'datetime', notnull=True),
+    Field('min_id', 'integer'),
+    Field('max_id', 'integer'),
+    Field('num_results', 'integer'),
+    Field('archived_at', 'datetime'),
+)
+
+# many-to-many link tables, storage of the list-style attributes DBDevice.commands,
+# DBCommand.output_parsers, DBJob.devices and DBJob.results (see BCMDb LinkList)
+db.define_table(
+    'device_commands',
+    Field('device', 'reference devices', notnull=True),
+    Field('command', 'reference commands', notnull=True),
+)
+INDEXES['device_commands'] = [
+    dict(fields=('device', 'command'), unique=True),
+    dict(fields=('command',)),
+]
+
+db.define_table(
+    'command_parsers',
+    Field('command', 'reference commands', notnull=True),
+    Field('output_parser', 'reference output_parsers', notnull=True),
+)
+INDEXES['command_parsers'] = [
+    dict(fields=('command', 'output_parser'), unique=True),
+    dict(fields=('output_parser',)),
+]
+
+db.define_table(
+    'job_devices',
+    Field('job', 'reference jobs', notnull=True),
+    Field('device', 'reference devices', notnull=True),
+)
+INDEXES['job_devices'] = [
+    dict(fields=('job', 'device'), unique=True),
+    dict(fields=('device',)),
+]
+
+db.define_table(
+    'job_results',
+    Field('job', 'reference jobs', notnull=True),
+    # 'results' DB id, not a reference as the result may be in an archive partition
+    Field('result', 'integer', notnull=True),
+)
+INDEXES['job_results'] = [
+    dict(fields=('job', 'result'), unique=True),
+    dict(fields=('result',)),
+]
+
+# link table -> (table, legacy list:reference field, owner link field, target link field)
+LINKS = {
+    'device_commands': ('devices', 'commands', 'device', 'command'),
+    'command_parsers': ('commands', 'output_parsers', 'command', 'output_parser'),
+    'job_devices': ('jobs', 'devices', 'job', 'device'),
+    'job_results': ('jobs', 'results', 'job', 'result'),
+}
+
+
+# fields changed from 'reference results' to 'integer', see drop_foreign_keys()
+DROPPED_FOREIGN_KEYS = {
+    'results': ('last_result',),
+    'job_results': ('result',),
+}
+
+
+def define_partition(name, create=False):
+    """
+    Define an archive partition of table 'results', same fields and indexes as 'results'
+    Partitions are not migrated, create the DB table of a new partition with create=True
+    """
+    if name not in db.tables:
+        db.define_table(name, db.results, migrate=False)
+        INDEXES[name] = INDEXES['results']
+        if create:
+            query = db._adapter.migrator.create_table(db[name], migrate=False)
+            db._adapter.create_sequence_and_triggers(query, db[name])
+    return db[name]
+
+
+def migrate_partitions():
+    """Add the fields added to table 'results' to the archive partitions, not migrated by pydal"""
+    for partition in db(db.result_partitions).select(db.result_partitions.name):
+        table = define_partition(partition.name)
+        db._adapter.execute(f"SELECT * FROM {table._rname} WHERE 1 = 0;")
+        columns = set(column[0] for column in db._adapter.cursor.description)
+        for field in table:
+            if field.name in columns:
+                continue
+            field_type = db._adapter.types[field.type] % dict(length=field.length)
+            db.executesql(f"ALTER TABLE {table._rname} ADD {field._rname} {field_type};")
+            db.commit()
+            logging.warning(f"Added field '{field.name}' to partition '{partition.name}'")
+
+
+def drop_foreign_keys():
+    """
+    SQLite keeps the foreign key of a field changed from 'reference' to 'integer' (pydal only
+    updates the field type), rebuild the tables of DROPPED_FOREIGN_KEYS still holding one
+    The table indexes are dropped with the table and re-created by migrate_indexes()
+    """
+    if db._adapter.dbengine != 'sqlite':
+        return
+    for table, fields in DROPPED_FOREIGN_KEYS.items():
+        sql = db.executesql(f"SELECT sql FROM sqlite_master WHERE type = 'table' AND name = '{table}';")
+        if not sql:
+            continue
+        rebuild = sql[0][0]
+        for field in fields:
+            rebuild = re.sub(rf'("{field}" INTEGER[^,]*?) REFERENCES "results" \("id"\)'
+                r'(?: ON (?:DELETE|UPDATE) (?:CASCADE|SET NULL|SET DEFAULT|RESTRICT|NO ACTION))*',
+                r'\1 ', rebuild)
+        if rebuild == sql[0][0]:
+            continue
+        db.commit()
+        db.executesql("PRAGMA foreign_keys = OFF;")
+        try:
+            db.executesql(rebuild.replace(f'CREATE TABLE "{table}"', f'CREATE TABLE "{table}__rebuild"', 1))
+            db.executesql(f'INSERT INTO "{table}__rebuild" SELECT * FROM "{table}";')
+            db.executesql(f'DROP TABLE "{table}";')
+            db.executesql(f'ALTER TABLE "{table}__rebuild" RENAME TO "{table}";')
+            db.commit()
+            logging.warning(f"Dropped the foreign keys of {list(fields)} on table '{table}'")
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.executesql("PRAGMA foreign_keys = ON;")
+
+
+def index_name(table, fields, unique=False):
+    """Return the DB name of a declared index, the name changes with the index definition"""
+    columns = [field[1:] + '_desc' if field.startswith('~') else field for field in fields]
+    return f"{table}__{'__'.join(columns)}__{'key' if unique else 'idx'}"
+
+
+def get_index_names():
+    """Return the names of the indexes in the DB, None if the DB engine is not supported"""
+    if db._adapter.dbengine == 'sqlite':
+        rows = db.executesql("SELECT name FROM sqlite_master WHERE type = 'index';")
+    elif db._adapter.dbengine == 'postgres':
+        rows = db.executesql("SELECT indexname FROM pg_indexes;")
+    else:
+        return None
+    return set(row[0] for row in rows)
+
+
+def check_indexes(index_names=None):
+    """
+    Startup check of the declared indexes, logs and returns the missing index names
+    The natural keys without their unique index are recorded in MISSING_UNIQUE_KEYS
+    ---
+    :return missing: list of declared index names missing in the DB, None if not supported
+    :rtype missing: list
+    """
+    index_names = index_names if index_names is not None else get_index_names()
+    if index_names is None:
+        return None
+    missing = list()
+    MISSING_UNIQUE_KEYS.clear()
+    for table, indexes in INDEXES.items():
+        for index in indexes:
+            name = index_name(table, **index)
+            if name in index_names:
+                continue
+            missing.append(name)
+            if index.get('unique', False):
+                MISSING_UNIQUE_KEYS.add((table, frozenset(index['fields'])))
+                logging.warning(f"Missing unique index {name}, saves to table '{table}' fall back to "
+                                f"select then insert, remove the duplicate records and restart to create it")
+    if missing:
+        logging.warning(f"Missing DB indexes {missing}, set settings.DB_MIGRATE to create them")
+    return missing
+
+
+def has_unique_key(table, keys):
+    """True if the natural key 'keys' of a table has its unique index, see check_indexes()"""
+    return (table, frozenset(keys)) not in MISSING_UNIQUE_KEYS
+
+
+def migrate_indexes():
+    """
+    Create the declared indexes missing in the DB and drop the indexes no longer declared,
+    an index definition change is a new index name so changed indexes are upgraded
+    """
+    index_names = get_index_names()
+    declared = set()
+    for table, indexes in INDEXES.items():
+        for index in indexes:
+            name = index_name(table, **index)
+            declared.add(name)
+            if index_names is not None and name in index_names:
+                continue
+            fields = [~db[table][field[1:]] if field.startswith('~') else db[table][field]
+                for field in index['fields']]
+            try:
+                db[table].create_index(name, *fields, unique=index.get('unique', False))
+                db.commit()
+                logging.warning(f"Created index {name} on table '{table}'")
+            except Exception as index_error:
+                db.rollback()
+                if index_names is not None:
+                    logging.warning(f"Unable to create index {name}, remove duplicate records: {index_error}")
+    for name in index_names or list():
+        table = name.split('__', 1)[0]
+        if table in INDEXES and name.endswith(('__key', '__idx')) and name not in declared:
+            db[table].drop_index(name)
+            db.commit()
+            logging.warning(f"Dropped index {name} on table '{table}'")
+
+
+def migrate_links():
+    """
+    Data migration of the legacy list:reference fields to the link tables, the migrated
+    fields are emptied so each record is only migrated once
+    """
+    for link_table, (table, field, owner, target) in LINKS.items():
+        records = db(db[table][field] != None).select(db[table].id, db[table][field])
+        records = [record for record in records if record[field]]
+        if not records:
+            continue
+        target_table = db[table][field].type.split(' ')[-1]
+        targets = sorted(set(target for record in records for target in record[field]))
+        owners = [record.id for record in records]
+        valid, existing = set(), set()
+        for idx in range(0, len(targets), 500):
+            query = db[target_table].id.belongs(targets[idx:idx + 500])
+            valid.update(row.id for row in db(query).select(db[target_table].id))
+        for idx in range(0, len(owners), 500):
+            query = db[link_table][owner].belongs(owners[idx:idx + 500])
+            existing.update((row[owner], row[target]) for row in db(query).select())
+        links = list()
+        for record in records:
+            for target_id in record[field]:
+                if target_id in valid and (record.id, target_id) not in existing:
+                    existing.add((record.id, target_id))
+                    links.append({owner: record.id, target: target_id})
+        db[link_table].bulk_insert(links)
+        for idx in range(0, len(owners), 500):
+            db(db[table].id.belongs(owners[idx:idx + 500])).update(**{field: None})
+        db.commit()
+        logging.warning(f"Migrated {len(links)} '{table}.{field}' references to table '{link_table}'")
+
+
+for partition in db(db.result_partitions).select(db.result_partitions.name):
+    define_partition(partition.name)
+
+if db._migrate:
+    drop_foreign_keys()
+    migrate_partitions()
+    migrate_indexes()
+    migrate_links()
+check_indexes()
 
 db.commit()
@@ -1,12 +1,99 @@
 # coding: utf-8 #
 
+import sqlite3
 from datetime import datetime
 
+from .. import models
+from ..models import db
+from .catalog_cache import catalog_cache, CatalogCache
+from .unit_of_work import unit_of_work
+
+# maximum number of values in one belongs() query, below the SQLite variable limit
+BELONGS_CHUNK_SIZE = 500
+
+
+class LinkList():
+    """
+    List-style attribute of a BCMDb object stored in a many-to-many link table (models.LINKS)
+    Loaded from the link table on first access (or prefetched by BCMDb.load_many), the
+    changes to the list are written by BCMDb.save_links() when the object is saved
+    """
+    def __init__(self, link_table):
+        self.link_table = link_table
+        self.name = None
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+    
+    @property
+    def owner(self):
+        return db[self.link_table][models.LINKS[self.link_table][2]]
+    
+    @property
+    def target(self):
+        return db[self.link_table][models.LINKS[self.link_table][3]]
+    
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if obj.__dict__.get(self.name) is None:
+            targets = catalog_cache.get_links(obj.dbtable, self, obj.db_id) if obj.db_id else list()
+            self.loaded(obj, targets)
+        return obj.__dict__[self.name]
+    
+    def __set__(self, obj, value):
+        """Assign a list of DB ids, None to reload the list from the link table on next access"""
+        obj.__dict__[self.name] = list(value) if value is not None else None
+    
+    def loaded(self, obj, targets):
+        """Set the list and the saved state as loaded from the link table"""
+        obj.__dict__[self.name] = list(targets)
+        obj.__dict__[f"{self.name}__saved"] = set(targets)
+    
+    def select(self, *owner_ids):
+        """Return the linked DB ids of each owner DB id, in link order"""
+        links = dict()
+        owner_ids = sorted(set(owner_ids))
+        for idx in range(0, len(owner_ids), BELONGS_CHUNK_SIZE):
+            query = self.owner.belongs(owner_ids[idx:idx + BELONGS_CHUNK_SIZE])
+            for row in db(query).select(self.owner, self.target, orderby=db[self.link_table].id):
+                links.setdefault(row[self.owner], list()).append(row[self.target])
+        return links
+    
+    def save(self, obj, created=False):
+        """
+        Insert and delete the link table rows changed since the list was loaded or saved
+        ---
+        :param created: the object record is new, it has no links yet
+        :type created: bool
+        :return True or False: based on whether links are changed or not
+        """
+        targets = obj.__dict__.get(self.name)
+        if targets is None or not obj.db_id:
+            return False
+        saved = obj.__dict__.get(f"{self.name}__saved")
+        if saved is None:
+            # list not loaded from the link table, e.g. from_json of an existing record
+            saved = set() if created else set(self.select(obj.db_id).get(obj.db_id, list()))
+        added = [target for target in dict.fromkeys(targets) if target not in saved]
+        removed = sorted(saved - set(targets))
+        for idx in range(0, len(removed), BELONGS_CHUNK_SIZE):
+            query = (self.owner == obj.db_id) & self.target.belongs(removed[idx:idx + BELONGS_CHUNK_SIZE])
+            db(query).delete()
+        if added:
+            db[self.link_table].bulk_insert([{self.owner.name: obj.db_id, self.target.name: target}
+                for target in added])
+        obj.__dict__[f"{self.name}__saved"] = set(targets)
+        return bool(added or removed)
+
 
 class BCMDb(object):
     """
     Base DB Abstraction class for uniform interaction with DB Tables
     """
+    # DB table of the class, the identity map key with the DB id
+    dbtable = None
+    
     def __init__(self, db_id=None):
         self.db_id = db_id
         self.db_loaded = False
@@ -21,6 +108,195 @@ class BCMDb(object):
     def get_timestamp():
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
+    @classmethod
+    def get(cls, db_id=None, db_rec=None):
+        """
+        Return the object of a DB id or record, loaded at most once per unit of work (request)
+        ---
+        :param db_id: a valid DB id
+        :type db_id: int
+        :param db_rec: a valid DB record, avoids loading the record again
+        :type db_rec: Row (pydal.objects.Row)
+        """
+        if db_rec is not None:
+            db_id = db_rec.id
+        obj = unit_of_work.get(cls.dbtable, db_id)
+        if obj is None:
+            if db_rec is None:
+                obj = cls(db_id=db_id)
+            else:
+                obj = cls()
+                obj.load_by_id(db_rec=db_rec)
+                obj.db_id = db_id
+            unit_of_work.put(cls.dbtable, db_id, obj)
+        return obj
+    
+    @classmethod
+    def select_chunks(cls, db_ids=None, table=None):
+        """
+        Yield the DB records of the class table in id order, BELONGS_CHUNK_SIZE records at a time
+        with one belongs() query per chunk of ids, or pages of the table when db_ids is empty
+        ---
+        :param db_ids: DB ids to select, None or empty for all records
+        :type db_ids: list
+        :param table: table to select from, default the class table
+        :type table: Table (pydal.objects.Table)
+        """
+        table = table if table is not None else db[cls.dbtable]
+        if not db_ids:
+            last_id = 0
+            while True:
+                records = db(table.id > last_id).select(orderby=table.id, limitby=(0, BELONGS_CHUNK_SIZE))
+                if records:
+                    yield records
+                if len(records) < BELONGS_CHUNK_SIZE:
+                    return
+                last_id = records.last().id
+        db_ids = sorted(set(int(db_id) for db_id in db_ids))
+        for idx in range(0, len(db_ids), BELONGS_CHUNK_SIZE):
+            yield db(table.id.belongs(db_ids[idx:idx + BELONGS_CHUNK_SIZE])).select(orderby=table.id)
+    
+    @classmethod
+    def select_records(cls, db_ids=None):
+        """Yield the DB records of the class table in id order, see select_chunks()"""
+        for records in cls.select_chunks(db_ids=db_ids):
+            yield from records
+    
+    @classmethod
+    def load_many(cls, db_ids=None):
+        """
+        Yield the objects of DB ids hydrated from the selected records, see select_chunks()
+        The 'LinkList' attributes are loaded with one query per chunk
+        ---
+        :param db_ids: DB ids to load, None or empty for all records
+        :type db_ids: list
+        """
+        for records in cls.select_chunks(db_ids=db_ids):
+            objs = [cls.get(db_rec=db_rec) for db_rec in records]
+            for name, link in cls.link_lists():
+                unloaded = [obj for obj in objs if obj.__dict__.get(name) is None]
+                links = link.select(*[obj.db_id for obj in unloaded]) if unloaded else dict()
+                for obj in unloaded:
+                    link.loaded(obj, links.get(obj.db_id, list()))
+            yield from objs
+    
+    @classmethod
+    def link_lists(cls):
+        """Return the (attribute name, LinkList) of the class list-style attributes"""
+        return [(name, attr) for klass in cls.__mro__ for name, attr in vars(klass).items()
+            if isinstance(attr, LinkList)]
+    
+    def save_links(self, created=False):
+        """
+        Save the changes of the 'LinkList' attributes to their link tables
+        ---
+        :param created: the object record is new, it has no links yet
+        :type created: bool
+        :return True or False: based on whether any links are changed or not
+        """
+        changed = False
+        for name, link in self.link_lists():
+            changed = link.save(self, created=created) or changed
+        return changed
+    
+    @classmethod
+    def commit(cls):
+        """
+        Commit the DB transaction, deferred to the unit of work flush when one is active
+        Changes of a catalog class (see CatalogCache) bump the catalog version in the transaction
+        """
+        if cls.dbtable in CatalogCache.TABLES:
+            catalog_cache.bump()
+        if not unit_of_work.is_active():
+            db.commit()
+            catalog_cache.end_transaction()
+    
+    @staticmethod
+    def rollback():
+        """Roll back the DB transaction, with an active unit of work the whole unit is rolled back"""
+        unit_of_work.fail()
+        db.rollback()
+        if not unit_of_work.is_active():
+            catalog_cache.end_transaction()
+    
+    @staticmethod
+    def has_upsert():
+        """True if the DB supports INSERT .. ON CONFLICT .. RETURNING (PostgreSQL, SQLite 3.35+)"""
+        if db._adapter.dbengine == 'postgres':
+            return True
+        return db._adapter.dbengine == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35)
+    
+    @staticmethod
+    def has_window_functions():
+        """True if the DB supports window functions - ROW_NUMBER() OVER (..) (PostgreSQL, SQLite 3.25+)"""
+        if db._adapter.dbengine == 'postgres':
+            return True
+        return db._adapter.dbengine == 'sqlite' and sqlite3.sqlite_version_info >= (3, 25)
+    
+    @staticmethod
+    def upsert(table, keys, fields, update=None, match=None, compare=None, returning=('id',)):
+        """
+        Create or update a record in one statement - INSERT .. ON CONFLICT .. DO UPDATE .. RETURNING
+        The natural key 'keys' must have a unique constraint (see models.INDEXES), without it
+        (e.g. duplicate records prevented the index creation) upsert_select() is used
+        ---
+        :param table: DB table
+        :type table: pydal.objects.Table
+        :param keys: natural key field names, the conflict target
+        :type keys: tuple
+        :param fields: field values of the record
+        :type fields: dict
+        :param update: field names updated if the natural key exists, None to never update
+        :type update: list
+        :param match: field names that must be equal in the existing record to update it
+        :type match: list
+        :param compare: field names compared to skip updates without changes
+        :type compare: list
+        :param returning: field names returned
+        :type returning: tuple
+        :return: tuple of the 'returning' values, None if no record is created or updated
+        """
+        if not BCMDb.has_upsert() or not models.has_unique_key(table._tablename, keys):
+            return BCMDb.upsert_select(table, keys, fields, update, match, compare, returning)
+        sql = table._insert(**fields).strip().rstrip(';')
+        sql += f" ON CONFLICT ({', '.join(table[key]._rname for key in keys)})"
+        if update:
+            equal, distinct = ('IS NOT DISTINCT FROM', 'IS DISTINCT FROM') \
+                if db._adapter.dbengine == 'postgres' else ('IS', 'IS NOT')
+            sql += " DO UPDATE SET " + ", ".join(
+                f"{table[field]._rname} = excluded.{table[field]._rname}" for field in update)
+            conditions = [f"{table._rname}.{table[field]._rname} {equal} excluded.{table[field]._rname}"
+                for field in match or list()]
+            if compare:
+                conditions.append("(" + " OR ".join(
+                    f"{table._rname}.{table[field]._rname} {distinct} excluded.{table[field]._rname}"
+                    for field in compare) + ")")
+            if conditions:
+                sql += " WHERE " + " AND ".join(conditions)
+        else:
+            sql += " DO NOTHING"
+        sql += " RETURNING " + ", ".join(table[field]._rname for field in returning) + ";"
+        rows = db.executesql(sql)
+        return tuple(rows[0]) if rows else None
+    
+    @staticmethod
+    def upsert_select(table, keys, fields, update=None, match=None, compare=None, returning=('id',)):
+        """BCMDb.upsert for DBs without INSERT .. ON CONFLICT, select then insert or update"""
+        query = None
+        for key in keys:
+            query = (table[key] == fields.get(key)) if query is None else query & (table[key] == fields.get(key))
+        db_rec = db(query).select().first()
+        if not db_rec:
+            db_id = table.insert(**fields)
+            db_rec = db(table.id == db_id).select().first()
+            return tuple(db_rec[field] for field in returning)
+        if not update or any(db_rec[field] != fields.get(field) for field in match or list()):
+            return None
+        if compare and not any(db_rec[field] != fields.get(field) for field in compare):
+            return None
+        db(table.id == db_rec.id).update(**{field: fields.get(field) for field in update})
+        return tuple(fields.get(field) if field in update else db_rec[field] for field in returning)
+    
     def validate(self):
         """
         Check the validity of the class.
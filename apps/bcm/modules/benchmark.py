@@ -0,0 +1,132 @@
+# coding: utf-8
+
+import logging
+import time
+
+from ..models import db
+from .. import settings
+from .commands import DBCommand
+from .devices import DBDevice
+from .jobs import DBJob
+from .job_engine import JobEngine
+from .session_pool import session_pool
+from .parse_pool import parse_pool
+from .device_simulator import DeviceSimulator
+
+"""
+End-to-end polling benchmark against simulated devices (Linux, devices use 127.x.y.z)
+>>> from apps.bcm.modules.benchmark import run_benchmark
+>>> report = run_benchmark(num_devices=200, max_workers=50, latency=0.05)
+>>> report['devices_per_sec'], report['latency_p50'], report['latency_p99'], report['db_writes_per_sec']
+"""
+
+VENDORS_BY_OS = {"eos": "Arista", "ios": "Cisco", "nxos": "Cisco", "junos": "Juniper"}
+
+BENCHMARK_COMMANDS = ["show version", "show ip interface brief"]
+
+
+def percentile(values, pct):
+    """Return the pct (0-100) percentile of a list of values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def create_devices(num_devices, os_mix, commands):
+    """Create (or re-use) the simulated devices in DB Table 'devices', return {id: (mgmt_ip, os)}"""
+    devices = dict()
+    for idx in range(num_devices):
+        os = os_mix[idx % len(os_mix)]
+        mgmt_ip = f"127.0.{idx // 250 + 1}.{idx % 250 + 1}"
+        d = DBDevice()
+        d.from_json({"name": f"bsim-{idx:05d}", "mgmt_ip": mgmt_ip, "vendor": VENDORS_BY_OS[os],
+            "os": os, "device_function": "Router", "device_roles": ["OTHER"], "commands": commands,
+            "region": "EMEA", "site_code": "LODT", "comment": "benchmark simulated device"})
+        d.save()
+        if d.db_id is None:
+            # no changes saved, re-use the existing record (and its mgmt_ip) of the device name
+            db_rec = db(db.devices.name == d.name).select(db.devices.id, db.devices.mgmt_ip,
+                db.devices.os).first()
+            if not db_rec:
+                raise ValueError("create_devices", f"Unable to create or re-use device {d.name}")
+            d.db_id, mgmt_ip, os = db_rec.id, db_rec.mgmt_ip, db_rec.os
+        devices.update({d.db_id: (mgmt_ip, os)})
+    return devices
+
+
+def run_benchmark(num_devices=100, max_workers=None, use_asyncio=None, os_mix=("eos", "ios", "nxos"),
+                  latency=0.05, login_latency=0.2, failure_rate=0.0, hang_rate=0.0,
+                  port=8022, cleanup=True):
+    """
+    Run a job against num_devices simulated devices and report polling performance
+    ---
+    :param os_mix: device os cycled over the simulated devices
+    :type os_mix: tuple
+    :param port: SSH port of the simulated devices, only used by the benchmark job
+    :type port: int
+    :param cleanup: delete the benchmark job, results, devices and the commands it created afterwards
+    :type cleanup: bool
+    :return report: throughput, per-device latency percentiles and DB write rates
+    :rtype report: dict
+    """
+    command_ids = list()
+    created_commands = list()
+    for syntax in BENCHMARK_COMMANDS:
+        c = DBCommand()
+        c.from_json({"syntax": syntax, "vendors": ["Arista", "Cisco", "Juniper"],
+            "device_functions": ["Router"], "device_roles": ["OTHER"]})
+        c.save()
+        command_ids.append(c.db_id)
+        if c.db_created:
+            created_commands.append(c.db_id)
+    devices = create_devices(num_devices, os_mix, command_ids)
+    sim = DeviceSimulator(port=port, latency=latency, login_latency=login_latency,
+        failure_rate=failure_rate, hang_rate=hang_rate)
+    for mgmt_ip, os in devices.values():
+        sim.add_device(mgmt_ip, os)
+    job = DBJob(name=f"benchmark_{int(time.time() * 1000)}", comment="benchmark")
+    job.set_devices(devices=list(devices.keys()))
+    job.save()
+    job.set_runtime_account(credentials=("admin", "admin"))
+    if settings.PARSE_POOL_ENABLED:
+        # fork the parser processes before the simulator opens its listening sockets
+        parse_pool.start()
+    sim.start()
+    try:
+        # the simulator port is passed to the job pollers only, other jobs of the process are unaffected
+        engine = JobEngine(job=job, max_workers=max_workers, use_asyncio=use_asyncio, port=port)
+        started = time.monotonic()
+        engine.load_pollers()
+        results = engine.run()
+        elapsed = time.monotonic() - started
+    finally:
+        session_pool.close_all()
+        sim.stop()
+    timings = [engine.timings[device] for device in engine.timings if device not in engine.failed]
+    report = dict(
+        devices=num_devices,
+        max_workers=engine.max_workers,
+        use_asyncio=engine.use_asyncio,
+        failed=len(engine.failed),
+        results=len(results),
+        elapsed=round(elapsed, 3),
+        devices_per_sec=round(num_devices / elapsed, 2) if elapsed else None,
+        latency_p50=percentile(timings, 50),
+        latency_p99=percentile(timings, 99),
+        db_write_time=round(engine.save_time, 3),
+        db_writes_per_sec=round(len(results) / engine.save_time, 2) if engine.save_time else None,
+    )
+    if cleanup:
+        db(db.results.job == job.db_id).delete()
+        db(db.jobs.id == job.db_id).delete()
+        db(db.device_commands.device.belongs(list(devices.keys()))).delete()
+        db(db.devices.id.belongs(list(devices.keys()))).delete()
+        # commands re-used from the catalog are kept
+        unused = [cmd_id for cmd_id in created_commands
+            if db(db.device_commands.command == cmd_id).isempty() and db(db.results.command == cmd_id).isempty()]
+        db(db.commands.id.belongs(unused)).delete()
+        # bumps the catalog version, cached records of the deleted devices/commands are dropped
+        DBDevice.commit()
+    logging.warning(f"Benchmark report: {report}")
+    return report
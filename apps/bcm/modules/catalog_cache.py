@@ -0,0 +1,164 @@
+# coding: utf-8
+
+import threading
+import time
+
+from pydal.objects import Row
+
+from .. import settings
+from ..models import db
+
+"""
+>>> from apps.bcm.modules.catalog_cache import catalog_cache
+>>> catalog_cache.get_record('devices', 4).name
+'nxos-core-1'
+>>> catalog_cache.get_record('devices', 4) is catalog_cache.get_record('devices', 4)
+False
+>>> catalog_cache.version
+12
+"""
+
+
+class CatalogCache():
+    """
+    Read-through cache of the catalog tables 'devices', 'commands' and 'output_parsers' and of
+    their link tables (see DBDevice, DBCommand, DBParser load_by_id and LinkList)
+    Every save or delete of a catalog object bumps the catalog version in DB Table
+    'catalog_versions' in the same transaction (see BCMDb.commit), a process reading a new
+    version drops all its cached records so any number of processes stay coherent without
+    a shared cache service. The version is read at most once per check_interval seconds,
+    a bump by the process drops the cached records and the version at once
+    A thread with a pending (uncommitted) bump reads its catalog lookups from DB and never
+    publishes versions or records, they are only read again once its transaction ends
+    """
+    TABLES = ('devices', 'commands', 'output_parsers')
+    # 'catalog_versions' name of the catalog version
+    VERSION = 'catalog'
+
+    def __init__(self, enabled=True, check_interval=5):
+        """
+        Standard constructor class
+        ---
+        :param enabled: False reads every record from DB
+        :type enabled: bool
+        :param check_interval: seconds the catalog version is trusted before it is read again,
+            the delay before a change made by another process is seen, 0 reads it on every lookup
+        :type check_interval: int
+        """
+        self.enabled = enabled
+        self.check_interval = check_interval if check_interval else 0
+        self.lock = threading.Lock()
+        self.local = threading.local()  # pending: True if the thread bumped the version, not committed
+        self.version = None
+        self.checked_at = None
+        self.records = dict()  # (table, DB id) -> record fields
+        self.links = dict()  # (link table, owner DB id) -> linked DB ids
+
+    @staticmethod
+    def read_version():
+        """Return the catalog version in DB"""
+        db_rec = db(db.catalog_versions.name == CatalogCache.VERSION).select(db.catalog_versions.version).first()
+        return db_rec.version if db_rec else 0
+
+    def clear(self):
+        """Drop the cached records, the version is read on the next lookup"""
+        with self.lock:
+            self.records = dict()
+            self.links = dict()
+            self.version = None
+            self.checked_at = None
+
+    def check(self):
+        """
+        Drop the cached records if the catalog version changed
+        ---
+        :return cacheable: False if the records read now must not be cached or read from the
+            cache (uncommitted changes of the thread)
+        :rtype cacheable: bool
+        """
+        if getattr(self.local, 'pending', False):
+            # the version read in the transaction is not committed, it must not be published
+            return False
+        if self.checked_at is None or time.monotonic() - self.checked_at >= self.check_interval:
+            version = CatalogCache.read_version()
+            with self.lock:
+                if version != self.version:
+                    self.records = dict()
+                    self.links = dict()
+                    self.version = version
+                self.checked_at = time.monotonic()
+        return True
+
+    def bump(self):
+        """Increment the catalog version in the current transaction and drop the cached records"""
+        if not db(db.catalog_versions.name == CatalogCache.VERSION).update(version=db.catalog_versions.version + 1):
+            db.catalog_versions.insert(name=CatalogCache.VERSION, version=1)
+        self.local.pending = True
+        self.clear()
+
+    def end_transaction(self):
+        """
+        Forget the version bumped by the thread, its transaction is committed or rolled back,
+        the version is read again (committed) on the next lookup
+        """
+        if getattr(self.local, 'pending', False):
+            self.local.pending = False
+            with self.lock:
+                self.checked_at = None
+
+    def get_record(self, table, db_id):
+        """
+        Return the record of a catalog table DB id, read from DB once per catalog version
+        ---
+        :param table: catalog table name, see TABLES
+        :type table: str
+        :param db_id: a valid DB id
+        :type db_id: int
+        :return db_rec: a copy of the record, None if not found
+        :rtype db_rec: Row (pydal.objects.Row)
+        """
+        if not self.enabled or table not in CatalogCache.TABLES:
+            return db(db[table].id == db_id).select().first()
+        cacheable = self.check()
+        version = self.version
+        fields = self.records.get((table, db_id)) if cacheable else None
+        if fields is None:
+            db_rec = db(db[table].id == db_id).select().first()
+            if not db_rec:
+                return None
+            fields = {field: db_rec[field] for field in db[table].fields}
+            with self.lock:
+                if cacheable and self.version == version:
+                    self.records.update({(table, db_id): fields})
+        # lists are copied, the loaded objects may change them
+        return Row({field: list(value) if isinstance(value, list) else value for field, value in fields.items()})
+
+    def get_links(self, table, link, db_id):
+        """
+        Return the linked DB ids of a catalog object LinkList, read from DB once per catalog version
+        ---
+        :param table: owner table name, link lists of other tables are not cached
+        :type table: str
+        :param link: the LinkList of the owner class
+        :type link: LinkList
+        :param db_id: owner DB id
+        :type db_id: int
+        :return targets: linked DB ids in link order
+        :rtype targets: list
+        """
+        if not self.enabled or table not in CatalogCache.TABLES:
+            return link.select(db_id).get(db_id, list())
+        cacheable = self.check()
+        version = self.version
+        targets = self.links.get((link.link_table, db_id)) if cacheable else None
+        if targets is None:
+            targets = link.select(db_id).get(db_id, list())
+            with self.lock:
+                if cacheable and self.version == version:
+                    self.links.update({(link.link_table, db_id): targets})
+        return list(targets)
+
+
+# shared by all threads of the process, coherent across processes by the catalog version
+catalog_cache = CatalogCache(enabled=settings.CATALOG_CACHE_ENABLED,
+    check_interval=settings.CATALOG_CACHE_CHECK_INTERVAL)
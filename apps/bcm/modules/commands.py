@@ -5,13 +5,18 @@ import logging
 from pydal.objects import Row
 
 from ..models import db
-from .bcm_db import BCMDb
+from .bcm_db import BCMDb, LinkList
+from .catalog_cache import catalog_cache
 
 
 class DBCommand(BCMDb):
     """
     DB Abstraction class for uniform interaction with DB Table 'commands'
     """
+    dbtable = 'commands'
+    # command 'output_parsers' DB ids, stored in link table 'command_parsers'
+    output_parsers = LinkList('command_parsers')
+    
     def __init__(self, db_id=None, syntax=None, comment=None):
         """
         Standard constructor class
@@ -45,7 +50,7 @@ class DBCommand(BCMDb):
                 rec_id = db_id
             if not rec_id:
                 raise ValueError(self.__class__.__name__, "Invalid or missing record id")
-            db_rec = db(db.commands.id == rec_id).select().first()    
+            db_rec = catalog_cache.get_record('commands', rec_id)
         if not db_rec:
             raise TypeError(self.__class__.__name__, f"Expecting record received {type(db_rec)}")
         self.db_id = db_rec.id
@@ -54,7 +59,7 @@ class DBCommand(BCMDb):
         self.device_functions = db_rec.device_functions
         self.device_roles = db_rec.device_roles
         self.comment = db_rec.comment
-        self.output_parsers = db_rec.output_parsers
+        self.output_parsers = None  # loaded from 'command_parsers' on first access
         self.created_at = db_rec.created_at
         self.modified_on = db_rec.modified_on
         self.db_loaded = True
@@ -67,27 +72,33 @@ class DBCommand(BCMDb):
         :return True or False: based on whether a new record is created or not
         """
         query = (db.commands.syntax == self.syntax)
-        if db(query).count() == 0:  # no existing db record matching 'syntax'
-            self.created_at = DBCommand.get_timestamp()
-            self.modified_on = self.created_at
-            db.commands.insert(syntax=self.syntax, vendors=self.vendors,
-                device_functions=self.device_functions, device_roles=self.device_roles,
-                comment=self.comment, output_parsers=self.output_parsers,
-                created_at=self.created_at, modified_on=self.modified_on)
-            db.commit()
-            db_rec = db(query).select().first()
-            if db_rec:
-                self.db_id = db_rec.id
-                self.db_created = True
-                logging.warning(f"New record created in table 'commands' id={self.db_id}")
-                return True
-        if db(query).count() > 0:  # no existing db record matching 'syntax'
-            db_rec = db(query).select().first()
+        timestamp = DBCommand.get_timestamp()
+        # insert unless a db record matching 'syntax' exists, existing records are merged below
+        db_rec = self.upsert(db.commands, keys=('syntax',), fields=dict(syntax=self.syntax,
+            vendors=self.vendors, device_functions=self.device_functions,
+            device_roles=self.device_roles, comment=self.comment,
+            created_at=timestamp, modified_on=timestamp))
+        if db_rec:
+            self.db_id = db_rec[0]
+            self.save_links(created=True)
+            self.commit()
+            self.created_at = timestamp
+            self.modified_on = timestamp
+            self.db_created = True
+            logging.warning(f"New record created in table 'commands' id={self.db_id}")
+            return True
+        db_rec = db(query).select().first()
+        if db_rec:  # existing db record matching 'syntax'
             self.db_id = db_rec.id
             vendor_updates = self.update_vendors(db_rec=db_rec)
             function_updates = self.update_functions(db_rec=db_rec)
             role_updates = self.update_roles(db_rec=db_rec)
+            link_updates = self.save_links()
             if not vendor_updates and not function_updates and not role_updates:
+                if link_updates:
+                    self.commit()
+                    logging.warning(f"Updated record in table 'commands' with id={self.db_id}")
+                    return True
                 logging.warning(f"No changes to save for id={self.db_id}")
                 return False
             if vendor_updates:
@@ -97,16 +108,16 @@ class DBCommand(BCMDb):
             if role_updates:
                 self.device_roles = role_updates
             self.modified_on = DBCommand.get_timestamp()
-            db.commands.update_or_insert(query,
-                syntax=self.syntax, vendors=self.vendors, device_functions=self.device_functions,
-                device_roles=self.device_roles, comment=self.comment, output_parsers=self.output_parsers,
-                created_at=self.created_at, modified_on=self.modified_on)
-            db.commit()
+            self.created_at = db_rec.created_at
+            db(db.commands.id == self.db_id).update(vendors=self.vendors,
+                device_functions=self.device_functions, device_roles=self.device_roles,
+                comment=self.comment, modified_on=self.modified_on)
+            self.commit()
             logging.warning(f"Updated record in table 'commands' with id={self.db_id}")
             return True
         # catch-all error
         logging.warning("Unknown Error, more information/debugging required")
-        db.rollback()
+        self.rollback()
         return False
     
     def update_vendors(self, db_rec=None, db_id=None):
@@ -212,8 +223,9 @@ class DBCommand(BCMDb):
             self.output_parsers.extend(output_parsers)
             self.output_parsers.sort()
             self.modified_on = DBCommand.get_timestamp()
-            db_rec.update_record(output_parsers=self.output_parsers, modified_on=self.modified_on)
-            db.commit()
+            db_rec.update_record(modified_on=self.modified_on)
+            self.save_links()
+            self.commit()
             logging.warning(f"Updating the command id={db_rec.id} 'output_parsers'")
             return True
         # catch all error
@@ -237,34 +249,40 @@ class DBCommand(BCMDb):
         if not db_rec or (db_rec and not isinstance(db_rec, Row)):
             raise TypeError(self.__class__.__name__, f"Expecting record received {type(db_rec)}")
         if parser_id and isinstance(parser_id, int):
-            self.output_parsers = [op_id for op_id in self.output_parsers if op_id != parser_id]
-            if self.output_parsers == db_rec.output_parsers:
+            current = list(self.output_parsers)
+            self.output_parsers = [op_id for op_id in current if op_id != parser_id]
+            if self.output_parsers == current:
                 logging.warning(f"No 'output_parser' id={parser_id} found in 'output_parsers'")
                 return False
             else:
                 self.modified_on = DBCommand.get_timestamp()
                 self.output_parsers.sort()
-                db_rec.update_record(output_parsers=self.output_parsers, modified_on=self.modified_on)
-                db.commit()
+                db_rec.update_record(modified_on=self.modified_on)
+                self.save_links()
+                self.commit()
                 logging.warning(f"Removed 'output_parser' id={parser_id} from 'output_parsers'")
             return True
         if parser_id and isinstance(parser_id, list):
-            self.output_parsers = [op_id for op_id in self.output_parsers if not op_id in parser_id]
-            if self.output_parsers == db_rec.output_parsers:
+            current = list(self.output_parsers)
+            self.output_parsers = [op_id for op_id in current if not op_id in parser_id]
+            if self.output_parsers == current:
                 logging.warning(f"No 'output_parser' id={parser_id} found in 'output_parsers'")
                 return False
             else:
                 self.modified_on = DBCommand.get_timestamp()
                 self.output_parsers.sort()
-                db_rec.update_record(output_parsers=self.output_parsers, modified_on=self.modified_on)
-                db.commit()
+                db_rec.update_record(modified_on=self.modified_on)
+                self.save_links()
+                self.commit()
                 logging.warning(f"Removed 'output_parser' id={parser_id} from 'output_parsers'")
                 return True
         elif not parser_id:
             removed = self.output_parsers
+            self.output_parsers = list()
             self.modified_on = DBCommand.get_timestamp()
-            db_rec.update_record(output_parsers=list(), modified_on=self.modified_on)
-            db.commit()
+            db_rec.update_record(modified_on=self.modified_on)
+            self.save_links()
+            self.commit()
             logging.warning(f"Removed all 'output_parsers', {removed} from 'output_parsers'")
             return True
         # catch all error
@@ -288,19 +306,19 @@ class DBCommand(BCMDb):
             db_rec = db(db.commands.id == rec_id).select().first()
         if not db_rec or (db_rec and not isinstance(db_rec, Row)):
             raise TypeError(self.__class__.__name__, f"Invalid type expecting Row received {type(db_rec)}")
-        if db(db.devices.commands.contains(db_rec.id)).count() > 0:
+        if db(db.device_commands.command == db_rec.id).count() > 0:
             logging.warning(f"Unable to delete command id={db_rec.id} while used by device in 'devices'")
         elif db(db.results.command.belongs(db(db.commands.id == db_rec.id).select())).count() > 0:
             logging.warning(f"Unable to delete command id={db_rec.id} while in table 'results'")
         elif db(db.output_parsers.command.belongs(db(db.commands.id == db_rec.id).select())).count() > 0:
             logging.warning(f"Unable to delete command id={db_rec.id} while in table 'output_parsers'")
         elif (
-            db(db.devices.commands.contains(db_rec.id)).count() == 0 and
+            db(db.device_commands.command == db_rec.id).count() == 0 and
             db(db.results.command.belongs(db(db.commands.id == db_rec.id).select())).count() == 0 and
             db(db.output_parsers.command.belongs(db(db.commands.id == db_rec.id).select())).count() == 0
         ):
-            db(db.devices.id == db_rec.id).delete()
-            db.commit()
+            db(db.commands.id == db_rec.id).delete()
+            self.commit()
             logging.warning(f"Record id={db_rec.id} deleted from table 'commands'")
             self.db_id = None
             self.db_loaded = False
@@ -358,21 +376,18 @@ class DBCommands():
     
     @staticmethod
     def get_commands(db_ids=None):
-        if not db_ids:
-            commands = db(db.commands).select()
-        else:
-            if isinstance(db_ids, list):
-                for db_id in db_ids:
-                    idx = 0
-                    while idx < len(db_ids):
-                        if idx == 0:
-                            query = (db.commands.id == db_id)
-                        else:
-                            query |= (db.commands.id == db_id)
-                        idx += 1
-                commands = db(query).select()
-        commands_list = []
-        for cmd in commands:
-            c = DBCommand(db_id=cmd.id)
-            commands_list.append(c.to_json())
-        return commands_list
+        """
+        Return 'commands' in dict format, one query per BELONGS_CHUNK_SIZE records
+        ---
+        :param db_ids: DB ids of the 'commands', None or empty for all 'commands'
+        :type db_ids: list
+        :return commands_list: list of 'commands' in dict format
+        :rtype commands_list: list
+        """
+        return list(DBCommands.iter_commands(db_ids=db_ids))
+    
+    @staticmethod
+    def iter_commands(db_ids=None):
+        """Yield 'commands' in dict format, streaming the records a chunk at a time"""
+        for command in DBCommand.load_many(db_ids=db_ids):
+            yield command.to_json()
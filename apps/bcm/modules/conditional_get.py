@@ -0,0 +1,140 @@
+# coding: utf-8
+
+import hashlib
+import threading
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+
+from py4web import request, response
+from py4web.core import HTTP
+
+from ..models import db
+from .catalog_cache import CatalogCache
+
+"""
+>>> from apps.bcm.modules.conditional_get import conditional_get
+>>> @action("get_devices")
+... @action.uses(db, unit_of_work)
+... def get_devices():
+...     conditional_get.check(conditional_get.catalog_version(), conditional_get.results_version())
+...     return dict(devices=DeviceManager().get_devices())
+"""
+
+
+class ConditionalGet():
+    """
+    Conditional GET of the JSON endpoints (ETag, Last-Modified and 304 Not Modified)
+    The version of a response is computed from cheap aggregates of the tables it is built
+    from - the catalog version (see CatalogCache) and the 'results' DB id range, before the
+    response itself. A client sending the current ETag (If-None-Match) or a date not older
+    than the version (If-Modified-Since) gets a 304 without the response being built
+    Last-Modified is never older than the time the process first saw the current version of
+    each scope, changes not moving a timestamp (deleted devices, archived or expired results)
+    move Last-Modified too
+    """
+    def __init__(self):
+        """
+        Standard constructor class
+        """
+        # Last-Modified of the responses built from constants
+        self.started_at = datetime.now().replace(microsecond=0)
+        self.lock = threading.Lock()
+        self.seen = dict()  # scope name -> (current version, first seen at)
+
+    @staticmethod
+    def latest(*timestamps):
+        """Return the latest of timestamps (datetime or 'YYYY-mm-dd HH:MM:SS'), None if all are None"""
+        timestamps = [datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S") if isinstance(timestamp, str)
+            else timestamp for timestamp in timestamps if timestamp]
+        return max(timestamps) if timestamps else None
+
+    @staticmethod
+    def select_max(field):
+        """Return the maximum of a field, one aggregate per query so SQLite reads it from an index"""
+        aggregate = field.max()
+        return db(field.table).select(aggregate).first()[aggregate]
+
+    @staticmethod
+    def catalog_version():
+        """
+        Return the version of the 'devices', 'commands' and 'output_parsers' catalog
+        ---
+        :return (version, last_modified): the catalog version and the latest 'modified_on'
+        :rtype (version, last_modified): tuple
+        """
+        last_modified = ConditionalGet.latest(ConditionalGet.select_max(db.devices.modified_on),
+            ConditionalGet.select_max(db.commands.modified_on),
+            ConditionalGet.select_max(db.output_parsers.modified_on))
+        return ("catalog", CatalogCache.read_version()), last_modified
+
+    @staticmethod
+    def results_version():
+        """
+        Return the version of 'results' and its archive partitions, new results change the
+        maximum DB id, archive and retention runs the minimum DB id and the partitions
+        ---
+        :return (version, last_modified): the DB id range and partitions, the latest 'completed_at'
+        :rtype (version, last_modified): tuple
+        """
+        first_id = db.results.id.min()
+        partitions = db.result_partitions.id.count()
+        version = ("results", db(db.results).select(first_id).first()[first_id],
+            ConditionalGet.select_max(db.results.id),
+            db(db.result_partitions).select(partitions).first()[partitions],
+            str(ConditionalGet.select_max(db.result_partitions.archived_at)))
+        return version, ConditionalGet.latest(ConditionalGet.select_max(db.results.completed_at))
+
+    def constant_version(self, *values):
+        """Return the version of a response built from constants, last modified at the process start"""
+        return ("constant",) + tuple(values), self.started_at
+
+    def seen_at(self, version):
+        """Return when the process first saw a version of its scope (version[0]), now if it changed"""
+        with self.lock:
+            seen = self.seen.get(version[0])
+            if seen is None or seen[0] != version:
+                seen = (version, datetime.now().replace(microsecond=0))
+                self.seen.update({version[0]: seen})
+            return seen[1]
+
+    @staticmethod
+    def is_current(etag, last_modified):
+        """True if the client copy is current, If-None-Match takes precedence over If-Modified-Since"""
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags or f"W/{etag}" in tags
+        if_modified_since = request.headers.get("If-Modified-Since")
+        if not if_modified_since or not last_modified:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified.timestamp()) <= int(since.timestamp())
+
+    def check(self, *versions):
+        """
+        Set the ETag and Last-Modified of the response from versions, raise 304 Not Modified
+        if the client copy is current. The ETag includes the path and query string, each
+        endpoint, page or filter has its own ETag
+        ---
+        :param versions: (version, last_modified) of each table scope of the response, see
+            catalog_version(), results_version() and constant_version()
+        :type versions: tuple
+        """
+        key = repr(([version for version, last_modified in versions], request.path, request.query_string))
+        etag = f'"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"'
+        # the latest of the scope timestamps and of the time each scope version was first seen
+        last_modified = ConditionalGet.latest(*[ConditionalGet.latest(last_modified, self.seen_at(version))
+            for version, last_modified in versions])
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if last_modified:
+            headers.update({"Last-Modified": formatdate(last_modified.timestamp(), usegmt=True)})
+        response.headers.update(headers)
+        if ConditionalGet.is_current(etag, last_modified):
+            raise HTTP(304, headers=headers)
+
+
+# shared by all the actions of the process
+conditional_get = ConditionalGet()
@@ -1,13 +1,22 @@
 # coding: utf-8 #
 
+import asyncio
 import logging
 import os
 import re
 import json
+import time
 
 from netmiko import NetmikoTimeoutException
 from paramiko.ssh_exception import AuthenticationException, SSHException
 from netmiko.ssh_dispatcher import ConnectHandler
+from netmiko.utilities import get_structured_data
+
+# asyncssh is optional, only required by AsyncNetConnect
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
 
 USER = 'admin'
 PSWD = 'C1sco12345'
@@ -26,6 +35,8 @@ class NetConnect():
         self.password = None
         self.connect = None
         self.is_connected = False
+        self.timeout = None  # connect timeout (seconds), None uses the netmiko default
+        self.port = None  # SSH port, None uses port 22
         if self.host_vendor:
             self.device_type = self.set_netmiko_device_type(vendor=self.host_vendor)
     
@@ -71,6 +82,11 @@ class NetConnect():
             "password": self.password}
         if self.device_type == 'juniper_junos':
             device_params.update({"fast_cli": False})
+        if self.port:
+            device_params.update({"port": self.port})
+        if self.timeout:
+            device_params.update({"conn_timeout": self.timeout, "auth_timeout": self.timeout,
+                "banner_timeout": self.timeout})
         try:
             self.connect = ConnectHandler(**device_params)
         except (NetmikoTimeoutException):
@@ -107,9 +123,10 @@ class NetConnect():
             response = self.connect.send_command_timing(command)
         return response
     
-    def send_op_command_json(self, cmd, timing=False):
+    def send_op_command_json(self, cmd, timing=False, raw=False):
         """
         Send op command with json set and return output in json (dict) format
+        If raw is set the output is returned unparsed (str)
         """
         if self.host_vendor == 'Arista' or self.host_vendor == 'Cisco':
             if re.search('([|]+.json$)', cmd):
@@ -126,14 +143,188 @@ class NetConnect():
             response = self.connect.send_command(command)
         else:
             response = self.connect.send_command_timing(command)
-        if response and isinstance(response, str):
+        if response and isinstance(response, str) and not raw:
             response = json.loads(response)
         return response
     
+    def send_op_commands_batch(self, cmds, use_json=False, use_textfsm=False, raw=False, read_timeout=60):
+        """
+        Send a list of op commands in one pipelined write and return the outputs in the same order
+        The combined output is split on the device prompt, falls back to one command at a time
+        when the output cannot be split into one segment per command
+        ---
+        :param cmds: list of op commands
+        :type cmds: list
+        :param use_json: append '| json' and return the outputs in json (dict) format
+        :type use_json: bool
+        :param raw: return the outputs unparsed (str)
+        :type raw: bool
+        :return responses: list of outputs (str, dict or TextFSM list)
+        :rtype responses: list
+        """
+        if not cmds or not isinstance(cmds, list):
+            raise TypeError(self.__class__.__name__, f"Invalid type expecting list received {type(cmds)}")
+        if not self.is_connected:
+            logging.warning(f"{self.__class__.__name__}, Not connected!")
+            return [None for cmd in cmds]
+        commands = list()
+        for cmd in cmds:
+            if use_json and (self.host_vendor == 'Arista' or self.host_vendor == 'Cisco'):
+                if not re.search('([|]+.json$)', cmd):
+                    cmd = cmd + " | json"
+            commands.append(cmd)
+        prompt = self.connect.find_prompt()
+        prompt_pattern = re.compile(rf"^{re.escape(prompt)}", re.M)
+        self.connect.write_channel("".join(cmd + self.connect.RETURN for cmd in commands))
+        output = ""
+        start = time.monotonic()
+        while len(prompt_pattern.findall(output)) < len(commands):
+            if time.monotonic() - start > read_timeout:
+                logging.warning(f"{self.__class__.__name__}, Timed out reading batch output")
+                break
+            output += self.connect.read_channel()
+            time.sleep(0.05)
+        # segments: '<cmd echo>\n<output>' for each command followed by the trailing prompt
+        segments = prompt_pattern.split(self.connect.strip_ansi_escape_codes(output))
+        if len(segments) != len(commands) + 1:
+            logging.warning(f"{self.__class__.__name__}, Unable to split batch output, "
+                            "sending commands one at a time")
+            # the pipelined output still in the channel must not be read by the next commands
+            if not self.drain_channel(timeout=read_timeout):
+                logging.warning(f"{self.__class__.__name__}, Batch output not drained, reconnecting")
+                self.disconnect()
+                self.connect_to_device()
+                if not self.is_connected:
+                    return [None for cmd in cmds]
+            if use_json:
+                return [self.send_op_command_json(cmd, raw=raw) for cmd in cmds]
+            return [self.send_op_command(cmd, use_textfsm=use_textfsm and not raw) for cmd in cmds]
+        responses = list()
+        for cmd, segment in zip(commands, segments[:-1]):
+            response = segment.split("\n", 1)[1] if "\n" in segment else ""
+            response = response.replace("\r\n", "\n").strip()
+            if raw:
+                pass
+            elif use_json and response:
+                try:
+                    response = json.loads(response)
+                except ValueError as json_error:
+                    logging.warning(f"{self.__class__.__name__}, Invalid json output for '{cmd}': {json_error}")
+                    response = None
+            elif use_textfsm:
+                response = get_structured_data(response, platform=self.device_type, command=cmd)
+            responses.append(response)
+        return responses
+    
+    def drain_channel(self, quiet=1, timeout=60):
+        """
+        Read and discard the channel output until no output is received for quiet seconds
+        ---
+        :return True or False: based on whether the channel is quiet before timeout
+        """
+        start = last_read = time.monotonic()
+        while time.monotonic() - start < timeout:
+            if self.connect.read_channel():
+                last_read = time.monotonic()
+            elif time.monotonic() - last_read >= quiet:
+                return True
+            time.sleep(0.05)
+        return False
+    
+    def is_alive(self):
+        """Return True if the session to the host device is open and responding"""
+        if not self.is_connected or not self.connect:
+            return False
+        try:
+            return self.connect.is_alive()
+        except Exception:
+            return False
+    
     def disconnect(self):
         """Disconnect from the host device"""
-        if not self.is_connected and not self.connected.is_alive():
-            logging.warning(self.__class__.__name__, "Not connected!")
+        if not self.is_connected or not self.connect:
+            logging.warning(f"{self.__class__.__name__}, Not connected!")
         else:
             self.connect.disconnect()
             self.is_connected = False
+
+
+class AsyncNetConnect(NetConnect):
+    """
+    asyncio SSH wrapper class with the NetConnect interface (methods are coroutines)
+    Uses asyncssh so one event loop can hold thousands of device sessions, commands run
+    on exec channels which avoids prompt detection, TextFSM parsing uses netmiko templates
+    """
+    def __init__(self, host=None, vendor=None, timeout=30):
+        super(AsyncNetConnect, self).__init__(host=host, vendor=vendor)
+        self.timeout = timeout
+        self.command_timeout = timeout
+
+    async def connect_to_device(self, auth=None):
+        """Connect to the host device"""
+        if asyncssh is None:
+            raise ImportError(self.__class__.__name__, "asyncssh is required, pip install asyncssh")
+        if self.is_connected:
+            logging.warning(f"{self.__class__.__name__}, Already connected")
+            return False
+        if not self.username and not isinstance(auth, tuple):
+            logging.warning(f"{self.__class__.__name__}, No login credentials set")
+            return False
+        elif auth and isinstance(auth, tuple):
+            self.username = auth[0]
+            self.password = auth[1]
+        try:
+            self.connect = await asyncio.wait_for(
+                asyncssh.connect(self.host, port=self.port or 22, username=self.username,
+                    password=self.password, known_hosts=None), timeout=self.timeout)
+        except (asyncio.TimeoutError):
+            logging.warning(f"{self.__class__.__name__}, No response, connection timed out!")
+        except (asyncssh.PermissionDenied):
+            logging.warning(f"{self.__class__.__name__}, No login credentials set!")
+        except (asyncssh.Error, OSError):
+            logging.warning(f"{self.__class__.__name__}, SSH issue!")
+        except Exception as unknown_error:
+            logging.warning(f"{self.__class__.__name__}, Unexpected error!")
+        if self.connect:
+            self.is_connected = True
+
+    async def send_op_command(self, cmd, timing=False, use_textfsm=False):
+        """
+        Send op command and return output
+        The 'timing' parameter is accepted for compatibility, exec channels end on command exit
+        """
+        if cmd and isinstance(cmd, str):
+            command = cmd
+        else:
+            raise TypeError(self.__class__.__name__, f"Invalid type expecting str received {type(cmd)}")
+        if not self.is_connected:
+            logging.warning(f"{self.__class__.__name__}, Not connected!")
+            return None
+        result = await asyncio.wait_for(self.connect.run(command, check=False), timeout=self.command_timeout)
+        response = result.stdout
+        if use_textfsm:
+            response = get_structured_data(response, platform=self.device_type, command=command)
+        return response
+
+    async def send_op_command_json(self, cmd, timing=False, raw=False):
+        """
+        Send op command with json set and return output in json (dict) format
+        If raw is set the output is returned unparsed (str)
+        """
+        command = cmd
+        if self.host_vendor == 'Arista' or self.host_vendor == 'Cisco':
+            if not re.search('([|]+.json$)', cmd):
+                command = cmd + " | json"
+        response = await self.send_op_command(command, timing=timing)
+        if response and isinstance(response, str) and not raw:
+            response = json.loads(response)
+        return response
+
+    async def disconnect(self):
+        """Disconnect from the host device"""
+        if not self.is_connected:
+            logging.warning(f"{self.__class__.__name__}, Not connected!")
+        else:
+            self.connect.close()
+            await self.connect.wait_closed()
+            self.is_connected = False
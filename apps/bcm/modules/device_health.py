@@ -0,0 +1,139 @@
+# coding: utf-8
+
+import logging
+import threading
+import time
+from collections import deque
+
+from .. import settings
+
+
+class DeviceHealth():
+    """
+    Recent connect outcomes and latencies of a device with its circuit breaker state
+    """
+    def __init__(self, window=20):
+        self.latencies = deque(maxlen=window)  # seconds, successful connects only
+        self.failures = 0  # consecutive connect failures
+        self.opened_at = None  # time the circuit breaker opened, None while closed
+        self.trial = False  # a half-open trial connect is in progress
+        self.trial_at = None  # time the trial connect started
+    
+    def to_json(self):
+        return dict(latencies=list(self.latencies), failures=self.failures,
+            state=self.state, opened_at=self.opened_at)
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.trial else "open"
+
+
+class HealthMonitor():
+    """
+    Thread-safe per-device health registry keyed by 'devices' DB id
+    A circuit breaker opens after failure_threshold consecutive connect failures and
+    fast-fails the device until cool_down seconds have passed, then allows one trial connect.
+    Connect timeouts adapt to the device latency history within min_timeout and max_timeout,
+    devices without history use default_timeout (the netmiko 'conn_timeout' default)
+    """
+    def __init__(self, failure_threshold=3, cool_down=300, window=20,
+                 min_timeout=5, max_timeout=30, timeout_factor=3, default_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.cool_down = cool_down
+        self.window = window
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self.default_timeout = default_timeout
+        self.devices = dict()
+        self.lock = threading.Lock()
+    
+    def get_health(self, device_id):
+        """Return the health record of a device, caller must hold the lock"""
+        if device_id not in self.devices:
+            self.devices[device_id] = DeviceHealth(window=self.window)
+        return self.devices[device_id]
+    
+    def allow(self, device_id):
+        """
+        Check the circuit breaker before connecting to a device
+        ---
+        :return True or False: based on whether a connect attempt is allowed
+        """
+        with self.lock:
+            health = self.get_health(device_id)
+            if health.opened_at is None:
+                return True
+            now = time.monotonic()
+            # a trial pending longer than cool_down never ended, another trial is allowed
+            if health.trial and now - health.trial_at < self.cool_down:
+                return False
+            if now - health.opened_at < self.cool_down:
+                return False
+            # cool-down passed, allow a single trial connect (half-open)
+            health.trial = True
+            health.trial_at = now
+            return True
+    
+    def end_trial(self, device_id):
+        """
+        End the trial connect of a device if no connect outcome was recorded (a pooled
+        session re-used or an error before connecting), the circuit breaker stays open
+        """
+        with self.lock:
+            health = self.get_health(device_id)
+            health.trial = False
+            health.trial_at = None
+    
+    def connect_timeout(self, device_id):
+        """Return the connect timeout (seconds) adapted to the device latency history"""
+        with self.lock:
+            latencies = sorted(self.get_health(device_id).latencies)
+        if not latencies:
+            # no history, unreachable devices must not wait longer than before
+            return min(self.max_timeout, max(self.min_timeout, self.default_timeout))
+        p90 = latencies[int(0.9 * (len(latencies) - 1))]
+        return min(self.max_timeout, max(self.min_timeout, p90 * self.timeout_factor))
+    
+    def record_success(self, device_id, latency):
+        """Record a successful connect and close the circuit breaker"""
+        with self.lock:
+            health = self.get_health(device_id)
+            health.latencies.append(latency)
+            health.failures = 0
+            health.opened_at = None
+            health.trial = False
+            health.trial_at = None
+    
+    def record_failure(self, device_id):
+        """Record a failed connect, open the circuit breaker at failure_threshold"""
+        with self.lock:
+            health = self.get_health(device_id)
+            health.failures += 1
+            if health.trial or health.failures >= self.failure_threshold:
+                if health.opened_at is None or health.trial:
+                    logging.warning(f"{self.__class__.__name__}, Circuit opened for device id={device_id} "
+                                    f"after {health.failures} failed connects")
+                health.opened_at = time.monotonic()
+                health.trial = False
+                health.trial_at = None
+    
+    def reset(self, device_id=None):
+        """Clear the health record of a device or of all devices"""
+        with self.lock:
+            if device_id is None:
+                self.devices = dict()
+            else:
+                self.devices.pop(device_id, None)
+
+
+# shared by all pollers and jobs in the process
+device_health = HealthMonitor(
+    failure_threshold=settings.HEALTH_FAILURE_THRESHOLD,
+    cool_down=settings.HEALTH_COOL_DOWN,
+    min_timeout=settings.HEALTH_MIN_TIMEOUT,
+    max_timeout=settings.HEALTH_MAX_TIMEOUT,
+    default_timeout=settings.HEALTH_DEFAULT_TIMEOUT
+)
@@ -10,6 +10,7 @@ from .devices import DBDevice
 from .commands import DBCommand
 from .results import DBResult
 from .output_parsers import DBParser
+from .partitions import result_partitions
 
 
 """      
@@ -36,7 +37,7 @@ class DeviceManager():
         self.commands = None
         self.num_commands = None
         self.results = None
-        self.num_results = None
+        self._num_results = None
         self.limited_results = None
     
     @classmethod
@@ -50,6 +51,8 @@ class DeviceManager():
         :type device: int or str
         :param roles: search for 'devices' by device_roles
         :type roles: str
+        :param max_results: only load the latest max_results results of each device
+        :type max_results: int
         """
         if not device and not roles:
             devices = db(db.devices).select()
@@ -60,30 +63,57 @@ class DeviceManager():
                 devices = db(db.devices.id == device).select()
             elif isinstance(device, str):
                 devices = db((db.devices.mgmt_ip == device) | (db.devices.name == device)).select().first()
+        latest = None
+        if max_results and isinstance(max_results, int):
+            # the latest results of all the devices at once, the older results are not read
+            device_ids = [dev.id for dev in devices]
+            latest = result_partitions.select_latest_by_device(device_ids, limit=max_results)
+            DBResult.resolve([result for results in latest.values() for result in results])
         device_list = list()
         for dev in devices:
             dm = DeviceManager()
-            dm.load(device=dev.id, max_results=max_results)
+            dm.load(device=dev, max_results=max_results, latest=latest)
             device_list.append(dm.to_json())
         return device_list
     
-    def load(self, device, max_results=None):
-        """Create 'device' object and load the related objects"""
+    def load(self, device, max_results=None, latest=None):
+        """
+        Create 'device' object and load the related objects
+        With max_results the results of the device are only counted if num_results is read
+        ---
+        :param max_results: only load the latest max_results results
+        :type max_results: int
+        :param latest: latest results by device DB id, prefetched by get_devices()
+        :type latest: dict
+        """
         if isinstance(device, int):
-            d = DBDevice(db_id=device)
+            d = DBDevice.get(device)
         elif isinstance(device, Row):
-            d = DBDevice()
-            d.load_by_id(db_rec=device)
+            d = DBDevice.get(db_rec=device)
         if not d:
             logging.warning(f"Expected 'device' object, received {type(d)}")
             return None
         self.device = d
-        self.commands = [DBCommand(db_id=cmd) for cmd in self.device.commands]
-        self.results = self.get_results()
+        self.commands = [DBCommand.get(cmd) for cmd in self.device.commands]
         self.num_commands = self.commands_count
-        self.num_results = self.results_count
-        if max_results and isinstance(max_results, int) and max_results <= self.num_results:
-            self.limit_results(max_results=max_results)
+        self._num_results = None
+        if max_results and isinstance(max_results, int):
+            if latest is None:
+                self.limit_results(max_results=max_results)
+            else:
+                results = latest.get(self.device.db_id, list())
+                self.limited_results = [DBResult.get(db_rec=result) for result in reversed(DBResult.resolve(results))]
+            self.results = self.limited_results
+        else:
+            self.results = self.get_results()
+            self._num_results = self.results_count
+    
+    @property
+    def num_results(self):
+        """Number of results of the device, counted on first access when only the latest are loaded"""
+        if self._num_results is None and self.device is not None:
+            self._num_results = result_partitions.count_by_device([self.device.db_id]).get(self.device.db_id, 0)
+        return self._num_results
     
     @property
     def commands_count(self):
@@ -94,16 +124,17 @@ class DeviceManager():
         return len(self.results)
     
     def get_results(self):
-        """Return a list of 'result' objects loaded from the DB table 'results'"""
-        results_by_device = db(db.results.device == self.device.db_id).select()
-        results = [DBResult(db_id=result.id) for result in results_by_device]
+        """Return a list of 'result' objects loaded from 'results' and its archive partitions"""
+        results_by_device = result_partitions.select(lambda table: table.device == self.device.db_id)
+        results = [DBResult.get(db_rec=result) for result in DBResult.resolve(results_by_device)]
         return results
     
     def limit_results(self, max_results=None):
         """Return a limited number of 'result' objects based on parameter max_results"""
-        results_by_device = db(db.results.device == self.device.db_id).select()
-        if results_by_device and len(results_by_device) >= max_results:
-            self.limited_results = [DBResult(db_id=result.id) for result in results_by_device[-max_results:]]
+        # the latest results, the archive partitions are only read if 'results' has too few
+        results_by_device = result_partitions.select_latest(
+            lambda table: table.device == self.device.db_id, limit=max_results)
+        self.limited_results = [DBResult.get(db_rec=result) for result in reversed(DBResult.resolve(results_by_device))]
     
     def commands_to_json(self):
         """
@@ -0,0 +1,276 @@
+# coding: utf-8
+
+import asyncio
+import json
+import logging
+import random
+import threading
+
+# asyncssh is optional, only required to run the simulator
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+"""
+>>> from apps.bcm.modules.device_simulator import DeviceSimulator
+>>> sim = DeviceSimulator(port=8022, latency=0.05)
+>>> sim.add_device("127.0.1.1", "nxos")
+>>> sim.start()
+$ ssh -p 8022 admin@127.0.1.1
+sim-127-0-1-1# show ip interface brief | json
+>>> sim.stop()
+"""
+
+NXOS_IP_INT_BRIEF = {"TABLE_intf": {"ROW_intf": [
+    {"vrf-name-out": "default", "intf-name": "Vlan10", "proto-state": "down", "link-state": "down",
+     "admin-state": "down", "iod": "77", "prefix": "192.168.1.1", "ip-disabled": "FALSE"},
+    {"vrf-name-out": "default", "intf-name": "Vlan20", "proto-state": "down", "link-state": "down",
+     "admin-state": "up", "iod": "78", "prefix": "192.168.2.1", "ip-disabled": "FALSE"},
+    {"vrf-name-out": "default", "intf-name": "Lo1", "proto-state": "up", "link-state": "up",
+     "admin-state": "up", "iod": "73", "prefix": "192.168.1.2", "ip-disabled": "FALSE"},
+    {"vrf-name-out": "default", "intf-name": "Lo59", "proto-state": "up", "link-state": "up",
+     "admin-state": "up", "iod": "84", "prefix": "59.59.59.59", "ip-disabled": "FALSE"},
+    {"vrf-name-out": "default", "intf-name": "Eth1/59", "proto-state": "down", "link-state": "down",
+     "admin-state": "down", "iod": "63", "prefix": "192.168.59.254", "ip-disabled": "FALSE"}
+]}}
+
+NXOS_VERSION = {"bios_ver_str": "", "kickstart_ver_str": "10.3(3)", "nxos_ver_str": "10.3(3)",
+    "chassis_id": "Nexus9000 C9300v Chassis", "host_name": "sim", "kern_uptm_days": "12"}
+
+EOS_VERSION = {"modelName": "vEOS-lab", "version": "4.30.5M", "serialNumber": "SIM0001",
+    "systemMacAddress": "50:00:00:00:00:01", "uptime": 1036800.0}
+
+EOS_IP_INT_BRIEF = {"interfaces": {
+    "Ethernet1": {"name": "Ethernet1", "interfaceStatus": "connected", "lineProtocolStatus": "up",
+        "interfaceAddress": {"ipAddr": {"address": "10.0.12.1", "maskLen": 30}}},
+    "Loopback0": {"name": "Loopback0", "interfaceStatus": "connected", "lineProtocolStatus": "up",
+        "interfaceAddress": {"ipAddr": {"address": "10.255.0.1", "maskLen": 32}}}
+}}
+
+IOS_VERSION = """Cisco IOS XE Software, Version 17.09.04a
+Cisco IOS Software [Cupertino], Virtual XE Software (X86_64_LINUX_IOSD-UNIVERSALK9-M), Version 17.9.4a, RELEASE SOFTWARE (fc3)
+ROM: IOS-XE ROMMON
+sim uptime is 12 days, 4 hours, 2 minutes
+System image file is "bootflash:packages.conf"
+cisco C8000V (VXE) processor (revision VXE) with 1987015K/3075K bytes of memory.
+Processor board ID 9ZW9SIM0001
+Configuration register is 0x2102"""
+
+IOS_IP_INT_BRIEF = """Interface              IP-Address      OK? Method Status                Protocol
+GigabitEthernet1       10.10.20.48     YES NVRAM  up                    up
+GigabitEthernet2       unassigned      YES NVRAM  administratively down down
+Loopback0              10.0.0.1        YES manual up                    up"""
+
+JUNOS_VERSION = """Hostname: sim
+Model: vmx
+Junos: 23.2R1.13
+JUNOS OS Kernel 64-bit  [20230616.0b9c5f1_builder_stable_13]"""
+
+JUNOS_INT_TERSE = """Interface               Admin Link Proto    Local                 Remote
+ge-0/0/0                up    up
+ge-0/0/0.0              up    up   inet     10.0.0.1/30
+lo0.0                   up    up   inet     10.255.0.1          --> 0/0"""
+
+# canned outputs by device os and command, json outputs are used for '| json' commands
+OUTPUTS = {
+    "ios": {
+        "show version": IOS_VERSION,
+        "show ip interface brief": IOS_IP_INT_BRIEF,
+    },
+    "nxos": {
+        "show version": NXOS_VERSION,
+        "show ip interface brief": NXOS_IP_INT_BRIEF,
+    },
+    "eos": {
+        "show version": EOS_VERSION,
+        "show ip interface brief": EOS_IP_INT_BRIEF,
+    },
+    "junos": {
+        "show version": JUNOS_VERSION,
+        "show interfaces terse": JUNOS_INT_TERSE,
+    },
+}
+
+# responses to the session setup (paging/width) commands sent by netmiko
+SETUP_OUTPUTS = {
+    "terminal length": "Pagination disabled.",
+    "terminal width": "Width set to 511 columns.",
+    "set cli screen-length": "Screen length set to 0",
+    "set cli screen-width": "Screen width set to 511",
+    "set cli complete-on-space": "Disabling complete-on-space",
+}
+
+INVALID_INPUT = {
+    "ios": "% Invalid input detected at '^' marker.",
+    "nxos": "% Invalid command at '^' marker.",
+    "eos": "% Invalid input",
+    "junos": "error: unknown command",
+}
+
+
+class SimulatedDevice():
+    """
+    Emulated network device CLI (prompt, paging setup and canned command outputs)
+    """
+    def __init__(self, host, os, outputs=None):
+        self.host = host
+        self.os = os if os in OUTPUTS else "ios"
+        self.hostname = f"sim-{host.replace('.', '-')}"
+        self.outputs = outputs if outputs else OUTPUTS[self.os]
+
+    @property
+    def prompt(self):
+        if self.os == "junos":
+            return f"admin@{self.hostname}> "
+        return f"{self.hostname}#"
+
+    def run(self, cmd):
+        """Return the output of a command, json outputs for '| json' or '| display json'"""
+        command = " ".join(cmd.split())
+        if not command:
+            return ""
+        for setup, output in SETUP_OUTPUTS.items():
+            if command.startswith(setup):
+                return output if self.os in ("eos", "junos") else ""
+        as_json = False
+        for pipe in ("| display json", "| json"):
+            if command.endswith(pipe):
+                command = command[:-len(pipe)].strip()
+                as_json = True
+        output = self.outputs.get(command)
+        if output is None:
+            return INVALID_INPUT[self.os]
+        if isinstance(output, dict):
+            return json.dumps(output, indent=2) if as_json else json.dumps(output)
+        if as_json:
+            return json.dumps({"output": output})
+        return output
+
+
+class SimulatorServer(asyncssh.SSHServer if asyncssh else object):
+    """
+    asyncssh server callbacks, accepts any login apart from injected failures
+    """
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    async def validate_password(self, username, password):
+        sim = self.simulator
+        await asyncio.sleep(sim.jitter(sim.login_latency))
+        if random.random() < sim.hang_rate:
+            # never answer, the client connect times out
+            await asyncio.sleep(3600)
+        return random.random() >= sim.failure_rate
+
+
+class DeviceSimulator():
+    """
+    Local SSH server emulating EOS, IOS, NX-OS and JunOS devices for testing and benchmarks
+    Each simulated device is a loopback address (127.x.y.z) on a shared port, the device
+    is selected by the address the client connected to. Runs its own event loop thread.
+    ---
+    latency: seconds added to each command, login_latency: seconds added to each login,
+    failure_rate: probability a login is rejected, hang_rate: probability a login never answers
+    """
+    def __init__(self, port=8022, latency=0.0, login_latency=0.0, failure_rate=0.0, hang_rate=0.0):
+        if asyncssh is None:
+            raise ImportError(self.__class__.__name__, "asyncssh is required, pip install asyncssh")
+        self.port = port
+        self.latency = latency
+        self.login_latency = login_latency
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.devices = dict()
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    @staticmethod
+    def jitter(delay):
+        """Return delay +/- 20%"""
+        return delay * random.uniform(0.8, 1.2) if delay else 0
+
+    def add_device(self, host, os, outputs=None):
+        """Add a simulated device on loopback address 'host'"""
+        self.devices[host] = SimulatedDevice(host=host, os=os, outputs=outputs)
+
+    async def handle_process(self, process):
+        """Run the CLI of the device the client connected to"""
+        host = process.get_extra_info("sockname")[0]
+        device = self.devices.get(host)
+        if not device:
+            process.exit(1)
+            return
+        if process.command:
+            # exec channel, run a single command
+            await asyncio.sleep(self.jitter(self.latency))
+            process.stdout.write(device.run(process.command) + "\n")
+            process.exit(0)
+            return
+        process.stdout.write(device.prompt)
+        buffer = ""
+        try:
+            while True:
+                data = await process.stdin.read(4096)
+                if not data:
+                    break
+                # like device CLIs ignore NUL keepalives
+                buffer += data.replace("\x00", "").replace("\r\n", "\n").replace("\r", "\n")
+                # commands typed ahead are echoed and answered one line at a time
+                while "\n" in buffer:
+                    line, buffer = buffer.split("\n", 1)
+                    cmd = line.strip()
+                    if cmd in ("exit", "quit", "logout"):
+                        process.exit(0)
+                        return
+                    process.stdout.write(line + "\r\n")
+                    if cmd:
+                        await asyncio.sleep(self.jitter(self.latency))
+                        output = device.run(cmd)
+                        if output:
+                            process.stdout.write(output.replace("\n", "\r\n") + "\r\n")
+                    process.stdout.write(device.prompt)
+        except (asyncssh.BreakReceived, asyncssh.SignalReceived, asyncssh.TerminalSizeChanged):
+            pass
+        except (asyncssh.Error, OSError, ConnectionError):
+            pass
+        process.exit(0)
+
+    async def start_server(self):
+        host_key = asyncssh.generate_private_key("ssh-ed25519")
+        self.server = await asyncssh.create_server(
+            lambda: SimulatorServer(self), list(self.devices.keys()), self.port,
+            server_host_keys=[host_key], process_factory=self.handle_process,
+            line_editor=False, encoding="utf-8")
+
+    def start(self):
+        """Start the simulator on a background event loop thread"""
+        if not self.devices:
+            raise ValueError(self.__class__.__name__, "No simulated devices, use add_device")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="bcm_simulator", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start_server(), self.loop).result()
+        logging.warning(f"{self.__class__.__name__}, {len(self.devices)} devices listening on port {self.port}")
+
+    def stop(self):
+        """Stop the simulator and its event loop thread"""
+        if not self.loop:
+            return
+
+        async def close():
+            self.server.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
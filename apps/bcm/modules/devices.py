@@ -4,7 +4,8 @@ import logging
 
 from pydal.objects import Row
 
-from .bcm_db import BCMDb
+from .bcm_db import BCMDb, LinkList
+from .catalog_cache import catalog_cache
 from ..models import db
 
 
@@ -12,6 +13,10 @@ class DBDevice(BCMDb):
     """
     DB Abstraction class for uniform interaction with DB Table 'devices'
     """
+    dbtable = 'devices'
+    # device 'commands' DB ids, stored in link table 'device_commands'
+    commands = LinkList('device_commands')
+    
     def __init__(self, db_id=None, name=None, mgmt_ip=None):
         """
         Standard constructor class
@@ -49,7 +54,7 @@ class DBDevice(BCMDb):
                 rec_id = db_id
             if not rec_id:
                 raise ValueError(self.__class__.__name__, "Invalid or missing record id")
-            db_rec = db(db.devices.id == rec_id).select().first()
+            db_rec = catalog_cache.get_record('devices', rec_id)
         if not db_rec:
             raise TypeError(self.__class__.__name__, f"Expecting record received {type(db_rec)}")
         self.db_id = db_rec.id
@@ -59,7 +64,7 @@ class DBDevice(BCMDb):
         self.os = db_rec.os
         self.device_function = db_rec.device_function
         self.device_roles = db_rec.device_roles
-        self.commands = db_rec.commands
+        self.commands = None  # loaded from 'device_commands' on first access
         self.region = db_rec.region
         self.site_code = db_rec.site_code
         self.comment = db_rec.comment
@@ -69,54 +74,57 @@ class DBDevice(BCMDb):
     
     def save(self):
         """
-        Save a record to DB - creator/updater method
+        Save a record to DB - creator/updater method, one upsert on the natural key 'name'
         Must set the class db_id to the new DB id
         ---
-        :return True or False: based on whether a new record is created or not
+        :return True or False: based on whether a record is created/updated or not
         """
-        # create query to check whether record already exists 'name & mgmt_ip'
-        query = (db.devices.name == self.name) & (db.devices.mgmt_ip == self.mgmt_ip)
-        if db(query).count() == 0:
-            # create query to check for duplicates of unique fields before save
-            is_unique = (db.devices.name == self.name) | (db.devices.mgmt_ip == self.mgmt_ip)
-            if db(is_unique).count() > 0:
-                logging.warning(f"Duplicate value in 'devices' for name={self.name} or mgmt_ip={self.mgmt_ip}")
-                return False
-            self.created_at = DBDevice.get_timestamp()
-            self.modified_on = self.created_at
-            db.devices.insert(name=self.name, mgmt_ip=self.mgmt_ip, vendor=self.vendor,
-                os=self.os, device_function=self.device_function, device_roles=self.device_roles,
-                commands=self.commands, region=self.region, site_code=self.site_code,
-                comment=self.comment, created_at=self.created_at, modified_on=self.modified_on)
-            db.commit()
-            db_rec = db(query).select().first()
+        timestamp = DBDevice.get_timestamp()
+        fields = dict(name=self.name, mgmt_ip=self.mgmt_ip, vendor=self.vendor,
+            os=self.os, device_function=self.device_function, device_roles=self.device_roles,
+            region=self.region, site_code=self.site_code,
+            comment=self.comment, created_at=timestamp, modified_on=timestamp)
+        modifiable = ['vendor', 'os', 'device_function', 'device_roles',
+            'region', 'site_code', 'comment']
+        try:
+            # the record is read first, created or updated is not known from the upsert
+            existing = db(db.devices.name == self.name).select(db.devices.id, db.devices.mgmt_ip).first()
+            # existing 'name & mgmt_ip' records are updated, a new 'mgmt_ip' must be unique
+            db_rec = self.upsert(db.devices, keys=('name',), fields=fields,
+                update=modifiable + ['modified_on'], match=['mgmt_ip'], compare=modifiable,
+                returning=('id', 'created_at'))
             if db_rec:
-                self.db_id = db_rec.id
+                self.db_id = db_rec[0]
+                links_changed = self.save_links(created=existing is None)
+            elif existing and existing.mgmt_ip == self.mgmt_ip:
+                self.db_id = existing.id
+                links_changed = self.save_links()
+            else:
+                links_changed = False
+            # the record and its links are committed at once
+            if db_rec or links_changed:
+                self.commit()
+        except Exception as save_error:
+            self.rollback()
+            logging.warning(f"Duplicate value in 'devices' for name={self.name} or mgmt_ip={self.mgmt_ip}: {save_error}")
+            return False
+        if db_rec:
+            self.modified_on = timestamp
+            if existing is None:
+                self.created_at = timestamp
                 self.db_created = True
                 logging.warning(f"New record created in table 'devices' id={self.db_id}")
-                return True
-        elif db(query).count() > 0:
-            """
-            TODO: This should be a modify record action.
-                  We should not be able to update a duplicate entry.
-            """
-            db_rec = db(query).select().first()
-            self.db_id = db_rec.id
-            if not self.is_record_modified(db_rec=db_rec):
-                logging.warning(f"No changes to save for id={self.db_id}")
-                return False
-            self.modified_on = DBDevice.get_timestamp()
-            db.devices.update_or_insert(query,
-                name=self.name, mgmt_ip=self.mgmt_ip, vendor=self.vendor, os=self.os,
-                device_function=self.device_function, device_roles=self.device_roles,
-                commands=self.commands, region=self.region, site_code=self.site_code,
-                comment=self.comment, created_at=self.created_at, modified_on=self.modified_on)
-            db.commit()
-            logging.warning(f"Updated record in table 'devices' with id={self.db_id}")
+            else:
+                self.created_at = db_rec[1]
+                logging.warning(f"Updated record in table 'devices' with id={self.db_id}")
             return True
-        # catch-all error
-        logging.warning("Unknown Error, more information/debugging required")
-        db.rollback()
+        if existing and existing.mgmt_ip == self.mgmt_ip:
+            if links_changed:
+                logging.warning(f"Updated record in table 'devices' with id={self.db_id}")
+                return True
+            logging.warning(f"No changes to save for id={self.db_id}")
+            return False
+        logging.warning(f"Duplicate value in 'devices' for name={self.name} or mgmt_ip={self.mgmt_ip}")
         return False
     
     def is_record_modified(self, db_rec=None, db_id=None):
@@ -143,7 +151,7 @@ class DBDevice(BCMDb):
             self.os != db_rec.os or
             self.device_function != db_rec.device_function or
             self.device_roles != db_rec.device_roles or
-            self.commands != db_rec.commands or
+            set(self.commands) != set(DBDevice.commands.select(db_rec.id).get(db_rec.id, list())) or
             self.region != db_rec.region or
             self.site_code != db_rec.site_code or
             self.comment != db_rec.comment
@@ -171,7 +179,7 @@ class DBDevice(BCMDb):
             raise TypeError(self.__class__.__name__, f"Invalid type expecting Row received {type(db_rec)}")
         if db(db.results.device.belongs(db(db.devices.id == db_rec.id).select())).count() == 0:
             db(db.devices.id == db_rec.id).delete()
-            db.commit()
+            self.commit()
             logging.warning(f"Record deleted in table 'devices' with id={self.db_id}")
             self.db_id = None
             self.db_loaded = False
@@ -249,21 +257,18 @@ class DBDevices():
     
     @staticmethod
     def get_devices(db_ids=None):
-        if not db_ids:
-            devices = db(db.devices).select()
-        else:
-            if isinstance(db_ids, list):
-                for db_id in db_ids:
-                    idx = 0
-                    while idx < len(db_ids):
-                        if idx == 0:
-                            query = (db.devices.id == db_id)
-                        else:
-                            query |= (db.devices.id == db_id)
-                        idx += 1
-                devices = db(query).select()
-        devices_list = []
-        for device in devices:
-            d = DBDevice(db_id=device.id)
-            devices_list.append(d.to_json())
-        return devices_list
+        """
+        Return 'devices' in dict format, one query per BELONGS_CHUNK_SIZE records
+        ---
+        :param db_ids: DB ids of the 'devices', None or empty for all 'devices'
+        :type db_ids: list
+        :return devices_list: list of 'devices' in dict format
+        :rtype devices_list: list
+        """
+        return list(DBDevices.iter_devices(db_ids=db_ids))
+    
+    @staticmethod
+    def iter_devices(db_ids=None):
+        """Yield 'devices' in dict format, streaming the records a chunk at a time"""
+        for device in DBDevice.load_many(db_ids=db_ids):
+            yield device.to_json()
@@ -0,0 +1,213 @@
+# coding: utf-8
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .. import settings
+from .network_poller import NetworkPoller, AsyncNetworkPoller
+from .result_sink import ResultSink
+
+
+class JobEngine():
+    """
+    Execution engine to poll the 'devices' of a job concurrently with a bounded worker pool
+    DB access (loading devices/commands and saving results) stays on the calling thread,
+    only the device connections and commands are run by the pool workers
+    When streaming, the calling thread saves each command result as soon as it completes
+    """
+    # seconds the calling thread waits for streamed results before checking the pool
+    STREAM_POLL_INTERVAL = 0.1
+    
+    def __init__(self, job, max_workers=None, use_asyncio=None, devices=None, stream=None, progress=None,
+                 port=None):
+        """
+        Standard constructor class
+        ---
+        :param job: the job to execute
+        :type job: DBJob
+        :param max_workers: maximum number of devices polled at once (default settings.JOB_MAX_WORKERS)
+        :type max_workers: int
+        :param use_asyncio: poll devices from one event loop (default settings.JOB_USE_ASYNCIO)
+        :type use_asyncio: bool
+        :param devices: subset (shard) of the job devices to poll, default all job devices
+        :type devices: list
+        :param stream: save results as each command completes (default settings.JOB_STREAM_RESULTS)
+        :type stream: bool
+        :param progress: called with the new 'results' DB ids at most every settings.JOB_PROGRESS_INTERVAL
+        :type progress: callable
+        :param port: SSH port of the job devices (default settings.DEVICE_SSH_PORT)
+        :type port: int
+        """
+        self.job = job
+        self.devices = devices if devices is not None else job.devices
+        self.use_asyncio = settings.JOB_USE_ASYNCIO if use_asyncio is None else use_asyncio
+        if max_workers:
+            self.max_workers = max_workers
+        elif self.use_asyncio:
+            self.max_workers = settings.JOB_MAX_ASYNC_SESSIONS
+        else:
+            self.max_workers = settings.JOB_MAX_WORKERS
+        self.pollers = dict()
+        self.failed = list()
+        self.timings = dict()  # device id -> seconds spent polling the device
+        self.save_time = 0.0  # seconds spent saving results
+        self.stream = settings.JOB_STREAM_RESULTS if stream is None else stream
+        self.sink = None
+        self.progress = progress
+        self.progress_results = list()  # 'results' DB ids not yet reported to progress
+        self.progress_at = time.monotonic()
+        self.port = port
+    
+    def load_pollers(self):
+        """Create a 'NetworkPoller' for each job device and load the device commands"""
+        self.pollers = dict()
+        poller_class = AsyncNetworkPoller if self.use_asyncio else NetworkPoller
+        if self.stream:
+            # the event loop thread writes the results, pollers must never block on a full queue
+            self.sink = ResultSink(maxsize=0 if self.use_asyncio else settings.JOB_STREAM_QUEUE_SIZE)
+        for device in self.devices:
+            poller = poller_class(device_id=device, job_id=self.job.db_id, port=self.port)
+            poller.load_device_commands()
+            poller.sink = self.sink
+            self.pollers.update({device: poller})
+    
+    def report_progress(self, results, force=False):
+        """Report new 'results' DB ids to self.progress, at most every settings.JOB_PROGRESS_INTERVAL"""
+        if not self.progress:
+            return
+        self.progress_results.extend(results)
+        if not self.progress_results:
+            return
+        if force or time.monotonic() - self.progress_at >= settings.JOB_PROGRESS_INTERVAL:
+            results, self.progress_results = self.progress_results, list()
+            self.progress_at = time.monotonic()
+            self.progress(results)
+    
+    def write_results(self, timeout=None):
+        """Save the streamed results waiting in self.sink, return the new 'results' DB ids"""
+        written = self.sink.write(timeout=timeout)
+        self.report_progress(written)
+        return written
+    
+    def poll_device(self, device, poller, auth):
+        """Run the device commands on a pool worker and record the device poll time"""
+        started = time.monotonic()
+        try:
+            return poller.run_device_commands(auth=auth)
+        finally:
+            self.timings[device] = time.monotonic() - started
+    
+    def save_device(self, device, polled):
+        """Save the results of a polled device, return the new 'results' DB ids"""
+        if polled is False:
+            self.failed.append(device)
+            return list()
+        poller = self.pollers[device]
+        started = time.monotonic()
+        poller.save_results()
+        self.save_time += time.monotonic() - started
+        results = list(poller.results) if poller.results else list()
+        self.report_progress(results)
+        return results
+    
+    def run(self):
+        """
+        Poll all job devices using the worker pool and save results as each device completes,
+        or as each command completes when streaming
+        ---
+        :return results: list of 'results' DB ids created by the job
+        :rtype results: list
+        """
+        if not self.pollers:
+            self.load_pollers()
+        if self.use_asyncio:
+            return asyncio.run(self.run_async())
+        results = list()
+        workers = max(1, min(self.max_workers, len(self.pollers)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcm_job") as executor:
+            futures = {
+                executor.submit(self.poll_device, device, poller, self.job.get_device_auth(device)): device
+                for device, poller in self.pollers.items()
+            }
+            if self.sink:
+                completed = self.stream_completed(futures, results)
+            else:
+                completed = as_completed(futures)
+            for future in completed:
+                device = futures[future]
+                try:
+                    polled = future.result()
+                except Exception as poll_error:
+                    logging.warning(f"{self.__class__.__name__}, device id={device} failed: {poll_error}")
+                    polled = False
+                results.extend(self.save_device(device, polled))
+        if self.sink:
+            results.extend(self.finish_stream())
+        self.report_progress(list(), force=True)
+        return results
+    
+    def stream_completed(self, futures, results):
+        """Save streamed results while the devices are polled, yield the futures as they complete"""
+        pending = set(futures)
+        while pending:
+            results.extend(self.write_results(timeout=JobEngine.STREAM_POLL_INTERVAL))
+            completed = [future for future in pending if future.done()]
+            for future in completed:
+                pending.discard(future)
+                yield future
+    
+    def finish_stream(self):
+        """Save the results still queued in self.sink once all devices are polled"""
+        results = list()
+        while not self.sink.is_idle:
+            results.extend(self.write_results(timeout=JobEngine.STREAM_POLL_INTERVAL))
+        self.save_time += self.sink.save_time
+        return results
+    
+    async def run_async(self):
+        """
+        Poll all job devices from one event loop, at most self.max_workers sessions open at once
+        ---
+        :return results: list of 'results' DB ids created by the job
+        :rtype results: list
+        """
+        if not self.pollers:
+            self.load_pollers()
+        results = list()
+        sessions = asyncio.Semaphore(max(1, self.max_workers))
+        
+        async def poll(device, poller, auth):
+            async with sessions:
+                started = time.monotonic()
+                try:
+                    polled = await poller.run_device_commands(auth=auth)
+                except Exception as poll_error:
+                    logging.warning(f"{self.__class__.__name__}, device id={device} failed: {poll_error}")
+                    polled = False
+                self.timings[device] = time.monotonic() - started
+            return device, polled
+        
+        tasks = [
+            poll(device, poller, self.job.get_device_auth(device))
+            for device, poller in self.pollers.items()
+        ]
+        
+        async def write():
+            while True:
+                results.extend(self.write_results())
+                await asyncio.sleep(JobEngine.STREAM_POLL_INTERVAL)
+        
+        writer = asyncio.ensure_future(write()) if self.sink else None
+        try:
+            for task in asyncio.as_completed(tasks):
+                device, polled = await task
+                results.extend(self.save_device(device, polled))
+        finally:
+            if writer:
+                writer.cancel()
+        if self.sink:
+            results.extend(self.finish_stream())
+        self.report_progress(list(), force=True)
+        return results
@@ -5,16 +5,25 @@ import json
 
 from pydal.objects import Row
 
-from .bcm_db import BCMDb
-from .network_poller import NetworkPoller
+from .bcm_db import BCMDb, LinkList
+from .job_engine import JobEngine
+from ..common import scheduler
 from ..models import db, COMMAND_STATUSES
+from .. import settings
 
 
 class DBJob(BCMDb):
     """
     DB Abstraction class for uniform interaction with DB Table 'jobs'
     """
-    def __init__(self, db_id=None, name=None, comment=None):
+    dbtable = 'jobs'
+    # scheduler task name of a job shard, registered in tasks.py
+    SHARD_TASK = "bcm_job_shard"
+    # job 'devices' and 'results' DB ids, stored in link tables 'job_devices' and 'job_results'
+    devices = LinkList('job_devices')
+    results = LinkList('job_results')
+    
+    def __init__(self, db_id=None, name=None, comment=None, max_workers=None):
         """
         Standard constructor class
         """
@@ -31,6 +40,8 @@ class DBJob(BCMDb):
             self.load_by_id()
         # credentials should not be stored in DB, only used at runtime
         self.runtime = None
+        # number of devices polled at once, defaults to settings.JOB_MAX_WORKERS
+        self.max_workers = max_workers
     
     def load_by_id(self, db_rec=None, db_id=None):
         """
@@ -51,9 +62,10 @@ class DBJob(BCMDb):
             db_rec = db(db.jobs.id == rec_id).select().first()    
         if not db_rec:
             raise TypeError(self.__class__.__name__, f"Expecting record received {type(db_rec)}")
+        self.db_id = db_rec.id
         self.name = db_rec.name
-        self.devices = db_rec.devices
-        self.results = db_rec.results
+        self.devices = None  # loaded from 'job_devices' on first access
+        self.results = None  # loaded from 'job_results' on first access
         self.started_at = db_rec.started_at
         self.completed_at = db_rec.completed_at
         self.status = db_rec.status
@@ -95,44 +107,39 @@ class DBJob(BCMDb):
         if not self.name:
             logging.warning("No 'jobs' name provided for 'save' method")
             return False
-        # create query to check whether 'jobs' name already exists
-        query = (db.jobs.name == self.name)
-        if db(query).count() > 0:
+        # insert unless the 'jobs' name already exists
+        db_rec = self.upsert(db.jobs, keys=('name',), fields=dict(name=self.name,
+            started_at=self.started_at, completed_at=self.completed_at, status=self.status,
+            comment=self.comment))
+        if not db_rec:
             logging.warning(f"Duplicate 'jobs' name {self.name} use 'update' method")
             return False
-        else:
-            db.jobs.insert(name=self.name, devices=self.devices, results=self.results,
-                started_at=self.started_at, completed_at=self.completed_at,
-                status=self.status, comment=self.comment)
-            db.commit()
-            db_rec = db(query).select().first()
-            if db_rec:
-                self.db_id = db_rec.id
-                self.db_created = True
-                logging.warning(f"New record created in table 'jobs' id={self.db_id}")
-                return True
+        self.db_id = db_rec[0]
+        self.save_links(created=True)
+        self.commit()
+        self.db_created = True
+        logging.warning(f"New record created in table 'jobs' id={self.db_id}")
+        return True
     
     def update(self):
         """
-        Update a job to DB - updater method
+        Update a job to DB - updater method, one upsert on the natural key 'name'
         ---
         :return True or False: based on whether the 'job is updated
         """
-        if db(db.jobs.id == self.db_id).count() == 0:
-            return self.save()
-        else:
-            db_rec = db(db.jobs.id == self.db_id).select().first()
-            if not self.is_record_modified(db_rec=db_rec):
-                logging.warning(f"No changes to save for id={self.db_id}")
-                return False
-            query = (db.jobs.id == self.db_id) & (db.jobs.name == self.name)
-            query &= (db.jobs.devices == self.devices) & (db.jobs.started_at == self.started_at)
-            db.jobs.update_or_insert(query,
-                results=self.results, completed_at=self.completed_at,
-                status=self.status, comment=self.comment)
-            db.commit()
-            logging.warning(f"Updated record in table 'jobs' id={self.db_id}, name={self.name}")
+        modifiable = ['completed_at', 'status', 'comment']
+        db_rec = self.upsert(db.jobs, keys=('name',), fields=dict(name=self.name,
+            started_at=self.started_at, completed_at=self.completed_at, status=self.status,
+            comment=self.comment), update=modifiable, compare=modifiable)
+        if db_rec:
+            self.db_id = db_rec[0]
+        link_updates = self.save_links()
+        self.commit()
+        if not db_rec and not link_updates:
+            logging.warning(f"No changes to save for id={self.db_id}")
             return False
+        logging.warning(f"Updated record in table 'jobs' id={self.db_id}, name={self.name}")
+        return True
     
     def is_record_modified(self, db_rec=None, db_id=None):
         """
@@ -154,7 +161,7 @@ class DBJob(BCMDb):
         elif db_rec and not isinstance(db_rec, Row):
             raise TypeError(self.__class__.__name__, f"Invalid type expecting Row received {type(db_rec)}")
         if (
-            self.results != db_rec.results or
+            set(self.results) != set(DBJob.results.select(db_rec.id).get(db_rec.id, list())) or
             self.completed_at != db_rec.completed_at or
             self.status != db_rec.status or
             self.comment != db_rec.comment
@@ -164,23 +171,152 @@ class DBJob(BCMDb):
         logging.warning("Unknown Error 'jobs:is_record_modified', more information/debugging required")
         return False
     
-    def run(self):
+    def get_device_auth(self, device):
+        """
+        Return the runtime credentials to use for a device, the job runtime account unless
+        settings.DEVICE_AUTH sets credentials for the device. Called from the job workers,
+        the job runtime account is not changed
+        ---
+        :param device: 'devices' DB id
+        :type device: int
+        :return auth: (username, password) or None
+        :rtype auth: tuple
+        """
+        auth = settings.DEVICE_AUTH.get(device)
+        if auth:
+            return tuple(auth)
+        if not self.runtime:
+            return None
+        return self.runtime.get('auth')
+    
+    def run(self, max_workers=None):
+        """
+        Run the job commands on all job devices concurrently using a 'JobEngine'
+        ---
+        :param max_workers: override the number of devices polled at once for this run
+        :type max_workers: int
+        """
         self.update_status(status="Running")
-        for device in self.devices:
-            j_np = NetworkPoller(device_id=device, job_id=self.db_id)
-            j_np.load_device_commands()
-            if device == 4:
-                self.set_runtime_account(credentials=('admin', 'C1sco12345'))
-            elif device == 5:
-                self.set_runtime_account(credentials=('admin', 'Admin_1234!'))
-            #print(device)
-            j_np.run_device_commands(auth=self.runtime.get('auth'))
-            j_np.save_results()
-            self.results.extend(list(j_np.results))
+        engine = JobEngine(job=self, max_workers=max_workers or self.max_workers,
+            progress=self.save_progress)
+        results = engine.run()
+        saved = set(self.results)
+        self.results.extend([result for result in results if result not in saved])
         self.completed_at = DBJob.get_timestamp()
         self.update_status(status="Completed")
         self.update()
     
+    def save_progress(self, results):
+        """Add the 'results' DB ids saved so far to the running job, JobEngine progress callback"""
+        saved = set(self.results)
+        self.results.extend([result for result in results if result not in saved])
+        if self.db_id:
+            self.update()
+    
+    def shard_prefix(self):
+        """Return the 'task_run' description prefix of the job shards"""
+        return f"job:{self.db_id}:shard:"
+    
+    def run_sharded(self, shard_size=None, max_workers=None):
+        """
+        Split the job devices into shards and enqueue each shard as a scheduler 'task_run'
+        Any py4web process or host sharing the DB with USE_SCHEDULER set runs the shards,
+        the job status and results are reassembled by the periodic collector task once the
+        scheduler recorded every shard as finished (see collect_running())
+        ---
+        :param shard_size: number of devices per shard (default settings.JOB_SHARD_SIZE)
+        :type shard_size: int
+        :return runs: list of 'task_run' DB ids
+        :rtype runs: list
+        """
+        if not scheduler:
+            logging.warning("Scheduler not enabled (settings.USE_SCHEDULER), running job in process")
+            self.run(max_workers=max_workers)
+            return list()
+        if not self.db_id:
+            raise ValueError(self.__class__.__name__, "Job must be saved before it is sharded")
+        shard_size = shard_size if shard_size else settings.JOB_SHARD_SIZE
+        self.update_status(status="Running")
+        self.update()
+        starts = list(range(0, len(self.devices), shard_size))
+        runs = list()
+        for shard, idx in enumerate(starts):
+            runs.append(scheduler.enqueue_run(DBJob.SHARD_TASK,
+                description=f"{self.shard_prefix()}{shard}",
+                inputs=dict(job_id=self.db_id, devices=self.devices[idx:idx + shard_size],
+                    shard=shard, shards=len(starts), max_workers=max_workers),
+                timeout=settings.JOB_SHARD_TIMEOUT))
+        logging.warning(f"Enqueued {len(runs)} shards for job id={self.db_id}")
+        return runs
+    
+    def run_shard(self, devices, shard, max_workers=None):
+        """
+        Run the job commands on a shard of the job devices, called by the scheduler task
+        The job is not updated here, a shard cannot see the other shards finish
+        ---
+        :return output: shard 'results' DB ids and failed devices
+        :rtype output: dict
+        """
+        engine = JobEngine(job=self, devices=devices, max_workers=max_workers or self.max_workers)
+        return dict(results=engine.run(), failed=engine.failed)
+    
+    def shard_runs(self):
+        """
+        Return the 'task_run' records of the shards of the latest sharded run of the job,
+        the shards of earlier runs (queued before the latest shard 0) are ignored
+        """
+        prefix = self.shard_prefix()
+        first = db(db.task_run.description == f"{prefix}0").select(db.task_run.id,
+            orderby=~db.task_run.id, limitby=(0, 1)).first()
+        if not first:
+            return list()
+        query = db.task_run.description.startswith(prefix) & (db.task_run.id >= first.id)
+        return db(query).select(orderby=db.task_run.id)
+    
+    def collect_shards(self):
+        """
+        Reassemble the job status and results from the 'task_run' records of the shards of
+        the latest run, the job is only updated once every shard is recorded as finished
+        ---
+        :return True or False: based on whether all shards are finished and the job is updated
+        """
+        if 'task_run' not in db.tables:
+            return False
+        runs = self.shard_runs()
+        if not runs or len(runs) < runs.first().inputs.get('shards', len(runs)):
+            # not all the shards of the run are enqueued yet
+            return False
+        results = list()
+        failed = False
+        for run in runs:
+            if run.status in ("queued", "assigned", "running"):
+                return False
+            if run.status != "completed" or not run.output:
+                failed = True
+                continue
+            results.extend(run.output.get("results", list()))
+        self.results = sorted(set(results))
+        self.completed_at = DBJob.get_timestamp()
+        self.update_status(status="Failed" if failed else "Completed")
+        self.update()
+        return True
+    
+    @staticmethod
+    def collect_running():
+        """
+        Finalise the running sharded jobs whose shards have all finished, called by the
+        periodic collector task after the scheduler recorded the shards
+        ---
+        :return collected: DB ids of the jobs updated
+        :rtype collected: list
+        """
+        collected = list()
+        for db_rec in db(db.jobs.status == "Running").select(db.jobs.id):
+            job = DBJob(db_id=db_rec.id)
+            if job.collect_shards():
+                collected.append(job.db_id)
+        return collected
+    
     def from_json(self, json_data):
         """
         Method to load a jobs object from a json data set.
@@ -227,21 +363,18 @@ class DBJobs():
     
     @staticmethod
     def get_jobs(db_ids=None):
-        if not db_ids:
-            jobs = db(db.jobs).select()
-        else:
-            if isinstance(db_ids, list):
-                for db_id in db_ids:
-                    idx = 0
-                    while idx < len(db_ids):
-                        if idx == 0:
-                            query = (db.jobs.id == db_id)
-                        else:
-                            query |= (db.jobs.id == db_id)
-                        idx += 1
-                jobs = db(query).select()
-        jobs_list = []
-        for job in jobs:
-            j = DBJob(db_id=job.id)
-            jobs_list.append(j.to_json())
-        return jobs_list
+        """
+        Return 'jobs' in dict format, one query per BELONGS_CHUNK_SIZE records
+        ---
+        :param db_ids: DB ids of the 'jobs', None or empty for all 'jobs'
+        :type db_ids: list
+        :return jobs_list: list of 'jobs' in dict format
+        :rtype jobs_list: list
+        """
+        return list(DBJobs.iter_jobs(db_ids=db_ids))
+    
+    @staticmethod
+    def iter_jobs(db_ids=None):
+        """Yield 'jobs' in dict format, streaming the records a chunk at a time"""
+        for job in DBJob.load_many(db_ids=db_ids):
+            yield job.to_json()
@@ -2,61 +2,232 @@
 
 import logging
 #from datetime import datetime
+import asyncio
 import json
+import time
 
 #from ..models import db
 #from .bcm_db import BCMDb
 from .devices import DBDevice
 from .commands import DBCommand
-from .results import DBResult
-from .device_connector import NetConnect
+from .results import DBResults
+from .device_connector import NetConnect, AsyncNetConnect
+from .session_pool import session_pool
+from .parse_pool import parse_pool
+from .device_health import device_health
+from .rate_limiter import login_limiter
+from .. import settings
 
 
 class NetworkPoller():
     """
     Abstraction class for uniform interaction with network devices
     """
-    def __init__(self, device_id, job_id):
+    def __init__(self, device_id, job_id, port=None):
+        """
+        Standard constructor class
+        ---
+        :param port: SSH port of the device, default settings.DEVICE_SSH_PORT
+        :type port: int
+        """
         self.device = DBDevice(db_id=device_id)
         self.job = job_id
+        self.port = port if port else settings.DEVICE_SSH_PORT
         self.commands = None
         self.response = dict()
         self.results = None
+        self.pool = session_pool if settings.SESSION_POOL_ENABLED else None
+        self.batch = settings.POLLER_BATCH_COMMANDS
+        self.parser = parse_pool if settings.PARSE_POOL_ENABLED else None
+        self.pending = list()
+        self.health = device_health if settings.HEALTH_ENABLED else None
+        self.limiter = login_limiter if settings.LOGIN_RATE_ENABLED else None
+        # 'ResultSink' set by the job engine to stream results instead of collecting them
+        self.sink = None
     
-    def run_device_commands(self, auth=None):
-        d = NetConnect(host=self.device.mgmt_ip, vendor=self.device.vendor)
+    def set_connection(self, auth=None, connector=NetConnect):
+        """Create a 'connector' object for the device with the runtime credentials"""
+        d = connector(host=self.device.mgmt_ip, vendor=self.device.vendor)
         d.set_username(username=auth[0])
         d.set_password(password=auth[1])
         d.set_host_os(os=self.device.os)
-        if not self.commands:
-            self.load_device_commands()
+        d.port = self.port
         if not d.device_type:
             d.set_netmiko_device_type(vendor=self.device.vendor)
+        return d
+    
+    def add_response(self, cmd_id, res, result_time=None, error=None, raw=None):
+        """
+        Add the response of a device command to self.response, or put it in self.sink
+        ---
+        :param error: the parse error of the command output, the result is saved 'Failed'
+            with the error and the raw output
+        :type error: Exception
+        :param raw: the unparsed command output, saved with a parse error
+        :type raw: str
+        """
+        response = {"device": self.device.db_id, "command": cmd_id, "job": self.job}
+        result = json.dumps(res)
+        if not result_time:
+            result_time = self.device.get_timestamp()
+        response.update({"completed_at": result_time})
+        comment = None
+        if error is not None:
+            result = json.dumps({"Failure": self.commands[cmd_id], "error": str(error), "output": raw})
+            result_status = 'Failed'
+            comment = f"Failed @{result_time}: unable to parse output, {error}"
+        elif result:
+            result_status = 'Success'
+        else:
+            result = {"Failure" : self.commands[cmd_id]}
+            result_status = result
+        response.update({"status": f"{result_status}",
+            "result": result, "comment": comment if comment else f"{result_status} @{result_time}"
+        })
+        if self.sink:
+            self.sink.put(response)
+        else:
+            self.response.update({f"{self.device.db_id}:{cmd_id}": response})
+    
+    def queue_response(self, cmd_id, raw, device_type=None):
+        """
+        Queue the raw response of a device command for the parse pool
+        The parsed response is added to self.response by collect_responses(),
+        or put in self.sink by the poller thread with stream_responses() when streaming
+        """
+        use_textfsm = self.device.os == 'ios'
+        result_time = self.device.get_timestamp()
+        future = self.parser.submit(raw, device_type=device_type, command=self.commands[cmd_id],
+            use_json=not use_textfsm, use_textfsm=use_textfsm)
+        self.pending.append((cmd_id, result_time, future, raw))
+    
+    def stream_responses(self, wait=False):
+        """
+        Put the parsed responses in self.sink, from the poller thread so a full sink blocks
+        the poller and never the parse pool
+        ---
+        :param wait: wait for all queued responses to be parsed, else put only the parsed ones
+        :type wait: bool
+        """
+        pending, self.pending = self.pending, list()
+        for cmd_id, result_time, future, raw in pending:
+            if wait or future.done():
+                self.add_parsed_response(cmd_id, result_time, future, raw=raw)
+            else:
+                self.pending.append((cmd_id, result_time, future, raw))
+    
+    def collect_responses(self):
+        """Wait for the queued responses to be parsed and add them to self.response"""
+        pending, self.pending = self.pending, list()
+        for cmd_id, result_time, future, raw in pending:
+            self.add_parsed_response(cmd_id, result_time, future, raw=raw)
+    
+    def add_parsed_response(self, cmd_id, result_time, future, raw=None):
+        """Add the response of a parse pool future, a parse error is added as a 'Failed' result"""
+        try:
+            res = future.result()
+        except Exception as parse_error:
+            logging.warning(f"{self.__class__.__name__}, Unable to parse response for "
+                            f"device id={self.device.db_id} command id={cmd_id}: {parse_error}")
+            self.add_response(cmd_id, None, result_time=result_time, error=parse_error, raw=raw)
+            return
+        self.add_response(cmd_id, res, result_time=result_time)
+    
+    def is_device_available(self):
+        """Check the device circuit breaker, devices failing to connect are skipped until cool-down"""
+        if self.health and not self.health.allow(self.device.db_id):
+            logging.warning(f"{self.__class__.__name__}, Skipping device id={self.device.db_id} "
+                            "after repeated connect failures")
+            return False
+        return True
+    
+    def record_connect(self, d, started):
+        """Record the connect outcome and latency in the device health"""
+        if not self.health:
+            return
+        if d.is_connected:
+            self.health.record_success(self.device.db_id, time.monotonic() - started)
+        else:
+            self.health.record_failure(self.device.db_id)
+    
+    def open_session(self, auth=None):
+        """Create a device connection and connect to the device"""
+        d = self.set_connection(auth=auth)
+        if self.health:
+            d.timeout = self.health.connect_timeout(self.device.db_id)
+        if self.limiter:
+            self.limiter.acquire(self.device.region, self.device.site_code)
+        started = time.monotonic()
         d.connect_to_device()
-        if not d.is_connected:
+        self.record_connect(d, started)
+        return d
+    
+    def run_device_commands(self, auth=None):
+        if not self.commands:
+            self.load_device_commands()
+        if not self.is_device_available():
+            return False
+        try:
+            polled = self.run_device_session(auth=auth)
+            if polled and self.sink:
+                # the session is released, wait for the parse pool on this thread
+                self.stream_responses(wait=True)
+            return polled
+        finally:
+            # a trial connect without a recorded outcome must not block the device
+            if self.health:
+                self.health.end_trial(self.device.db_id)
+    
+    def run_device_session(self, auth=None):
+        """Open (or re-use) a device session and run the device commands"""
+        # sessions are pooled by device and account, never shared between credentials
+        key = self.pool.key(self.device.db_id, auth) if self.pool else None
+        if self.pool:
+            d = self.pool.acquire(key, connect=lambda: self.open_session(auth=auth))
+        else:
+            d = self.open_session(auth=auth)
+        if not d or not d.is_connected:
+            if d and self.pool:
+                self.pool.release(key, d)
             return False
+        try:
+            if self.batch and len(self.commands) > 1:
+                self.run_device_commands_batch(d)
+            else:
+                for cmd_id in self.commands.keys():
+                    if self.parser:
+                        if self.device.os == 'ios':
+                            raw = d.send_op_command(self.commands[cmd_id])
+                        else:
+                            raw = d.send_op_command_json(self.commands[cmd_id], raw=True)
+                        self.queue_response(cmd_id, raw, device_type=d.device_type)
+                        if self.sink:
+                            self.stream_responses()
+                    elif self.device.os == 'ios':
+                        self.add_response(cmd_id, d.send_op_command(self.commands[cmd_id], use_textfsm=True))
+                    else:
+                        self.add_response(cmd_id, d.send_op_command_json(self.commands[cmd_id]))
+        finally:
+            if self.pool:
+                self.pool.release(key, d)
+            else:
+                d.disconnect()
+        return True
+    
+    def run_device_commands_batch(self, d):
+        """Send all device commands in one pipelined exchange and split the responses by command"""
+        cmd_ids = list(self.commands.keys())
+        cmds = [self.commands[cmd_id] for cmd_id in cmd_ids]
+        raw = bool(self.parser)
+        if self.device.os == 'ios':
+            responses = d.send_op_commands_batch(cmds, use_textfsm=True, raw=raw)
         else:
-            for cmd_id in self.commands.keys():
-                cmd_ref = f"{self.device.db_id}:{cmd_id}"
-                self.response.update({cmd_ref: {
-                    "device": self.device.db_id, "command": cmd_id, "job": self.job
-                }})
-                if self.device.os == 'ios':
-                    res = d.send_op_command(self.commands[cmd_id], use_textfsm=True)
-                    result = json.dumps(res)
-                else:
-                    res = d.send_op_command_json(self.commands[cmd_id])
-                    result = json.dumps(res)
-                result_time = self.device.get_timestamp()
-                self.response[cmd_ref].update({"completed_at": result_time})
-                if result:
-                    result_status = 'Success'
-                else:
-                    result = {"Failure" : self.commands[cmd_id]}
-                    result_status = result
-                self.response[cmd_ref].update({"status": f"{result_status}",
-                    "result": result, "comment": f"{result_status} @{result_time}"
-                })
+            responses = d.send_op_commands_batch(cmds, use_json=True, raw=raw)
+        for cmd_id, res in zip(cmd_ids, responses):
+            if raw:
+                self.queue_response(cmd_id, res, device_type=d.device_type)
+            else:
+                self.add_response(cmd_id, res)
     
     def load_device_commands(self, all=True, subset=None):
         """
@@ -80,10 +251,55 @@ class NetworkPoller():
     def save_results(self):
         """
         """
+        if self.pending:
+            self.collect_responses()
         if self.response:
-            self.results = list()
-            for result in self.response.keys():
-                r = DBResult()
-                r.from_json(json_data=self.response[result])
-                r.save()
-                self.results.append(r.db_id)
+            self.results = DBResults.save_results(list(self.response.values()))
+
+
+class AsyncNetworkPoller(NetworkPoller):
+    """
+    asyncio abstraction class for uniform interaction with network devices
+    Device and command loading stay synchronous (DB access), only the device session is async
+    """
+    async def run_device_commands(self, auth=None):
+        d = self.set_connection(auth=auth, connector=AsyncNetConnect)
+        if not self.commands:
+            self.load_device_commands()
+        if not self.is_device_available():
+            return False
+        try:
+            if self.health:
+                d.timeout = self.health.connect_timeout(self.device.db_id)
+            if self.limiter:
+                await asyncio.sleep(self.limiter.reserve(self.device.region, self.device.site_code))
+            started = time.monotonic()
+            await d.connect_to_device()
+            self.record_connect(d, started)
+        finally:
+            # a trial connect without a recorded outcome must not block the device
+            if self.health:
+                self.health.end_trial(self.device.db_id)
+        if not d.is_connected:
+            return False
+        try:
+            for cmd_id in self.commands.keys():
+                if self.parser:
+                    if self.device.os == 'ios':
+                        raw = await d.send_op_command(self.commands[cmd_id])
+                    else:
+                        raw = await d.send_op_command_json(self.commands[cmd_id], raw=True)
+                    self.queue_response(cmd_id, raw, device_type=d.device_type)
+                    if self.sink:
+                        self.stream_responses()
+                elif self.device.os == 'ios':
+                    self.add_response(cmd_id, await d.send_op_command(self.commands[cmd_id], use_textfsm=True))
+                else:
+                    self.add_response(cmd_id, await d.send_op_command_json(self.commands[cmd_id]))
+        finally:
+            await d.disconnect()
+        if self.sink and self.pending:
+            # wait for the parse pool without blocking the event loop
+            await asyncio.wait([asyncio.wrap_future(future) for _, _, future, _ in self.pending])
+            self.stream_responses(wait=True)
+        return True
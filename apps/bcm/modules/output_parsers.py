@@ -6,6 +6,7 @@ from pydal.objects import Row
 
 from ..models import db
 from .bcm_db import BCMDb
+from .catalog_cache import catalog_cache
 #from .commands import DBCommand
 
 
@@ -13,6 +14,8 @@ class DBParser(BCMDb):
     """
     DB Abstraction class for uniform interaction with DB Table 'output_parsers'
     """
+    dbtable = 'output_parsers'
+    
     def __init__(self, db_id=None):
         """
         Standard constructor class
@@ -48,7 +51,7 @@ class DBParser(BCMDb):
                 rec_id = db_id
             if not rec_id:
                 raise ValueError(self.__class__.__name__, "Invalid or missing record id")
-            db_rec = db(db.output_parsers.id == rec_id).select().first()    
+            db_rec = catalog_cache.get_record('output_parsers', rec_id)
         if not db_rec:
             raise TypeError(self.__class__.__name__, f"Expecting record received {type(db_rec)}")
         self.db_id = db_rec.id
@@ -97,54 +100,50 @@ class DBParser(BCMDb):
     
     def save(self):
         """
-        Save a record to DB - creator/updater method
+        Save a record to DB - creator/updater method, one upsert on the natural key
+        'vendor', 'command', 'device_os' & 'is_json'
         Must set the class db_id to the new DB id
         ---
-        :return True or False: based on whether a new record is created or not
-        """
-        # query to check whether record exists as 'vendor, 'command', 'os' & 'is_json'
+        :return True or False: based on whether a record is created/updated or not
+        """
+        timestamp = DBParser.get_timestamp()
+        fields = dict(vendor=self.vendor, command=self.command,
+            device_os=self.device_os, is_json=self.is_json,
+            parser_path=self.parser_path, main_keys=self.main_keys,
+            ignore_keys=self.ignore_keys, name=self.name,
+            created_at=timestamp, modified_on=timestamp)
+        modifiable = ['parser_path', 'main_keys', 'ignore_keys', 'name']
         query = (db.output_parsers.vendor == self.vendor) & (
             db.output_parsers.command == self.command)
         query &= (db.output_parsers.device_os == self.device_os) & (
             db.output_parsers.is_json == self.is_json)
-        if db(query).count() == 0:
-            # create query to check for duplicates of unique fields before save
-            is_unique = (db.output_parsers.name == self.name)
-            if db(is_unique).count() > 0:
-                logging.warning(f"Duplicate value in 'output_parsers' for name={self.name}")
-                return False
-            self.created_at = DBParser.get_timestamp()
-            self.modified_on = self.created_at
-            db.output_parsers.insert(vendor=self.vendor, command=self.command,
-                device_os=self.device_os, is_json=self.is_json,
-                parser_path=self.parser_path, main_keys=self.main_keys,
-                ignore_keys=self.ignore_keys, name=self.name,
-                created_at=self.created_at, modified_on=self.modified_on)
-            db.commit()
-            db_rec = db(query).select().first()
+        try:
+            # the record is read first, created or updated is not known from the upsert
+            existing = db(query).select(db.output_parsers.id).first()
+            db_rec = self.upsert(db.output_parsers, keys=('vendor', 'command', 'device_os', 'is_json'),
+                fields=fields, update=modifiable + ['modified_on'], compare=modifiable,
+                returning=('id', 'created_at'))
             if db_rec:
-                self.db_id = db_rec.id
+                self.commit()
+        except Exception as save_error:
+            # the parser 'name' must be unique
+            self.rollback()
+            logging.warning(f"Duplicate value in 'output_parsers' for name={self.name}: {save_error}")
+            return False
+        if db_rec:
+            self.db_id = db_rec[0]
+            self.modified_on = timestamp
+            if existing is None:
+                self.created_at = timestamp
                 self.db_created = True
                 logging.warning(f"New record created in table 'output_parsers' id={self.db_id}")
-                return True
-        elif db(query).count() > 0:
-            db_rec = db(query).select().first()
-            self.db_id = db_rec.id
-            if not self.is_record_modified(db_rec=db_rec):
-                logging.warning(f"No changes to save for id={self.db_id}")
-                return False
-            self.modified_on = DBParser.get_timestamp()
-            db.output_parsers.update_or_insert(query,
-                vendor=self.vendor, command=self.command, device_os=self.device_os,
-                is_json=self.is_json, parser_path=self.parser_path,
-                main_keys=self.main_keys, ignore_keys=self.ignore_keys,
-                name=self.name, modified_on=self.modified_on)
-            db.commit()
-            logging.warning(f"Updated record in table 'output_parsers' with id={self.db_id}")
+            else:
+                self.created_at = db_rec[1]
+                logging.warning(f"Updated record in table 'output_parsers' with id={self.db_id}")
             return True
-        # catch-all error
-        logging.warning("Unknown Error, more information/debugging required")
-        db.rollback()
+        if existing:
+            self.db_id = existing.id
+        logging.warning(f"No changes to save for id={self.db_id}")
         return False
     
     def is_record_modified(self, db_rec=None, db_id=None):
@@ -193,12 +192,12 @@ class DBParser(BCMDb):
             db_rec = db(db.output_parsers.id == rec_id).select().first()
         if not db_rec or (db_rec and not isinstance(db_rec, Row)):
             raise TypeError(self.__class__.__name__, f"Invalid type expecting Row received {type(db_rec)}")
-        if db(db.commands.output_parsers.contains(db_rec.id)).count() > 0:
+        if db(db.command_parsers.output_parser == db_rec.id).count() > 0:
             logging.warning(f"Unable to delete 'output_parsers' id={db_rec.id} while used "
                             "as an 'output_parsers' by a command in 'commands'")
-        elif db(db.commands.output_parsers.contains(db_rec.id)).count() == 0:
-            db(db.devices.id == db_rec.id).delete()
-            db.commit()
+        elif db(db.command_parsers.output_parser == db_rec.id).count() == 0:
+            db(db.output_parsers.id == db_rec.id).delete()
+            self.commit()
             logging.warning(f"Record id={db_rec.id} deleted from table 'output_parsers'")
             self.db_id = None
             self.db_loaded = False
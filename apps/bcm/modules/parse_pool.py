@@ -0,0 +1,76 @@
+# coding: utf-8
+
+import json
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from netmiko.utilities import get_structured_data
+
+from .. import settings
+
+
+def parse_output(raw, device_type=None, command=None, use_json=False, use_textfsm=False):
+    """
+    Parse raw device output, run in the parse pool worker processes
+    ---
+    :param raw: raw command output
+    :type raw: str
+    :param device_type: netmiko device_type used to select the TextFSM template
+    :type device_type: str
+    :return: json (dict) output, TextFSM output (list) or the raw output when no parser applies
+    """
+    if not raw or not isinstance(raw, str):
+        return raw
+    if use_json:
+        return json.loads(raw)
+    if use_textfsm:
+        return get_structured_data(raw, platform=device_type, command=command)
+    return raw
+
+
+class ParsePool():
+    """
+    Process pool for CPU-bound parsing (TextFSM, json decode) of raw device output
+    Keeps parsing off the threads/event loop holding the SSH sessions, the worker
+    processes are started on first use
+    """
+    def __init__(self, max_workers=None):
+        """
+        Standard constructor class
+        ---
+        :param max_workers: number of parser processes, None uses the number of CPUs
+        :type max_workers: int
+        """
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """Start the parser processes, forked processes inherit the open files/sockets at start"""
+        with self.lock:
+            if not self.executor:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                self.executor.submit(parse_output, None).result()
+    
+    def submit(self, raw, device_type=None, command=None, use_json=False, use_textfsm=False):
+        """
+        Queue raw output for parsing
+        ---
+        :return future: concurrent.futures.Future resolving to the parsed output
+        """
+        self.start()
+        return self.executor.submit(parse_output, raw, device_type=device_type,
+            command=command, use_json=use_json, use_textfsm=use_textfsm)
+    
+    def shutdown(self):
+        """Stop the parser processes"""
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+                logging.warning(f"{self.__class__.__name__}, Parser processes stopped")
+
+
+# shared by all pollers in the process
+parse_pool = ParsePool(max_workers=settings.PARSE_POOL_MAX_WORKERS)
@@ -0,0 +1,387 @@
+# coding: utf-8
+
+import logging
+from datetime import datetime
+
+from .. import settings
+from ..models import db, INDEXES, define_partition, migrate_indexes
+from .bcm_db import BCMDb, BELONGS_CHUNK_SIZE
+from .result_blobs import result_blobs
+
+"""
+>>> from apps.bcm.modules.partitions import result_partitions
+>>> result_partitions.archive()
+1520
+>>> [table._tablename for table in result_partitions.tables(since="2024-08-01 00:00:00")]
+['results_202408', 'results_202409', 'results']
+"""
+
+
+def month_start(timestamp, months=0):
+    """Return the start of the month of a timestamp, moved by a number of months"""
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+    month = timestamp.year * 12 + timestamp.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+class ResultPartitions():
+    """
+    Time partitioning of DB Table 'results' in monthly archive partitions 'results_YYYYMM'
+    'results' is the hot partition, new results are always written to 'results' so the DB ids
+    stay unique across the partitions, archive() moves the results older than the hot months
+    to their monthly partition (same fields, indexes and DB ids) and drops the partitions
+    older than the retention months. Recent results are read from 'results' only, reads of
+    a DB id or of a time range are routed to the partitions holding them (see DBResult)
+    """
+    # maximum number of results moved by one statement (one transaction)
+    ARCHIVE_CHUNK_SIZE = 10000
+
+    def __init__(self, hot_months=None, retention_months=None):
+        """
+        Standard constructor class
+        ---
+        :param hot_months: months of results kept in 'results', current month included
+        :type hot_months: int
+        :param retention_months: months of results kept, None keeps all results
+        :type retention_months: int
+        """
+        self.hot_months = max(1, hot_months) if hot_months else 1
+        self.retention_months = retention_months
+
+    @staticmethod
+    def partition_name(starts_at):
+        """Return the partition name of the month starting at starts_at"""
+        return f"results_{starts_at.strftime('%Y%m')}"
+
+    def hot_starts_at(self, now=None):
+        """Return the start of the hot partition, older results are archived"""
+        return month_start(now if now else datetime.now(), months=1 - self.hot_months)
+
+    def retention_starts_at(self, now=None):
+        """Return the start of the retention window, older results are dropped, None keeps all"""
+        if not self.retention_months:
+            return None
+        return month_start(now if now else datetime.now(), months=1 - max(self.retention_months, self.hot_months))
+
+    def get_partitions(self, since=None, until=None):
+        """Return the 'result_partitions' records, newest first, overlapping since-until"""
+        query = (db.result_partitions.id > 0)
+        if since:
+            query &= (db.result_partitions.ends_at > since)
+        if until:
+            query &= (db.result_partitions.starts_at <= until)
+        return db(query).select(orderby=~db.result_partitions.starts_at)
+
+    def tables(self, since=None, until=None, newest_first=False):
+        """
+        Return 'results' and the archive partitions holding results completed from since until
+        ---
+        :param newest_first: order 'results' then the partitions newest first, default oldest first
+        :type newest_first: bool
+        :return tables: list of pydal Table
+        :rtype tables: list
+        """
+        tables = [db.results]
+        tables.extend(define_partition(partition.name) for partition in self.get_partitions(since, until))
+        return tables if newest_first else tables[::-1]
+
+    def get_partition(self, completed_at):
+        """Return the archive partition table of a completion time, None if not archived"""
+        query = (db.result_partitions.starts_at <= completed_at) & (db.result_partitions.ends_at > completed_at)
+        partition = db(query).select(db.result_partitions.name).first()
+        return define_partition(partition.name) if partition else None
+
+    def route_ids(self, db_ids):
+        """Return the (partition table, DB ids) of the archive partitions holding DB ids"""
+        routes = list()
+        db_ids = set(db_ids)
+        for partition in self.get_partitions():
+            if not db_ids or partition.min_id is None:
+                continue
+            ids = sorted(db_id for db_id in db_ids if partition.min_id <= db_id <= partition.max_id)
+            if ids:
+                routes.append((define_partition(partition.name), ids))
+        return routes
+
+    def find(self, db_id):
+        """Return the archived 'results' record of a DB id, None if not archived"""
+        for table, ids in self.route_ids([db_id]):
+            db_rec = db(table.id == db_id).select().first()
+            if db_rec:
+                return db_rec
+        return None
+
+    def select(self, query, since=None, until=None):
+        """
+        Select results from 'results' and the archive partitions, oldest partition first
+        ---
+        :param query: function returning the query of a partition table, e.g. lambda t: t.device == 4
+        :type query: callable
+        :param since/until: completion time range, limits the partitions read
+        :type since/until: str or datetime
+        :return records: list of 'results' records (Row)
+        :rtype records: list
+        """
+        records = list()
+        for table in self.tables(since=since, until=until):
+            table_query = query(table)
+            if since:
+                table_query &= (table.completed_at >= since)
+            if until:
+                table_query &= (table.completed_at <= until)
+            records.extend(db(table_query).select(orderby=table.id))
+        return records
+
+    def select_latest(self, query, limit):
+        """Select the limit latest results, newest first, reading older partitions only if needed"""
+        records = list()
+        for table in self.tables(newest_first=True):
+            records.extend(db(query(table)).select(orderby=~table.completed_at,
+                limitby=(0, limit - len(records))))
+            if len(records) >= limit:
+                break
+        return records
+
+    @staticmethod
+    def select_ranked(table, devices, limit):
+        """
+        Select the limit latest results of each device from one table, newest first, in one
+        window function query, ROW_NUMBER() OVER (PARTITION BY device ORDER BY completed_at DESC)
+        DBs without window functions run one query per device
+        """
+        fields = [table[field] for field in table.fields]
+        if not BCMDb.has_window_functions():
+            records = list()
+            for device in devices:
+                records.extend(db(table.device == device).select(orderby=~table.completed_at | ~table.id,
+                    limitby=(0, limit)))
+            return records
+        rank = (f"ROW_NUMBER() OVER (PARTITION BY {table.device.sqlsafe} "
+                f"ORDER BY {table.completed_at.sqlsafe} DESC, {table.id.sqlsafe} DESC)")
+        sql = (f"SELECT {', '.join(field._rname for field in fields)} FROM ("
+               f"SELECT {', '.join(field.sqlsafe for field in fields)}, {rank} AS result_rank "
+               f"FROM {table._rname} WHERE {db._adapter.expand(table.device.belongs(devices))}"
+               f") ranked WHERE result_rank <= {int(limit)} ORDER BY device, result_rank;")
+        return db.executesql(sql, fields=fields)
+
+    def select_latest_by_device(self, devices, limit):
+        """
+        Select the limit latest results of each device, newest first, with one query per
+        BELONGS_CHUNK_SIZE devices (see select_ranked), the archive partitions are only read
+        for the devices with less than limit results in the newer tables
+        ---
+        :param devices: 'devices' DB ids
+        :type devices: list
+        :param limit: number of results per device
+        :type limit: int
+        :return latest: list of 'results' records (Row) newest first, by device DB id
+        :rtype latest: dict
+        """
+        latest = dict()
+        missing = sorted(set(devices))
+        for table in self.tables(newest_first=True):
+            missing = [device for device in missing if len(latest.get(device, list())) < limit]
+            if not missing:
+                break
+            for idx in range(0, len(missing), BELONGS_CHUNK_SIZE):
+                for record in ResultPartitions.select_ranked(table, missing[idx:idx + BELONGS_CHUNK_SIZE], limit):
+                    latest.setdefault(record.device, list()).append(record)
+        return {device: sorted(records, key=lambda record: (record.completed_at, record.id), reverse=True)[:limit]
+            for device, records in latest.items()}
+
+    def count_by_device(self, devices):
+        """Return the number of results of each device DB id in 'results' and the archive partitions"""
+        counts = dict()
+        devices = sorted(set(devices))
+        for table in self.tables():
+            count = table.id.count()
+            for idx in range(0, len(devices), BELONGS_CHUNK_SIZE):
+                rows = db(table.device.belongs(devices[idx:idx + BELONGS_CHUNK_SIZE])).select(table.device,
+                    count, groupby=table.device)
+                for row in rows:
+                    counts.update({row[table.device]: counts.get(row[table.device], 0) + row[count]})
+        return counts
+
+    def select_page(self, query, limit, after=None, before=None):
+        """
+        Select a page of results in (completed_at, id) order (keyset pagination), each table
+        is read from the page key with an index range of at most limit + 1 records and the
+        archive partitions are only read until the page is complete
+        ---
+        :param query: function returning the query of a partition table, e.g. lambda t: t.device == 4
+        :type query: callable
+        :param limit: page size
+        :type limit: int
+        :param after: (completed_at, id) key, the page of results following the key
+        :type after: tuple
+        :param before: (completed_at, id) key, the page of results preceding the key, default
+            the latest results when after is None too
+        :type before: tuple
+        :return (records, more): the page in (completed_at, id) order, True if more results follow
+            the page (after) or precede it (before)
+        :rtype (records, more): tuple
+        """
+        descending = after is None
+        key = after if after else before
+
+        def page_query(table):
+            table_query = query(table)
+            if key and descending:
+                table_query &= (table.completed_at <= key[0]) & ((table.completed_at < key[0]) | (table.id < key[1]))
+            elif key:
+                table_query &= (table.completed_at >= key[0]) & ((table.completed_at > key[0]) | (table.id > key[1]))
+            return table_query
+
+        orderby = lambda table: (~table.completed_at | ~table.id) if descending else (table.completed_at | table.id)
+        sort_key = lambda record: (record.completed_at, record.id)
+        # 'results' may hold results of an archived month (see DBResult.save), it is always read
+        records = list(db(page_query(db.results)).select(orderby=orderby(db.results), limitby=(0, limit + 1)))
+        partitions = self.get_partitions(since=key[0] if key and not descending else None,
+            until=key[0] if key and descending else None)
+        for partition in (partitions if descending else reversed(partitions)):
+            if len(records) > limit:
+                records.sort(key=sort_key, reverse=descending)
+                last = records[limit].completed_at
+                if (partition.ends_at <= last) if descending else (partition.starts_at > last):
+                    break
+            table = define_partition(partition.name)
+            records.extend(db(page_query(table)).select(orderby=orderby(table), limitby=(0, limit + 1)))
+        records.sort(key=sort_key, reverse=descending)
+        more = len(records) > limit
+        records = records[:limit]
+        return (records[::-1] if descending else records), more
+
+    def create(self, starts_at):
+        """Return the archive partition table of the month starting at starts_at, created if new"""
+        name = ResultPartitions.partition_name(starts_at)
+        if not db(db.result_partitions.name == name).count():
+            define_partition(name, create=True)
+            db.result_partitions.insert(name=name, starts_at=starts_at,
+                ends_at=month_start(starts_at, months=1), num_results=0)
+            db.commit()
+            migrate_indexes()
+            logging.warning(f"{self.__class__.__name__}, Created partition '{name}'")
+        return define_partition(name)
+
+    def unlink(self, subquery):
+        """Remove the job links and 'last_result' of results selected by subquery before removal"""
+        db(db.job_results.result.belongs(subquery)).delete()
+        for table in self.tables():
+            db(table.last_result.belongs(subquery)).update(last_result=None)
+
+    def archive_month(self, starts_at):
+        """
+        Move the results of the month starting at starts_at from 'results' to its partition,
+        ARCHIVE_CHUNK_SIZE results per transaction
+        ---
+        :return moved: number of results moved
+        :rtype moved: int
+        """
+        query = (db.results.completed_at >= starts_at) & (db.results.completed_at < month_start(starts_at, 1))
+        fields = [db.results[field] for field in db.results.fields]
+        columns = ", ".join(field._rname for field in fields)
+        moved = 0
+        while True:
+            ids = db(query).select(db.results.id, orderby=db.results.id,
+                limitby=(0, ResultPartitions.ARCHIVE_CHUNK_SIZE))
+            if not ids:
+                break
+            table = self.create(starts_at)
+            chunk = query & (db.results.id >= ids.first().id) & (db.results.id <= ids.last().id)
+            try:
+                db.executesql(f"INSERT INTO {table._rname} ({columns}) {db(chunk)._select(*fields)}")
+                db(chunk).delete()
+                partition = db(db.result_partitions.name == table._tablename).select().first()
+                partition.update_record(
+                    min_id=min(ids.first().id, partition.min_id or ids.first().id),
+                    max_id=max(ids.last().id, partition.max_id or ids.last().id),
+                    num_results=(partition.num_results or 0) + len(ids), archived_at=datetime.now())
+                db.commit()
+            except Exception as archive_error:
+                db.rollback()
+                logging.warning(f"{self.__class__.__name__}, Unable to archive results to "
+                                f"'{table._tablename}': {archive_error}")
+                break
+            moved += len(ids)
+        return moved
+
+    def expire(self, retention):
+        """
+        Delete the results of 'results' completed before retention, ARCHIVE_CHUNK_SIZE results
+        per transaction
+        ---
+        :return expired: number of results deleted
+        :rtype expired: int
+        """
+        query = (db.results.completed_at < retention)
+        expired = 0
+        while True:
+            ids = db(query).select(db.results.id, orderby=db.results.id,
+                limitby=(0, ResultPartitions.ARCHIVE_CHUNK_SIZE))
+            if not ids:
+                break
+            chunk = query & (db.results.id >= ids.first().id) & (db.results.id <= ids.last().id)
+            try:
+                self.unlink(db(chunk)._select(db.results.id))
+                expired += db(chunk).delete()
+                db.commit()
+            except Exception as expire_error:
+                db.rollback()
+                logging.warning(f"{self.__class__.__name__}, Unable to delete results older than "
+                                f"{retention}: {expire_error}")
+                break
+        if expired:
+            logging.warning(f"{self.__class__.__name__}, Deleted {expired} results older than {retention}")
+        return expired
+
+    def drop_expired(self, now=None):
+        """Drop the partitions older than the retention months, return the dropped partition names"""
+        retention = self.retention_starts_at(now)
+        if not retention:
+            return list()
+        dropped = list()
+        for partition in db(db.result_partitions.ends_at <= retention).select():
+            table = define_partition(partition.name)
+            self.unlink(db(table.id > 0)._select(table.id))
+            table.drop()
+            INDEXES.pop(partition.name, None)
+            partition.delete_record()
+            db.commit()
+            dropped.append(partition.name)
+            logging.warning(f"{self.__class__.__name__}, Dropped partition '{partition.name}' "
+                            f"of {partition.num_results} results")
+        return dropped
+
+    def archive(self, now=None):
+        """
+        Apply the retention policy, archive the results older than the hot months and drop
+        (results or partitions) older than the retention months
+        ---
+        :return moved: number of results moved to the archive partitions
+        :rtype moved: int
+        """
+        hot = self.hot_starts_at(now)
+        retention = self.retention_starts_at(now)
+        expired = self.expire(retention) if retention else 0
+        moved = 0
+        oldest = db.results.completed_at.min()
+        starts_at = db(db.results.completed_at < hot).select(oldest).first()[oldest]
+        while starts_at and month_start(starts_at) < hot:
+            starts_at = month_start(starts_at)
+            moved += self.archive_month(starts_at)
+            starts_at = db((db.results.completed_at >= month_start(starts_at, 1)) &
+                (db.results.completed_at < hot)).select(oldest).first()[oldest]
+        dropped = self.drop_expired(now)
+        if expired or dropped:
+            # result texts only used by the removed results
+            result_blobs.collect(self.tables())
+            db.commit()
+        if moved:
+            logging.warning(f"{self.__class__.__name__}, Archived {moved} results older than {hot}")
+        return moved
+
+
+# shared by all readers and writers of 'results' in the process
+result_partitions = ResultPartitions(hot_months=settings.RESULTS_HOT_MONTHS,
+    retention_months=settings.RESULTS_RETENTION_MONTHS)
@@ -0,0 +1,88 @@
+# coding: utf-8
+
+import logging
+import threading
+import time
+
+from .. import settings
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket, refilled at 'rate' tokens per second up to 'burst' tokens
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def reserve(self):
+        """
+        Take a token, the bucket may go into debt to queue callers in order
+        ---
+        :return wait: seconds the caller must wait before using the token
+        :rtype wait: float
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class LoginRateLimiter():
+    """
+    Rate limit new device logins (SSH + TACACS/RADIUS) by 'devices' region and site_code
+    Only new connects are throttled, commands on open sessions are not limited
+    """
+    def __init__(self, rate=5, burst=10, limits=None):
+        """
+        Standard constructor class
+        ---
+        :param rate: default logins per second per region/site_code
+        :type rate: float
+        :param burst: default logins allowed at once per region/site_code
+        :type burst: int
+        :param limits: (rate, burst) overrides keyed by 'REGION:SITE_CODE' or 'REGION'
+        :type limits: dict
+        """
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits if limits else dict()
+        self.buckets = dict()
+        self.lock = threading.Lock()
+    
+    def get_bucket(self, region, site_code):
+        """Return the token bucket of a region/site_code"""
+        key = f"{region}:{site_code}"
+        with self.lock:
+            if key not in self.buckets:
+                rate, burst = self.limits.get(key, self.limits.get(region, (self.rate, self.burst)))
+                self.buckets[key] = TokenBucket(rate=rate, burst=burst)
+            return self.buckets[key]
+    
+    def reserve(self, region, site_code):
+        """Reserve a login, return the seconds to wait before connecting"""
+        wait = self.get_bucket(region, site_code).reserve()
+        if wait:
+            logging.info(f"{self.__class__.__name__}, Login to {region}:{site_code} delayed {wait:.2f}s")
+        return wait
+    
+    def acquire(self, region, site_code):
+        """Block until a login is allowed for the region/site_code"""
+        wait = self.reserve(region, site_code)
+        if wait:
+            time.sleep(wait)
+
+
+# shared by all pollers and jobs in the process
+login_limiter = LoginRateLimiter(
+    rate=settings.LOGIN_RATE,
+    burst=settings.LOGIN_BURST,
+    limits=settings.LOGIN_RATE_LIMITS
+)
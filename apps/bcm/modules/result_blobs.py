@@ -0,0 +1,201 @@
+# coding: utf-8
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from .. import settings
+from ..models import db
+from .bcm_db import BCMDb, BELONGS_CHUNK_SIZE
+from .result_codec import result_codec
+
+"""
+>>> from apps.bcm.modules.result_blobs import result_blobs
+>>> result_hash = result_blobs.put('{"version": "9.3(8)"}', command=17)
+>>> result_hash
+'3e40f53f70fd289b4b084d8ed0e7bf7a'
+>>> result_blobs.get(result_hash)
+'{"version": "9.3(8)"}'
+"""
+
+
+class ResultBlobs():
+    """
+    Content-addressed store of the result payloads in DB Table 'result_blobs'
+    Each distinct result text is stored once (compressed, see ResultCodec) keyed by its hash,
+    'results' records point at the hash so repeated polls returning the same output only add
+    a 'results' record. Payloads never change for a hash, read payloads are cached (LRU)
+    Writers touch 'used_at' of the payloads they use, collect() only deletes payloads unused
+    for longer than grace_period, so a payload is never deleted under an uncommitted writer
+    """
+    def __init__(self, cache_size=0, grace_period=3600):
+        """
+        Standard constructor class
+        ---
+        :param cache_size: maximum size (characters) of the cached payloads, 0 disables the cache
+        :type cache_size: int
+        :param grace_period: seconds an unused payload is kept after its last use by a writer
+        :type grace_period: int
+        """
+        self.cache_size = cache_size if cache_size else 0
+        self.grace_period = grace_period
+        self.cached = 0
+        self.cache = OrderedDict()  # hash -> result text, least recently used first
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def hash(result):
+        """Return the content hash of a result text"""
+        return hashlib.blake2b(result.encode(), digest_size=16).hexdigest()
+
+    def cache_put(self, result_hash, result):
+        """Cache a payload, evicting the least recently used payloads over self.cache_size"""
+        if not self.cache_size or len(result) > self.cache_size:
+            return
+        with self.lock:
+            if result_hash not in self.cache:
+                self.cache[result_hash] = result
+                self.cached += len(result)
+            self.cache.move_to_end(result_hash)
+            while self.cached > self.cache_size:
+                evicted_hash, evicted = self.cache.popitem(last=False)
+                self.cached -= len(evicted)
+
+    def cache_get(self, result_hash):
+        """Return a cached payload or None"""
+        with self.lock:
+            result = self.cache.get(result_hash)
+            if result is not None:
+                self.cache.move_to_end(result_hash)
+            return result
+
+    def get_existing(self, hashes, touch=False):
+        """
+        Return the hashes with a payload in DB Table 'result_blobs'
+        ---
+        :param touch: set 'used_at' of the payloads before reading them, the write locks the
+            payloads against a concurrent collect() until the transaction ends
+        :type touch: bool
+        """
+        existing = set()
+        hashes = sorted(set(hashes))
+        used_at = datetime.now()
+        for idx in range(0, len(hashes), BELONGS_CHUNK_SIZE):
+            query = db.result_blobs.hash.belongs(hashes[idx:idx + BELONGS_CHUNK_SIZE])
+            if touch:
+                db(query).update(used_at=used_at)
+            existing.update(db_rec.hash for db_rec in db(query).select(db.result_blobs.hash))
+        return existing
+
+    def insert(self, result_hash, result, command=None):
+        """Insert a payload unless its hash exists (written concurrently), no commit"""
+        stored, result_format = result_codec.encode(result, command=command)
+        created_at = datetime.now()
+        BCMDb.upsert(db.result_blobs, keys=('hash',), fields=dict(hash=result_hash, result=stored,
+            result_format=result_format, size=len(result), created_at=created_at, used_at=created_at))
+
+    def put(self, result, command=None):
+        """
+        Store a result payload unless its hash exists, no commit (committed with the 'results')
+        ---
+        :param result: the result text (DBResult.result)
+        :type result: str
+        :param command: 'commands' DB id of the result, selects the compression dictionary
+        :type command: int
+        :return result_hash: the content hash of the result
+        :rtype result_hash: str
+        """
+        return self.put_many([(result, command)])[0]
+
+    def put_many(self, results):
+        """
+        Store the payloads of many results, one query per BELONGS_CHUNK_SIZE hashes plus one
+        write per new payload, no commit. The existence of a payload is always read from DB after
+        touching it, the cache does not prove it (payloads are deleted by collect(), in any process)
+        ---
+        :param results: (result text, 'commands' DB id) of each result
+        :type results: list
+        :return hashes: the content hash of each result, None for a result None
+        :rtype hashes: list
+        """
+        hashes = [ResultBlobs.hash(result) if result is not None else None for result, command in results]
+        existing = self.get_existing([result_hash for result_hash in hashes if result_hash], touch=True)
+        for result_hash, (result, command) in zip(hashes, results):
+            if not result_hash or result_hash in existing:
+                continue
+            self.insert(result_hash, result, command=command)
+            existing.add(result_hash)
+        return hashes
+
+    def get_many(self, hashes):
+        """
+        Return the payload of many hashes, one query per BELONGS_CHUNK_SIZE uncached hashes
+        ---
+        :return results: result text by hash, missing hashes are not included
+        :rtype results: dict
+        """
+        results = dict()
+        missing = list()
+        for result_hash in set(hashes):
+            result = self.cache_get(result_hash)
+            if result is None:
+                missing.append(result_hash)
+            else:
+                results.update({result_hash: result})
+        missing.sort()
+        for idx in range(0, len(missing), BELONGS_CHUNK_SIZE):
+            query = db.result_blobs.hash.belongs(missing[idx:idx + BELONGS_CHUNK_SIZE])
+            for db_rec in db(query).select(db.result_blobs.hash, db.result_blobs.result,
+                    db.result_blobs.result_format):
+                result = result_codec.decode(db_rec.result, db_rec.result_format)
+                self.cache_put(db_rec.hash, result)
+                results.update({db_rec.hash: result})
+        return results
+
+    def get(self, result_hash):
+        """Return the payload of a hash, None if not found"""
+        result = self.get_many([result_hash]).get(result_hash)
+        if result is None:
+            logging.warning(f"{self.__class__.__name__}, No payload found for hash {result_hash}")
+        return result
+
+    def collect(self, tables):
+        """
+        Delete the payloads no longer used by any 'results' record, after results are removed
+        Payloads used by a writer within self.grace_period are kept, their 'results' may not be
+        committed yet. The deleted payloads are evicted from the cache, no commit
+        ---
+        :param tables: 'results' and its archive partitions
+        :type tables: list
+        :return deleted: number of payloads deleted
+        :rtype deleted: int
+        """
+        used_before = datetime.now() - timedelta(seconds=self.grace_period)
+        # payloads stored before 'used_at' was added fall back to 'created_at'
+        query = ((db.result_blobs.used_at < used_before) |
+            ((db.result_blobs.used_at == None) & (db.result_blobs.created_at < used_before)))
+        for table in tables:
+            query &= ~db.result_blobs.hash.belongs(db(table.result_hash != None)._select(table.result_hash))
+        unused = [db_rec.hash for db_rec in db(query).select(db.result_blobs.hash)]
+        deleted = 0
+        for idx in range(0, len(unused), BELONGS_CHUNK_SIZE):
+            deleted += db(query & db.result_blobs.hash.belongs(unused[idx:idx + BELONGS_CHUNK_SIZE])).delete()
+        self.evict(unused)
+        if deleted:
+            logging.warning(f"{self.__class__.__name__}, Deleted {deleted} unused payloads")
+        return deleted
+
+    def evict(self, hashes):
+        """Drop payloads from the cache"""
+        with self.lock:
+            for result_hash in hashes:
+                result = self.cache.pop(result_hash, None)
+                if result is not None:
+                    self.cached -= len(result)
+
+
+# shared by all readers and writers of 'results' in the process
+result_blobs = ResultBlobs(cache_size=settings.RESULTS_BLOB_CACHE_SIZE,
+    grace_period=settings.RESULTS_BLOB_GRACE_PERIOD)
@@ -0,0 +1,223 @@
+# coding: utf-8
+
+import base64
+import logging
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from .. import settings
+from ..models import db
+
+# zstandard is optional, only required by the 'zstd' codec
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+>>> from apps.bcm.modules.result_codec import result_codec
+>>> stored, result_format = result_codec.encode(result, command=17)
+>>> result_format
+'zlib:3'
+>>> result_codec.decode(stored, result_format) == result
+True
+>>> result_codec.train_dictionaries()
+[17, 18]
+"""
+
+
+class ResultCodec():
+    """
+    Compression of the 'results' result text, the 'result_format' of each record tells how the
+    result is stored so records are read unchanged whatever the codec settings:
+    None (plain text, records saved before compression or too short), 'zlib' or 'zstd' (base64 of
+    the compressed text) and 'zlib:<id>' or 'zstd:<id>' (compressed with 'result_dictionaries' id)
+    Outputs of a command are repetitive, a dictionary trained on the past results of the command
+    (see train_dictionaries) is used when the command has one
+    """
+    ZLIB_LEVEL = 6
+    ZSTD_LEVEL = 3
+    # zlib only uses the last 32KB of a preset dictionary
+    ZLIB_DICT_SIZE = 32768
+    # minimum number of past results of a command to train a dictionary
+    MIN_SAMPLES = 10
+    # seconds the current dictionaries are cached before checking for newer ones
+    DICTIONARY_TTL = 300
+
+    def __init__(self, codec=None, min_size=0, dict_size=None, dict_samples=None):
+        """
+        Standard constructor class
+        ---
+        :param codec: 'zstd', 'zlib' or None to store results as plain text
+        :type codec: str
+        :param min_size: results shorter than min_size are stored as plain text
+        :type min_size: int
+        :param dict_size: maximum size (bytes) of a trained dictionary
+        :type dict_size: int
+        :param dict_samples: number of past results of a command a dictionary is trained on
+        :type dict_samples: int
+        """
+        if codec == "zstd" and zstandard is None:
+            logging.warning(f"{self.__class__.__name__}, zstandard is not installed, using zlib "
+                            "(pip install zstandard)")
+            codec = "zlib"
+        if codec not in (None, "zlib", "zstd"):
+            raise ValueError(self.__class__.__name__, f"Unknown codec {codec}")
+        self.codec = codec
+        self.min_size = min_size if min_size else 0
+        self.dict_size = dict_size if dict_size else ResultCodec.ZLIB_DICT_SIZE
+        self.dict_samples = dict_samples if dict_samples else 100
+        self.lock = threading.Lock()
+        self.dictionaries = dict()  # 'result_dictionaries' id -> (codec, dictionary bytes)
+        self.current = dict()  # command id -> current 'result_dictionaries' id of self.codec
+        self.current_at = None
+
+    def get_dictionary(self, dict_id):
+        """Return the (codec, dictionary bytes) of a 'result_dictionaries' id, cached as immutable"""
+        dictionary = self.dictionaries.get(dict_id)
+        if dictionary is None:
+            db_rec = db(db.result_dictionaries.id == dict_id).select().first()
+            if not db_rec:
+                raise ValueError(self.__class__.__name__, f"No 'result_dictionaries' id={dict_id}")
+            dictionary = (db_rec.codec, db_rec.dictionary)
+            with self.lock:
+                self.dictionaries.update({dict_id: dictionary})
+        return dictionary
+
+    def get_current(self, command):
+        """Return the current 'result_dictionaries' id of a command for self.codec, or None"""
+        if self.current_at is None or time.monotonic() - self.current_at >= ResultCodec.DICTIONARY_TTL:
+            current = dict()
+            query = (db.result_dictionaries.codec == self.codec)
+            for db_rec in db(query).select(db.result_dictionaries.id, db.result_dictionaries.command,
+                    orderby=db.result_dictionaries.created_at | db.result_dictionaries.id):
+                current.update({db_rec.command: db_rec.id})
+            with self.lock:
+                self.current = current
+                self.current_at = time.monotonic()
+        return self.current.get(command)
+
+    @staticmethod
+    def compress(data, codec, dictionary=None):
+        """Compress bytes with a codec and an optional dictionary"""
+        if codec == "zlib":
+            if dictionary:
+                compressor = zlib.compressobj(ResultCodec.ZLIB_LEVEL, zdict=dictionary)
+            else:
+                compressor = zlib.compressobj(ResultCodec.ZLIB_LEVEL)
+            return compressor.compress(data) + compressor.flush()
+        if codec == "zstd":
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            return zstandard.ZstdCompressor(level=ResultCodec.ZSTD_LEVEL, dict_data=dict_data).compress(data)
+        raise ValueError("ResultCodec", f"Unknown codec {codec}")
+
+    @staticmethod
+    def decompress(data, codec, dictionary=None):
+        """Decompress bytes compressed by compress()"""
+        if codec == "zlib":
+            decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+            return decompressor.decompress(data) + decompressor.flush()
+        if codec == "zstd":
+            if zstandard is None:
+                raise ImportError("ResultCodec", "zstandard is required to read 'zstd' results, pip install zstandard")
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+        raise ValueError("ResultCodec", f"Unknown codec {codec}")
+
+    def encode(self, result, command=None):
+        """
+        Encode a result for storage with self.codec and the command current dictionary
+        ---
+        :param result: the result text (DBResult.result)
+        :type result: str
+        :param command: 'commands' DB id of the result, selects the dictionary
+        :type command: int
+        :return (stored, result_format): value of the 'result' and 'result_format' fields
+        :rtype (stored, result_format): tuple
+        """
+        if not self.codec or not isinstance(result, str) or len(result) < self.min_size:
+            return result, None
+        dict_id = self.get_current(command) if command else None
+        dictionary = self.get_dictionary(dict_id)[1] if dict_id else None
+        stored = base64.b64encode(ResultCodec.compress(result.encode(), self.codec, dictionary)).decode()
+        if len(stored) >= len(result):
+            return result, None
+        return stored, f"{self.codec}:{dict_id}" if dict_id else self.codec
+
+    def decode(self, stored, result_format=None):
+        """Return the result text of a stored 'result' and its 'result_format'"""
+        if not result_format or stored is None:
+            return stored
+        codec, _, dict_id = result_format.partition(":")
+        dictionary = None
+        if dict_id:
+            dict_codec, dictionary = self.get_dictionary(int(dict_id))
+            if dict_codec != codec:
+                raise ValueError(self.__class__.__name__, f"Dictionary id={dict_id} is not a {codec} dictionary")
+        return ResultCodec.decompress(base64.b64decode(stored), codec, dictionary).decode()
+
+    def train(self, command):
+        """
+        Train a dictionary for self.codec on the latest results of a command, return its
+        'result_dictionaries' DB id or None if the command has too few results
+        """
+        # the results of the devices running the command, selected with the (device, command) index
+        devices = db(db.device_commands.command == command).select(db.device_commands.device,
+            limitby=(0, self.dict_samples))
+        query = db.results.device.belongs([db_rec.device for db_rec in devices])
+        query &= (db.results.command == command) & ((db.results.result != None) | (db.results.result_hash != None))
+        records = db(query).select(db.results.result, db.results.result_format, db.results.result_hash,
+            orderby=~db.results.id, limitby=(0, self.dict_samples))
+        # result texts stored in 'result_blobs' (see ResultBlobs), each distinct text is one sample
+        hashes = list(dict.fromkeys(record.result_hash for record in records if record.result_hash))
+        blobs = db(db.result_blobs.hash.belongs(hashes)).select(db.result_blobs.result,
+            db.result_blobs.result_format) if hashes else list()
+        records = [record for record in records if not record.result_hash] + list(blobs)
+        samples = [self.decode(record.result, record.result_format).encode() for record in records]
+        samples = [sample for sample in samples if sample]
+        if len(samples) < ResultCodec.MIN_SAMPLES:
+            return None
+        dictionary = None
+        if self.codec == "zstd":
+            try:
+                dictionary = zstandard.train_dictionary(self.dict_size, samples).as_bytes()
+            except zstandard.ZstdError as train_error:
+                logging.warning(f"{self.__class__.__name__}, Unable to train dictionary for command "
+                                f"id={command}, using raw samples: {train_error}")
+        if dictionary is None:
+            # raw dictionary of the latest samples, the most recent at the end where zlib weights it most
+            size = min(self.dict_size, ResultCodec.ZLIB_DICT_SIZE) if self.codec == "zlib" else self.dict_size
+            dictionary = b"".join(reversed(samples))[-size:]
+        dict_id = db.result_dictionaries.insert(command=command, codec=self.codec, dictionary=dictionary,
+            num_samples=len(samples), created_at=datetime.now())
+        db.commit()
+        with self.lock:
+            self.dictionaries.update({int(dict_id): (self.codec, dictionary)})
+            self.current.update({command: int(dict_id)})
+        logging.warning(f"{self.__class__.__name__}, Trained {self.codec} dictionary id={dict_id} "
+                        f"for command id={command} on {len(samples)} results")
+        return int(dict_id)
+
+    def train_dictionaries(self, retrain=False):
+        """
+        Train a dictionary for the commands without one for self.codec, or all commands if retrain
+        ---
+        :return trained: list of 'commands' DB ids with a new dictionary
+        :rtype trained: list
+        """
+        if not self.codec:
+            return list()
+        self.current_at = None
+        trained = list()
+        for db_rec in db(db.commands).select(db.commands.id):
+            if retrain or not self.get_current(db_rec.id):
+                if self.train(db_rec.id):
+                    trained.append(db_rec.id)
+        return trained
+
+
+# shared by all readers and writers of 'results' in the process
+result_codec = ResultCodec(codec=settings.RESULTS_COMPRESSION, min_size=settings.RESULTS_COMPRESS_MIN_SIZE,
+    dict_size=settings.RESULTS_DICT_SIZE, dict_samples=settings.RESULTS_DICT_SAMPLES)
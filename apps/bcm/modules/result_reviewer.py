@@ -2,14 +2,18 @@
 
 import logging
 import json
+from datetime import datetime
 
 from pydal.objects import Row
 
+from .. import settings
 from ..models import db
 from .devices import DBDevice
 from .commands import DBCommand
 from .results import DBResult
 from .output_parsers import DBParser
+from .partitions import result_partitions
+from .result_codec import result_codec
 
 """
 >>> from apps.bcm.modules.result_reviewer import ResultsReview
@@ -41,8 +45,8 @@ class ResultsReview():
         self.device = None
         self.command = None
         self.output_parser = None
-        self.result_one = DBResult(db_id=result_one)
-        self.result_two = DBResult(db_id=result_two)
+        self.result_one = DBResult.get(result_one)
+        self.result_two = DBResult.get(result_two)
         self.reviewed = bool()
         self.reviewed_at = None
         self.review_status = None
@@ -50,54 +54,143 @@ class ResultsReview():
         self.comment = None
 
     @staticmethod
-    def get_results():
-        results = db().select(db.results.ALL, orderby=db.results.device)
+    def get_results(since=None, until=None):
+        """Return the results completed from since until, read from the partitions holding them"""
+        results = DBResult.resolve(result_partitions.select(lambda table: table.id > 0, since=since, until=until))
+        results = sorted(results, key=lambda res: res.device)
         results_list = []
         for res in results:
-            r = DBResult(db_id=res.id)
+            r = DBResult.get(db_rec=res)
             results_list.append(r.to_json)
         return results_list
     
     @classmethod
-    def get_results_by_device(cls, device=None, command=None):
-        results_by_device = dict()
-        if not device and not command:
-            results = db().select(db.results.ALL, orderby=db.results.device)
-        elif not device and command:
+    def get_results_by_device(cls, device=None, command=None, since=None, until=None, include_result=True):
+        """
+        Return the results by device, optionally of one device (and command) and completed
+        from since until, only the partitions holding since-until are read
+        The results are selected joined with 'devices' and 'commands', one query per partition
+        ---
+        :param device: 'devices' DB id, name or mgmt_ip
+        :type device: int or str
+        :param command: 'commands' DB id, requires device
+        :type command: int
+        :param include_result: include the result text, False leaves out 'result' (None)
+        :type include_result: bool
+        :return results_by_device: results in dict format with 'device_name' and 'command_name'
+            by 'devices' DB id and 'results' DB id
+        :rtype results_by_device: dict
+        """
+        if not device and command:
             raise NotImplementedError("Command not supproted with 'device' parameter")
-        elif device and isinstance(device, int):
-            if not command:
-                results = db(db.results.device == device).select()
-            else:
-                results = db((db.results.device == device) & (db.results.command == command)).select()
-            #results_by_device[device] = dict()
+        query = (db.devices.id > 0)
+        if isinstance(device, int):
+            query = (db.devices.id == device)
         elif isinstance(device, str):
-            if not command:
-                dev = db((db.devices.mgmt_ip == device) | (db.devices.name == device)).select().first()
-                results = db(db.results.device == dev.id).select()
-                #results_by_device[dev.id] = dict()
-            else:
-                dev = db((db.devices.mgmt_ip == device) | (db.devices.name == device)).select().first()
-                results = db((db.results.device == dev.id) & (db.results.command == command)).select()
-        for res in results:
-            r = DBResult(db_id=res.id)
-            d = DBDevice(db_id=r.device)
-            c = DBCommand(db_id=r.command)
-            if not r.device in results_by_device.keys():
-                results_by_device.update({r.device: {res.id: r.to_json()}})
-            else:
-                results_by_device[r.device].update({res.id: r.to_json()})
-            results_by_device[r.device][res.id].update({"device_name": d.name})
-            results_by_device[r.device][res.id].update({"command_name": c.syntax})
-        return results_by_device
+            query = (db.devices.mgmt_ip == device) | (db.devices.name == device)
+        if device and command:
+            query &= (db.commands.id == command)
+        results_by_device = dict()
+        for table in result_partitions.tables(since=since, until=until):
+            table_query = query & (table.device == db.devices.id) & (table.command == db.commands.id)
+            if since:
+                table_query &= (table.completed_at >= since)
+            if until:
+                table_query &= (table.completed_at <= until)
+            fields = [table.id, table.device, table.command, table.completed_at, table.status, table.job,
+                table.last_result, table.comment, db.devices.name, db.commands.syntax]
+            if include_result:
+                fields.extend([table.result, table.result_format, table.result_hash])
+            rows = db(table_query).select(*fields, orderby=table.device | table.id)
+            records = [row[table._tablename] for row in rows]
+            if include_result:
+                DBResult.resolve(records)
+            for row, res in zip(rows, records):
+                result = dict(id=res.id, device=res.device, command=res.command,
+                    completed_at=res.completed_at, status=res.status, job=res.job,
+                    result=result_codec.decode(res.result, res.result_format) if include_result else None,
+                    last_result=res.last_result, comment=res.comment,
+                    device_name=row.devices.name, command_name=row.commands.syntax)
+                results_by_device.setdefault(res.device, dict()).update({res.id: result})
+        return dict(sorted(results_by_device.items()))
+    
+    @staticmethod
+    def to_cursor(record):
+        """Return the page cursor of a 'results' record, its (completed_at, id) key e.g. '20241001120000-1523'"""
+        return f"{record.completed_at.strftime('%Y%m%d%H%M%S')}-{record.id}"
+    
+    @staticmethod
+    def from_cursor(cursor):
+        """Return the (completed_at, id) key of a page cursor, None without cursor"""
+        if not cursor:
+            return None
+        try:
+            completed_at, db_id = cursor.split("-")
+            return datetime.strptime(completed_at, "%Y%m%d%H%M%S"), int(db_id)
+        except ValueError:
+            raise ValueError("ResultsReview", f"Invalid page cursor '{cursor}'")
+    
+    @classmethod
+    def get_results_page(cls, device=None, command=None, limit=None, after=None, before=None):
+        """
+        Return a page of results in (completed_at, id) order, optionally of one device (and command)
+        Pages are read from the cursor key (see ResultPartitions.select_page), the cost of a page
+        does not depend on the number of results before or after it
+        ---
+        :param device: 'devices' DB id
+        :type device: int
+        :param command: 'commands' DB id, requires device
+        :type command: int
+        :param limit: page size, default settings.RESULTS_PAGE_SIZE, at most settings.RESULTS_MAX_PAGE_SIZE
+        :type limit: int
+        :param after: page cursor, the page of results following the cursor
+        :type after: str
+        :param before: page cursor, the page of results preceding the cursor, default the latest
+            results when after is None too
+        :type before: str
+        :return page: 'results' (dict format with 'device_name' and 'command_name'), 'next' the
+            cursor of the following page (after=next), 'previous' the cursor of the preceding
+            page (before=previous), None if there is no following or preceding page
+        :rtype page: dict
+        """
+        limit = int(limit) if limit else settings.RESULTS_PAGE_SIZE
+        if limit < 1:
+            raise ValueError(cls.__name__, f"Invalid page size {limit}")
+        limit = min(limit, settings.RESULTS_MAX_PAGE_SIZE)
+        if after and before:
+            raise ValueError(cls.__name__, "Expecting one of 'after' or 'before' cursors")
+        if command and not device:
+            raise NotImplementedError("Command not supproted with 'device' parameter")
+        if device and command:
+            query = lambda table: (table.device == device) & (table.command == command)
+        elif device:
+            query = lambda table: table.device == device
+        else:
+            query = lambda table: table.id > 0
+        records, more = result_partitions.select_page(query, limit,
+            after=cls.from_cursor(after), before=cls.from_cursor(before))
+        results = list()
+        for res in DBResult.resolve(records):
+            r = DBResult.get(db_rec=res)
+            result = r.to_json()
+            result.update({"device_name": DBDevice.get(r.device).name})
+            result.update({"command_name": DBCommand.get(r.command).syntax})
+            results.append(result)
+        if not records:
+            # no results past the cursor, the cursor is the way back
+            return dict(results=results, next=before, previous=after)
+        following = more if after else bool(before)
+        preceding = bool(after) if after else more
+        return dict(results=results,
+            next=cls.to_cursor(records[-1]) if following else None,
+            previous=cls.to_cursor(records[0]) if preceding else None)
     
     def load_result(self, result, current=True):
         """Create object and load the 'result' object or None"""
         if isinstance(result, int):
-            res = DBResult(db_id=result)
+            res = DBResult.get(result)
         elif isinstance(result, Row):
-            res = DBResult()
-            res.load_by_id(db_rec=result)
+            res = DBResult.get(db_rec=result)
         if not result:
             logging.warning(f"Expected 'result' object, received {type(result)}")
             return None
@@ -122,7 +215,7 @@ class ResultsReview():
             self.result_one and self.result_two and 
             self.result_one.device == self.result_two.device
         ):
-            self.device = DBDevice(db_id=self.result_one.device)
+            self.device = DBDevice.get(self.result_one.device)
         else:
             # catch-all error
             logging.warning("Unknown Error, more information/debugging required")
@@ -134,7 +227,7 @@ class ResultsReview():
             self.result_one and self.result_two and 
             self.result_one.command == self.result_two.command
         ):
-            self.command = DBCommand(db_id=self.result_one.command)
+            self.command = DBCommand.get(self.result_one.command)
         else:
             # catch-all error
             logging.warning("Unknown Error, more information/debugging required")
@@ -151,7 +244,7 @@ class ResultsReview():
             if not parser:
                 logging.warning(f"No parsers available for command id={self.command.db_id}")
             else:
-                self.output_parser = DBParser(db_id=parser.id)
+                self.output_parser = DBParser.get(db_rec=parser)
     
     def results_comparison(self):
         """
@@ -163,6 +256,13 @@ class ResultsReview():
             self.get_output_parser()
         if not self.output_parser or not isinstance(self.output_parser, DBParser):
             raise TypeError(self.__class__.__name__, f"Expecting DBParser received {type(self.output_parser)}")  
+        if self.result_one.result_hash and self.result_one.result_hash == self.result_two.result_hash:
+            # same content hash (see ResultBlobs), the results are equal without parsing them
+            self.reviewed = True
+            self.reviewed_at = self.result_one.get_timestamp()
+            self.review_status = "Success"
+            self.report = None
+            return
         output_datapath = self.output_parser.parser_path
         res_j_one = json.loads(self.result_one.result)
         res_j_two = json.loads(self.result_two.result)
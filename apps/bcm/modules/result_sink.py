@@ -0,0 +1,81 @@
+# coding: utf-8
+
+import logging
+import queue
+import time
+
+from .results import DBResult, DBResults
+
+
+class ResultSink():
+    """
+    Persistence sink streaming command results to DB Table 'results' as each command completes
+    Pollers put() results from their own thread (pool workers or event loop), the thread owning
+    the DB connection writes them with write(), so results are durable while the job runs and
+    never accumulate in the pollers
+    """
+    def __init__(self, maxsize=0):
+        """
+        Standard constructor class
+        ---
+        :param maxsize: maximum number of queued results, put() blocks when full (0 unbounded)
+        :type maxsize: int
+        """
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.results = list()
+        self.save_time = 0.0  # seconds spent saving results
+
+    def put(self, response):
+        """Queue a command result (DBResult json) for writing"""
+        self.queue.put(response)
+
+    @property
+    def is_idle(self):
+        """True if no results are queued"""
+        return self.queue.empty()
+
+    def save(self, responses):
+        """
+        Save command results to DB in one transaction, return the new 'results' DB ids
+        If the bulk save fails each result is saved on its own, so one bad result is not
+        losing the others
+        """
+        try:
+            return DBResults.save_results(responses)
+        except Exception as save_error:
+            logging.warning(f"{self.__class__.__name__}, Bulk save of {len(responses)} results failed: {save_error}")
+        db_ids = list()
+        for response in responses:
+            try:
+                r = DBResult()
+                r.from_json(json_data=response)
+                if r.save():
+                    db_ids.append(r.db_id)
+            except Exception as save_error:
+                logging.warning(f"{self.__class__.__name__}, Unable to save result for device "
+                                f"id={response.get('device')} command id={response.get('command')}: {save_error}")
+        return db_ids
+
+    def write(self, timeout=None):
+        """
+        Write the queued results to DB, must be called from the thread owning the DB connection
+        ---
+        :param timeout: seconds to wait for a first result, None to return if the queue is empty
+        :type timeout: float
+        :return written: list of 'results' DB ids written
+        :rtype written: list
+        """
+        try:
+            responses = [self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()]
+        except queue.Empty:
+            return list()
+        while True:
+            try:
+                responses.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        started = time.monotonic()
+        written = self.save(responses)
+        self.save_time += time.monotonic() - started
+        self.results.extend(written)
+        return written
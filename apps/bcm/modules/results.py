@@ -5,14 +5,22 @@ import json
 
 from pydal.objects import Row
 
-from .bcm_db import BCMDb
+from .bcm_db import BCMDb, BELONGS_CHUNK_SIZE
+from .partitions import result_partitions
+from .result_blobs import result_blobs
+from .result_codec import result_codec
 from ..models import db
 
 
 class DBResult(BCMDb):
     """
     DB Abstraction class for uniform interaction with DB Table 'results'
+    Results are written to 'results', archived results are read from their partition
+    (see ResultPartitions). The result text is stored once per content in 'result_blobs',
+    the record holds its 'result_hash' (see ResultBlobs)
     """
+    dbtable = 'results'
+    
     def __init__(self, db_id=None):
         """
         Standard constructor class
@@ -25,6 +33,7 @@ class DBResult(BCMDb):
         self.status = None
         self.job = None
         self.result = None
+        self.result_hash = None
         self.last_result = None
         self.comment = None
         if self.db_id:
@@ -47,6 +56,8 @@ class DBResult(BCMDb):
             if not rec_id:
                 raise ValueError(self.__class__.__name__, "Invalid or missing record id")
             db_rec = db(db.results.id == rec_id).select().first()    
+            if not db_rec:
+                db_rec = result_partitions.find(rec_id)
         if not db_rec:
             raise TypeError(self.__class__.__name__, f"Expecting record received {type(db_rec)}")
         self.device = db_rec.device
@@ -54,11 +65,58 @@ class DBResult(BCMDb):
         self.completed_at = db_rec.completed_at
         self.status = db_rec.status
         self.job = db_rec.job
-        self.result = db_rec.result
+        self.result_hash = db_rec.get('result_hash')
+        if self.result_hash and db_rec.result is None:
+            self.result = result_blobs.get(self.result_hash)
+        else:
+            # records saved before 'result_blobs' (or payloads read by resolve()) hold the result
+            self.result = result_codec.decode(db_rec.result, db_rec.result_format)
         self.last_result = db_rec.last_result
         self.comment = db_rec.comment
         self.db_loaded = True
     
+    @staticmethod
+    def resolve(records):
+        """
+        Read the result text of 'results' records stored in 'result_blobs', one query per
+        BELONGS_CHUNK_SIZE distinct hashes, the records are updated in place
+        ---
+        :param records: 'results' records of 'results' or its partitions
+        :type records: list or Rows
+        :return records: the records with the result text in 'result'
+        """
+        stored = [record for record in records if record.get('result_hash') and record.result is None]
+        if stored:
+            payloads = result_blobs.get_many([record.result_hash for record in stored])
+            for record in stored:
+                record.result = payloads.get(record.result_hash)
+                record.result_format = None
+        return records
+    
+    @classmethod
+    def select_chunks(cls, db_ids=None, table=None):
+        """
+        Yield the DB records of 'results' then of the archive partitions, see BCMDb.select_chunks()
+        DB ids not in 'results' are selected from the partitions holding them, the result text
+        of each chunk is read from 'result_blobs' at once (see resolve())
+        """
+        if table is not None:
+            for records in super(DBResult, cls).select_chunks(db_ids=db_ids, table=table):
+                yield cls.resolve(records)
+            return
+        if not db_ids:
+            for table in result_partitions.tables(newest_first=True):
+                for records in super(DBResult, cls).select_chunks(table=table):
+                    yield cls.resolve(records)
+            return
+        missing = set(int(db_id) for db_id in db_ids)
+        for records in super(DBResult, cls).select_chunks(db_ids=db_ids):
+            missing.difference_update(record.id for record in records)
+            yield cls.resolve(records)
+        for table, ids in result_partitions.route_ids(missing):
+            for records in super(DBResult, cls).select_chunks(db_ids=ids, table=table):
+                yield cls.resolve(records)
+    
     def save(self):
         """
         Save a record to DB - creator/updater method
@@ -66,36 +124,48 @@ class DBResult(BCMDb):
         ---
         :return True or False: based on whether a new record is created or not
         """
-        # create query to check whether 'device' has run 'command' before
+        # the last result of 'device' running 'command'
+        last_id = db.results.id.max()
         query = (db.results.device == self.device) & (db.results.command == self.command)
-        if db(query).count() > 0:
-            db_last_rec = db(query).select().last()
-            if db_last_rec and isinstance(db_last_rec, Row):
-                self.last_result = db_last_rec.id
-        # add to query to check key field 'completed_at' for uniqueness
-        query &= (db.results.completed_at == self.completed_at)
-        # ensure result is saved as a JSON blob
-        # self.result = json.dumps(self.result.replace("'", "\""))
-        if db(query).count() == 0:
-            db.results.insert(device=self.device, command=self.command,
-                completed_at=self.completed_at, status=self.status,
-                job=self.job, result=self.result,
-                last_result=self.last_result, comment=self.comment)
-            db.commit()
-            db_rec = db(query).select().first()
+        self.last_result = db(query).select(last_id).first()[last_id]
+        if self.last_result is None:
+            latest = result_partitions.select_latest(lambda table: (table.device == self.device) &
+                (table.command == self.command), limit=1)
+            self.last_result = latest[0].id if latest else None
+        partition = result_partitions.get_partition(self.completed_at) if self.completed_at else None
+        if partition:
+            # results of an archived month are only saved if not already in its partition
+            db_rec = db((partition.device == self.device) & (partition.command == self.command) &
+                (partition.completed_at == self.completed_at)).select(partition.id, partition.last_result).first()
             if db_rec:
                 self.db_id = db_rec.id
-                self.db_created = True
-                logging.warning(f"New record created in table 'results' id={self.db_id}")
-                return True
-        elif db(query).count() > 0:
-            db_rec = db(query).select().first()
+                self.last_result = db_rec.last_result
+                logging.warning(f"Record exists in table '{partition._tablename}' id={self.db_id} - no updates permitted")
+                return False
+        # the result text is written to 'result_blobs' unless a result with the same content exists
+        self.result_hash = result_blobs.put(self.result, command=self.command) if self.result is not None else None
+        # insert unless the key field 'completed_at' is not unique, no updates permitted
+        db_rec = self.upsert(db.results, keys=('device', 'command', 'completed_at'),
+            fields=dict(device=self.device, command=self.command,
+                completed_at=self.completed_at, status=self.status,
+                job=self.job, result=None, result_hash=self.result_hash,
+                last_result=self.last_result, comment=self.comment))
+        if db_rec:
+            self.commit()
+            self.db_id = db_rec[0]
+            self.db_created = True
+            logging.warning(f"New record created in table 'results' id={self.db_id}")
+            return True
+        query &= (db.results.completed_at == self.completed_at)
+        db_rec = db(query).select(db.results.id, db.results.last_result).first()
+        if db_rec:
             self.db_id = db_rec.id
+            self.last_result = db_rec.last_result
             logging.warning(f"Record exists in table 'results' id={self.db_id} - no updates permitted")
             return False
         # catch-all error
         logging.warning("Unknown Error, more information/debugging required")
-        db.rollback()
+        self.rollback()
         return False
 
     def from_json(self, json_data):
@@ -146,21 +216,194 @@ class DBResults():
     
     @staticmethod
     def get_results(db_ids=None):
-        if not db_ids:
-            results = db(db.results).select()
-        else:
-            if isinstance(db_ids, list):
-                for db_id in db_ids:
-                    idx = 0
-                    while idx < len(db_ids):
-                        if idx == 0:
-                            query = (db.results.id == db_id)
-                        else:
-                            query |= (db.results.id == db_id)
-                        idx += 1
-                results = db(query).select()
-        results_list = []
+        """
+        Return 'results' in dict format, one query per BELONGS_CHUNK_SIZE records
+        ---
+        :param db_ids: DB ids of the 'results', None or empty for all 'results'
+        :type db_ids: list
+        :return results_list: list of 'results' in dict format
+        :rtype results_list: list
+        """
+        return list(DBResults.iter_results(db_ids=db_ids))
+    
+    @staticmethod
+    def iter_results(db_ids=None):
+        """Yield 'results' in dict format, streaming the records a chunk at a time"""
+        for result in DBResult.load_many(db_ids=db_ids):
+            yield result.to_json()
+    
+    @staticmethod
+    def to_ndjson(records):
+        """
+        Return 'results' records as newline-delimited JSON, one line per result
+        ---
+        :param records: 'results' records of 'results' or its partitions
+        :type records: list
+        :return lines: a JSON object per result, each ending with a newline
+        :rtype lines: str
+        """
+        lines = list()
+        for record in DBResult.resolve(records):
+            result = dict(id=record.id, device=record.device, command=record.command,
+                completed_at=record.completed_at, status=record.status, job=record.job,
+                result=result_codec.decode(record.result, record.result_format),
+                last_result=record.last_result, comment=record.comment)
+            lines.append(json.dumps(result, default=str) + "\n")
+        return "".join(lines)
+    
+    @staticmethod
+    def export_results(device=None, command=None, job=None, since=None, until=None,
+            chunk_size=BELONGS_CHUNK_SIZE):
+        """
+        Yield the 'results' and the archived results matching the filters as newline-delimited
+        JSON, oldest partition first and by DB id. Each table is read with a DB cursor
+        (iterselect) and chunk_size records at a time are resolved and serialised, the
+        memory used does not depend on the number of results exported
+        ---
+        :param device: 'devices' DB id, None for all devices
+        :type device: int
+        :param command: 'commands' DB id, None for all commands
+        :type command: int
+        :param job: 'jobs' DB id, None for all jobs
+        :type job: int
+        :param since: results completed at or after since, None for no lower bound
+        :type since: datetime
+        :param until: results completed at or before until, None for no upper bound
+        :type until: datetime
+        :param chunk_size: number of results per yielded chunk
+        :type chunk_size: int
+        :return chunk: chunk_size results in NDJSON format
+        :rtype chunk: str
+        """
+        for table in result_partitions.tables(since=since, until=until):
+            query = (table.id > 0)
+            if device:
+                query &= (table.device == device)
+            if command:
+                query &= (table.command == command)
+            if job:
+                query &= (table.job == job)
+            if since:
+                query &= (table.completed_at >= since)
+            if until:
+                query &= (table.completed_at <= until)
+            records = list()
+            for record in db(query).iterselect(orderby=table.id):
+                records.append(record)
+                if len(records) >= chunk_size:
+                    yield DBResults.to_ndjson(records)
+                    records = list()
+            if records:
+                yield DBResults.to_ndjson(records)
+    
+    @staticmethod
+    def get_last_results(pairs):
+        """
+        Return the DB id of the last result of each (device, command) pair in one query per chunk
+        ---
+        :param pairs: (device, command) DB id pairs
+        :type pairs: set
+        :return last_results: 'results' DB id by (device, command)
+        :rtype last_results: dict
+        """
+        last_results = dict()
+        # pairs without results in 'results' are looked up in the partitions, newest first
+        for table in result_partitions.tables(newest_first=True):
+            missing = set(pair for pair in pairs if pair not in last_results)
+            if not missing:
+                break
+            devices = sorted(set(device for device, command in missing))
+            commands = sorted(set(command for device, command in missing))
+            last_id = table.id.max()
+            for idx in range(0, len(devices), BELONGS_CHUNK_SIZE):
+                query = table.device.belongs(devices[idx:idx + BELONGS_CHUNK_SIZE])
+                query &= table.command.belongs(commands)
+                rows = db(query).select(table.device, table.command, last_id,
+                    groupby=table.device | table.command)
+                for row in rows:
+                    pair = (row[table.device], row[table.command])
+                    if pair in missing:
+                        last_results.update({pair: row[last_id]})
+        return last_results
+    
+    @staticmethod
+    def get_existing_results(results):
+        """Return the (device, command, completed_at) keys of results already in 'results' or its partitions"""
+        existing = set()
+        devices = sorted(set(result['device'] for result in results))
+        completed = sorted(set(str(result['completed_at']) for result in results))
+        for table in result_partitions.tables(since=completed[0], until=completed[-1]):
+            for idx in range(0, len(devices), BELONGS_CHUNK_SIZE):
+                query = table.device.belongs(devices[idx:idx + BELONGS_CHUNK_SIZE])
+                query &= (table.completed_at >= completed[0]) & (table.completed_at <= completed[-1])
+                rows = db(query).select(table.device, table.command, table.completed_at)
+                for row in rows:
+                    existing.add((row.device, row.command, row.completed_at.strftime("%Y-%m-%d %H:%M:%S")))
+        return existing
+    
+    @staticmethod
+    def save_results(results):
+        """
+        Save many results (a device's or a whole job's) to DB Table 'results' in one transaction
+        The 'last_result' of every (device, command) is resolved in one query and the rows are
+        written with bulk_insert, results already in DB (same device, command and completed_at)
+        are skipped like DBResult.save()
+        ---
+        :param results: results in DBResult json format (see DBResult.from_json)
+        :type results: list
+        :return db_ids: list of the new 'results' DB ids
+        :rtype db_ids: list
+        """
+        records = list()
         for result in results:
-            r = DBResult(db_id=result.id)
-            results_list.append(r.to_json())
-        return results_list
+            r = DBResult()
+            r.from_json(json_data=result)
+            if not r.device or not r.command or not r.completed_at:
+                raise ValueError("DBResults", f"Missing device, command or completed_at in {result}")
+            records.append(r)
+        if not records:
+            return list()
+        try:
+            existing = DBResults.get_existing_results([r.to_json() for r in records])
+            new, keys = list(), set()
+            for r in records:
+                key = (r.device, r.command, r.completed_at)
+                if key in existing or key in keys:
+                    continue
+                keys.add(key)
+                new.append(r)
+            if len(new) < len(records):
+                logging.warning(f"Skipped {len(records) - len(new)} existing records in table 'results'")
+            last_results = DBResults.get_last_results(set((r.device, r.command) for r in new))
+            # results of the same (device, command) are chained by completed_at, one insert round each
+            rounds, seen = list(), dict()
+            for r in sorted(new, key=lambda r: r.completed_at):
+                pair = (r.device, r.command)
+                count = seen.get(pair, 0)
+                seen.update({pair: count + 1})
+                if count == len(rounds):
+                    rounds.append(list())
+                rounds[count].append(r)
+            # one existence query per chunk of hashes, the new result texts are written once
+            hashes = result_blobs.put_many([(r.result, r.command) for r in new])
+            for r, result_hash in zip(new, hashes):
+                r.result_hash = result_hash
+            db_ids = list()
+            for batch in rounds:
+                for r in batch:
+                    r.last_result = last_results.get((r.device, r.command))
+                rows = [dict(device=r.device, command=r.command, completed_at=r.completed_at,
+                    status=r.status, job=r.job, result=None, result_hash=r.result_hash,
+                    last_result=r.last_result, comment=r.comment) for r in batch]
+                ids = db.results.bulk_insert(rows)
+                for r, db_id in zip(batch, ids):
+                    r.db_id = int(db_id)
+                    r.db_created = True
+                    last_results.update({(r.device, r.command): r.db_id})
+                    db_ids.append(r.db_id)
+            BCMDb.commit()
+        except Exception:
+            BCMDb.rollback()
+            raise
+        logging.warning(f"{len(db_ids)} new records created in table 'results'")
+        return db_ids
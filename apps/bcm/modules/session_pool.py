@@ -0,0 +1,156 @@
+# coding: utf-8
+
+import logging
+import threading
+import time
+
+from .. import settings
+
+
+class SessionPool():
+    """
+    Thread-safe pool of authenticated device sessions (NetConnect) keyed by ('devices' DB id,
+    username), a session is only re-used with the account it was opened with
+    Idle sessions are re-used by later polls (and jobs) to skip the SSH login, sessions are
+    checked with is_alive() before re-use and disconnected once idle for idle_timeout seconds,
+    by the next acquire() or by a sweeper thread running while sessions are idle
+    """
+    def __init__(self, max_per_device=1, idle_timeout=300):
+        """
+        Standard constructor class
+        ---
+        :param max_per_device: maximum number of sessions (idle and in use) per device account
+        :type max_per_device: int
+        :param idle_timeout: seconds an idle session is kept before it is disconnected
+        :type idle_timeout: int
+        """
+        self.max_per_device = max_per_device
+        self.idle_timeout = idle_timeout
+        self.idle = dict()  # (device id, username) -> list of (session, released at)
+        self.in_use = dict()  # (device id, username) -> number of sessions in use
+        self.condition = threading.Condition()
+        self.sweeper = None  # thread disconnecting expired idle sessions
+    
+    @staticmethod
+    def key(device_id, auth=None):
+        """Return the pool key of a device and runtime credentials (username, password)"""
+        return (device_id, auth[0] if auth else None)
+    
+    def count(self, key):
+        """Return the number of sessions (idle and in use) held for a device account"""
+        return len(self.idle.get(key, list())) + self.in_use.get(key, 0)
+    
+    def acquire(self, key, connect, timeout=None):
+        """
+        Return a live idle session for the device account or a new session created by connect()
+        Blocks while the device account is at max_per_device sessions
+        ---
+        :param key: (devices DB id, username), see SessionPool.key()
+        :type key: tuple
+        :param connect: callable returning a new (connected) NetConnect
+        :type connect: function
+        :param timeout: seconds to wait for a free session slot, None waits forever
+        :type timeout: float
+        :return session: a NetConnect object or None if no slot became free before timeout
+        """
+        expired = list()
+        session = None
+        slot = False
+        with self.condition:
+            while True:
+                expired.extend(self.pop_expired())
+                while self.idle.get(key):
+                    candidate, released_at = self.idle[key].pop()
+                    if candidate.is_alive():
+                        session = candidate
+                        break
+                    expired.append(candidate)
+                if session or self.count(key) < self.max_per_device:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    slot = True
+                    break
+                if not self.condition.wait(timeout=timeout):
+                    logging.warning(f"{self.__class__.__name__}, No free session for device id={key[0]} username={key[1]}")
+                    break
+        self.close_sessions(expired)
+        if session or not slot:
+            return session
+        try:
+            session = connect()
+        except Exception:
+            self.release(key, None)
+            raise
+        return session
+    
+    def release(self, key, session):
+        """Return a session to the pool, sessions not alive or over the cap are disconnected"""
+        close = None
+        with self.condition:
+            self.in_use[key] = max(0, self.in_use.get(key, 0) - 1)
+            if session and session.is_alive() and self.count(key) < self.max_per_device:
+                self.idle.setdefault(key, list()).append((session, time.monotonic()))
+                self.start_sweeper()
+            elif session and session.is_connected:
+                close = session
+            self.condition.notify_all()
+        if close:
+            self.close_sessions([close])
+    
+    def start_sweeper(self):
+        """Start the sweeper thread unless running, caller must hold the lock"""
+        if self.sweeper is None or not self.sweeper.is_alive():
+            self.sweeper = threading.Thread(target=self.sweep, name="session-pool-sweeper", daemon=True)
+            self.sweeper.start()
+    
+    def sweep(self):
+        """Disconnect the expired idle sessions until no session is idle"""
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            self.evict_idle()
+            with self.condition:
+                if not any(self.idle.values()):
+                    self.sweeper = None
+                    return
+    
+    def pop_expired(self):
+        """Remove and return idle sessions older than idle_timeout, caller must hold the lock"""
+        expired = list()
+        now = time.monotonic()
+        for key in list(self.idle.keys()):
+            keep = list()
+            for session, released_at in self.idle[key]:
+                if now - released_at > self.idle_timeout:
+                    expired.append(session)
+                else:
+                    keep.append((session, released_at))
+            self.idle[key] = keep
+        return expired
+    
+    def evict_idle(self):
+        """Disconnect idle sessions older than idle_timeout"""
+        with self.condition:
+            expired = self.pop_expired()
+        self.close_sessions(expired)
+        return len(expired)
+    
+    def close_all(self):
+        """Disconnect all idle sessions"""
+        with self.condition:
+            sessions = [session for idle in self.idle.values() for session, released_at in idle]
+            self.idle = dict()
+        self.close_sessions(sessions)
+    
+    @staticmethod
+    def close_sessions(sessions):
+        for session in sessions:
+            try:
+                session.disconnect()
+            except Exception as close_error:
+                logging.warning(f"SessionPool, error closing session: {close_error}")
+
+
+# shared by all pollers and jobs in the process
+session_pool = SessionPool(
+    max_per_device=settings.SESSION_POOL_MAX_PER_DEVICE,
+    idle_timeout=settings.SESSION_POOL_IDLE_TIMEOUT
+)
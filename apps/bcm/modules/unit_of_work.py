@@ -0,0 +1,115 @@
+# coding: utf-8
+
+import logging
+
+from py4web.core import Fixture
+
+from ..models import db
+from .catalog_cache import catalog_cache
+
+"""
+>>> from apps.bcm.modules.unit_of_work import unit_of_work
+>>> from apps.bcm.modules.devices import DBDevice
+>>> with unit_of_work:
+...     d = DBDevice.get(4)
+...     d is DBDevice.get(4)
+...     d.comment = "core router"
+...     unit_of_work.add(d)
+True
+"""
+
+
+class UnitOfWork(Fixture):
+    """
+    Request scoped identity map and unit of work for 'BCMDb' objects
+    The identity map loads each (table, id) at most once per request (see BCMDb.get),
+    dirty objects registered with add() are saved by flush() with one commit at the end
+    of the request, saves made while a unit of work is active do not commit either.
+    Any failed save rolls back the whole unit of work.
+    Used as an action fixture @action.uses(db, unit_of_work) or, outside of a request,
+    as a context manager 'with unit_of_work:'
+    """
+    def on_request(self, context):
+        Fixture.local_initialize(self)
+        self.local.identity_map = dict()
+        self.local.dirty = list()
+        self.local.failed = False
+
+    def on_success(self, context):
+        try:
+            self.flush()
+        finally:
+            Fixture.local_delete(self)
+
+    def on_error(self, context):
+        db.rollback()
+        catalog_cache.end_transaction()
+        Fixture.local_delete(self)
+
+    def __enter__(self):
+        self.on_request(None)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.on_error(None)
+        else:
+            self.on_success(None)
+        return False
+
+    def is_active(self):
+        """True if a unit of work is open on this thread"""
+        return self.is_valid()
+
+    def get(self, table, db_id):
+        """Return the object of 'table' DB id loaded in the unit of work, or None"""
+        if not self.is_active():
+            return None
+        return self.local.identity_map.get((table, db_id))
+
+    def put(self, table, db_id, obj):
+        """Add a loaded object to the identity map, ignored if no unit of work is active"""
+        if self.is_active() and db_id:
+            self.local.identity_map.update({(table, db_id): obj})
+
+    def add(self, obj):
+        """Register a dirty object to save on flush(), saved immediately if no unit of work is active"""
+        if not self.is_active():
+            return obj.save()
+        if not any(dirty is obj for dirty in self.local.dirty):
+            self.local.dirty.append(obj)
+        return None
+
+    def fail(self):
+        """Mark the unit of work as failed, it is rolled back instead of committed"""
+        if self.is_active():
+            self.local.failed = True
+
+    def flush(self):
+        """
+        Save the dirty objects and commit once, or roll back if any save failed
+        ---
+        :return True or False: based on whether the unit of work is committed or not
+        """
+        dirty, self.local.dirty = self.local.dirty, list()
+        try:
+            for obj in dirty:
+                obj.save()
+                if obj.db_id:
+                    self.put(obj.dbtable, obj.db_id, obj)
+        except Exception:
+            db.rollback()
+            catalog_cache.end_transaction()
+            raise
+        if self.local.failed:
+            db.rollback()
+            catalog_cache.end_transaction()
+            logging.warning(f"{self.__class__.__name__}, Failed save, unit of work rolled back")
+            self.local.failed = False
+            return False
+        db.commit()
+        catalog_cache.end_transaction()
+        return True
+
+
+unit_of_work = UnitOfWork()
@@ -6,6 +6,7 @@ This is an optional file that defined app level settings such as:
 This file is provided as an example:
 """
 import os
+import json
 from py4web.core import required_folder
 
 # mode (default or development)
@@ -111,6 +112,115 @@ T_FOLDER = required_folder(APP_FOLDER, "translations")
 USE_SCHEDULER = False
 SCHEDULER_MAX_CONCURRENT_RUNS = 1
 
+# Device connection settings
+# DEVICE_SSH_PORT: SSH port of the devices, None uses port 22
+DEVICE_SSH_PORT = None
+# DEVICE_AUTH: (username, password) by 'devices' DB id, overrides the job runtime account
+#              set in settings_private.py or in environment variable BCM_DEVICE_AUTH as JSON,
+#              e.g. '{"4": ["admin", "password"]}', never in this file
+DEVICE_AUTH = {int(device): tuple(auth) for device, auth in
+    json.loads(os.environ.get("BCM_DEVICE_AUTH", "{}")).items()}
+
+# Job settings
+# JOB_MAX_WORKERS:  Maximum number of devices polled at once by a job
+JOB_MAX_WORKERS = 10
+# JOB_USE_ASYNCIO:  Poll devices from one asyncio event loop (requires asyncssh)
+# JOB_MAX_ASYNC_SESSIONS: Maximum number of SSH sessions open at once by an asyncio job
+JOB_USE_ASYNCIO = False
+JOB_MAX_ASYNC_SESSIONS = 1000
+# JOB_SHARD_SIZE:  Number of devices per scheduler task when a job is sharded (requires USE_SCHEDULER)
+# JOB_SHARD_TIMEOUT: Seconds before the scheduler kills a job shard
+# JOB_COLLECT_INTERVAL: Seconds between the scheduled runs updating the jobs whose shards have all finished
+JOB_SHARD_SIZE = 50
+JOB_SHARD_TIMEOUT = 3600
+JOB_COLLECT_INTERVAL = 30
+# JOB_STREAM_RESULTS: Save each command result as soon as it completes, not once per device (experimental)
+# JOB_STREAM_QUEUE_SIZE: Maximum number of results waiting to be saved before pollers block
+# JOB_PROGRESS_INTERVAL: Seconds between job 'results' updates while a job runs
+JOB_STREAM_RESULTS = False
+JOB_STREAM_QUEUE_SIZE = 1000
+JOB_PROGRESS_INTERVAL = 10
+
+# Results partition settings
+# RESULTS_HOT_MONTHS: Months of results kept in table 'results' (current month included), older
+#                     results are moved to the monthly archive partitions 'results_YYYYMM'
+# RESULTS_RETENTION_MONTHS: Months of results kept, older results and partitions are deleted, None (default)
+#                           keeps all results
+# RESULTS_ARCHIVE_INTERVAL: Seconds between the scheduled archive runs (requires USE_SCHEDULER)
+RESULTS_HOT_MONTHS = 3
+RESULTS_RETENTION_MONTHS = None
+RESULTS_ARCHIVE_INTERVAL = 86400
+
+# Results compression settings
+# RESULTS_COMPRESSION: Codec of the stored results, 'zlib', 'zstd' (requires zstandard) or None for plain text
+# RESULTS_COMPRESS_MIN_SIZE: Results shorter than this (characters) are stored as plain text
+# RESULTS_DICT_SIZE: Maximum size (bytes) of the compression dictionary trained per command
+# RESULTS_DICT_SAMPLES: Number of past results of a command a dictionary is trained on
+# RESULTS_DICT_INTERVAL: Seconds between the scheduled dictionary training runs (requires USE_SCHEDULER)
+RESULTS_COMPRESSION = "zlib"
+RESULTS_COMPRESS_MIN_SIZE = 128
+RESULTS_DICT_SIZE = 32768
+RESULTS_DICT_SAMPLES = 100
+RESULTS_DICT_INTERVAL = 86400
+# RESULTS_BLOB_CACHE_SIZE: Maximum size (characters) of the result payloads cached in memory, 0 disables the cache
+RESULTS_BLOB_CACHE_SIZE = 16777216
+# RESULTS_BLOB_GRACE_PERIOD: Seconds an unused payload is kept after its last use, must exceed the longest
+#                            'results' write transaction (payloads of uncommitted results are not deleted)
+RESULTS_BLOB_GRACE_PERIOD = 3600
+
+# Catalog cache settings ('devices', 'commands' and 'output_parsers' records, see modules/catalog_cache.py)
+# CATALOG_CACHE_ENABLED: Serve the catalog lookups from memory, invalidated by the catalog version in DB
+# CATALOG_CACHE_CHECK_INTERVAL: Seconds the catalog version is trusted before it is read again (the delay
+#                               before a change made by another process is seen, changes made by the
+#                               process are seen at once), 0 reads it on every lookup
+CATALOG_CACHE_ENABLED = True
+CATALOG_CACHE_CHECK_INTERVAL = 5
+
+# Results API settings
+# RESULTS_PAGE_SIZE: Number of results per page of the results API, unless the request sets 'limit'
+# RESULTS_MAX_PAGE_SIZE: Maximum 'limit' of a results API request
+RESULTS_PAGE_SIZE = 100
+RESULTS_MAX_PAGE_SIZE = 1000
+
+# POLLER_BATCH_COMMANDS: Send all device commands in one pipelined exchange (experimental, the outputs
+#                        are split on the device prompt)
+POLLER_BATCH_COMMANDS = False
+# PARSE_POOL_ENABLED: Parse command output (TextFSM, json) in a process pool, not the poller threads
+# PARSE_POOL_MAX_WORKERS: Number of parser processes, None uses the number of CPUs
+PARSE_POOL_ENABLED = True
+PARSE_POOL_MAX_WORKERS = None
+
+# Device session pool settings
+# SESSION_POOL_ENABLED:  Keep authenticated device sessions open for re-use between polls
+# SESSION_POOL_MAX_PER_DEVICE: Maximum number of sessions per device
+# SESSION_POOL_IDLE_TIMEOUT: Seconds an idle session is kept before it is disconnected
+SESSION_POOL_ENABLED = True
+SESSION_POOL_MAX_PER_DEVICE = 1
+SESSION_POOL_IDLE_TIMEOUT = 300
+
+# Device health settings
+# HEALTH_ENABLED:  Adapt connect timeouts to device history and fast-fail devices that keep failing
+# HEALTH_FAILURE_THRESHOLD: Consecutive connect failures before a device is skipped
+# HEALTH_COOL_DOWN: Seconds a failing device is skipped before a trial connect
+# HEALTH_MIN_TIMEOUT/HEALTH_MAX_TIMEOUT: Bounds (seconds) of the adaptive connect timeout
+# HEALTH_DEFAULT_TIMEOUT: Connect timeout (seconds) of a device without latency history (netmiko default)
+HEALTH_ENABLED = True
+HEALTH_FAILURE_THRESHOLD = 3
+HEALTH_COOL_DOWN = 300
+HEALTH_MIN_TIMEOUT = 5
+HEALTH_MAX_TIMEOUT = 30
+HEALTH_DEFAULT_TIMEOUT = 10
+
+# Device login rate limit settings (protects the TACACS/RADIUS servers of each site)
+# LOGIN_RATE_ENABLED:  Throttle new device logins by devices region and site_code
+# LOGIN_RATE: New logins per second per region/site_code
+# LOGIN_BURST: New logins allowed at once per region/site_code
+# LOGIN_RATE_LIMITS: (rate, burst) overrides keyed by 'REGION:SITE_CODE' or 'REGION'
+LOGIN_RATE_ENABLED = True
+LOGIN_RATE = 5
+LOGIN_BURST = 10
+LOGIN_RATE_LIMITS = {}
+
 # Celery settings (alternative to the build-in scheduler)
 USE_CELERY = False
 CELERY_BROKER = "redis://localhost:6379/0"
@@ -0,0 +1,79 @@
+"""
+This file registers the bcm tasks with the built-in scheduler (settings.USE_SCHEDULER)
+Every py4web process sharing the DB with the scheduler enabled picks up queued tasks
+"""
+from .common import settings, scheduler
+from .models import db
+from .modules.jobs import DBJob
+from .modules.partitions import result_partitions
+from .modules.result_codec import result_codec
+
+# scheduler task names of the periodic 'results' archive, dictionary training and job collector runs
+ARCHIVE_TASK = "bcm_archive_results"
+DICTIONARY_TASK = "bcm_train_dictionaries"
+COLLECT_TASK = "bcm_collect_jobs"
+
+
+def run_job_shard(job_id, devices, shard, shards=None, max_workers=None):
+    """Run the commands of a job on one shard of its devices, the job is updated by collect_jobs()"""
+    job = DBJob(db_id=job_id)
+    try:
+        output = job.run_shard(devices=devices, shard=shard, max_workers=max_workers)
+        db.commit()
+    except:
+        # rollback on failure
+        db.rollback()
+        raise
+    return output
+
+
+def collect_jobs():
+    """Update the sharded jobs whose shards have all finished (see DBJob.collect_running)"""
+    try:
+        collected = DBJob.collect_running()
+        db.commit()
+    except:
+        # rollback on failure
+        db.rollback()
+        raise
+    return dict(collected=collected)
+
+
+def archive_results():
+    """Archive and drop 'results' past the hot and retention months (see ResultPartitions)"""
+    try:
+        moved = result_partitions.archive()
+        db.commit()
+    except:
+        # rollback on failure
+        db.rollback()
+        raise
+    return dict(archived=moved)
+
+
+def train_dictionaries():
+    """Train the compression dictionaries of the commands without one (see ResultCodec)"""
+    try:
+        trained = result_codec.train_dictionaries()
+        db.commit()
+    except:
+        # rollback on failure
+        db.rollback()
+        raise
+    return dict(trained=trained)
+
+
+if settings.USE_SCHEDULER:
+    # register the tasks with the scheduler
+    scheduler.register_task(DBJob.SHARD_TASK, run_job_shard)
+    scheduler.register_task(ARCHIVE_TASK, archive_results)
+    scheduler.register_task(DICTIONARY_TASK, train_dictionaries)
+    scheduler.register_task(COLLECT_TASK, collect_jobs)
+    # one run of each periodic task, re-queued by the scheduler after each run, a run in progress
+    # (e.g. restart while it runs) is re-queued when it completes
+    for task, period in ((ARCHIVE_TASK, settings.RESULTS_ARCHIVE_INTERVAL),
+            (DICTIONARY_TASK, settings.RESULTS_DICT_INTERVAL),
+            (COLLECT_TASK, settings.JOB_COLLECT_INTERVAL)):
+        active = db.task_run.status.belongs(("queued", "assigned", "running"))
+        if not db((db.task_run.name == task) & active).count():
+            scheduler.enqueue_run(task, period=period)
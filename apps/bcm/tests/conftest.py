@@ -0,0 +1,71 @@
+# coding: utf-8
+"""
+Tests of the bcm app modules, run from the repository root: python -m pytest apps/bcm/tests
+The app is imported with private settings (see settings.py) pointing the DB at a temporary folder
+"""
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# imported by settings.py 'from .settings_private import *' before the app connects to its DB
+settings_private = types.ModuleType("apps.bcm.settings_private")
+settings_private.DB_FOLDER = tempfile.mkdtemp(prefix="bcm_tests_")
+settings_private.DB_URI = "sqlite://bcm_tests.db"
+settings_private.SESSION_SECRET_KEY = "Bcm-Tests!7f3c9a1e-5D2b-4E8f-A6c0-91b4d7e2f358"
+settings_private.USE_SCHEDULER = False
+sys.modules["apps.bcm.settings_private"] = settings_private
+
+import apps.bcm  # noqa: E402
+# pytest imports the app package by its directory name, it must be the app imported above
+sys.modules.setdefault("bcm", apps.bcm)
+from apps.bcm.models import db, INDEXES, define_partition  # noqa: E402
+from apps.bcm.modules.catalog_cache import catalog_cache  # noqa: E402
+from apps.bcm.modules.result_blobs import result_blobs  # noqa: E402
+
+TIMESTAMP = "2024-01-01 00:00:00"
+
+
+@pytest.fixture(autouse=True)
+def clean_db():
+    """Empty the DB tables, drop the archive partitions and the process caches after each test"""
+    yield
+    db.rollback()
+    for partition in db(db.result_partitions).select():
+        define_partition(partition.name).drop()
+        INDEXES.pop(partition.name, None)
+    for table in db.tables:
+        db(db[table]).delete()
+    db.commit()
+    catalog_cache.clear()
+    result_blobs.evict(list(result_blobs.cache))
+
+
+@pytest.fixture
+def catalog():
+    """A command, two devices polling it and a job, as a dict of DB ids"""
+    command = db.commands.insert(syntax="show version", vendors=["Cisco"], device_functions=["Router"],
+        device_roles=["OTHER"], created_at=TIMESTAMP)
+    devices = [db.devices.insert(name=f"r{idx}", mgmt_ip=f"10.0.0.{idx}", vendor="Cisco", os="nxos",
+        device_function="Router", device_roles=["OTHER"], region="EMEA", site_code="LODT",
+        created_at=TIMESTAMP) for idx in range(1, 3)]
+    for device in devices:
+        db.device_commands.insert(device=device, command=command)
+    job = db.jobs.insert(name="tests", status="Completed")
+    db.commit()
+    return dict(command=command, devices=devices, job=job)
+
+
+@pytest.fixture
+def make_result(catalog):
+    """Return a function building a result in DBResult json format"""
+    def make(completed_at, result="x", device=None, status="Success"):
+        return dict(device=device if device else catalog['devices'][0], command=catalog['command'],
+            completed_at=completed_at, status=status, job=catalog['job'], result=result)
+    return make
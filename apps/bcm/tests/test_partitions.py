@@ -0,0 +1,124 @@
+# coding: utf-8
+from datetime import datetime
+
+import pytest
+
+from apps.bcm.models import db
+from apps.bcm.modules.partitions import ResultPartitions, result_partitions, month_start
+from apps.bcm.modules.results import DBResult, DBResults
+
+NOW = datetime(2026, 10, 18)
+
+
+@pytest.fixture
+def partitions(monkeypatch):
+    """result_partitions with 2 hot months and no retention"""
+    monkeypatch.setattr(result_partitions, "hot_months", 2)
+    monkeypatch.setattr(result_partitions, "retention_months", None)
+    return result_partitions
+
+
+@pytest.fixture
+def history(catalog, make_result):
+    """3 results a month over 6 months, the DB ids of the results and of the job links"""
+    results = [make_result(month_start(NOW, -months).replace(day=day).strftime("%Y-%m-%d %H:%M:%S"),
+        result=f"r{months}") for months in range(6) for day in (3, 1, 2)]
+    ids = DBResults.save_results(results)
+    db.job_results.bulk_insert([dict(job=catalog['job'], result=db_id) for db_id in ids])
+    db.commit()
+    return ids
+
+
+def all_results():
+    return sorted((record.id, str(record.completed_at)) for record in result_partitions.select(lambda t: t.id > 0))
+
+
+def test_archive_moves_old_months(partitions, history):
+    before = all_results()
+    assert partitions.archive(now=NOW) == 12
+    assert [table._tablename for table in partitions.tables()] == [
+        "results_202605", "results_202606", "results_202607", "results_202608", "results"]
+    assert db(db.results).count() == 6
+    # same DB ids and links, archived results are read from their partition
+    assert all_results() == before
+    assert db(db.job_results).count() == 18
+    oldest = min(before, key=lambda result: result[1])
+    archived = DBResult(db_id=oldest[0])
+    assert str(archived.completed_at) == oldest[1] and archived.result == "r5"
+    assert partitions.archive(now=NOW) == 0
+
+
+def test_archive_month_chunks(partitions, history, monkeypatch):
+    monkeypatch.setattr(ResultPartitions, "ARCHIVE_CHUNK_SIZE", 2)
+    assert partitions.archive_month(month_start(NOW, -5)) == 3
+    partition = db(db.result_partitions.name == "results_202605").select().first()
+    assert partition.num_results == 3
+
+
+def page_through(partitions, limit, forward):
+    """Return the DB ids of all the pages, oldest first"""
+    query = lambda table: table.id > 0
+    pages, key = list(), None
+    while True:
+        if forward:
+            records, more = partitions.select_page(query, limit, after=key or ("2000-01-01 00:00:00", 0))
+        else:
+            records, more = partitions.select_page(query, limit, before=key)
+        assert len(records) <= limit
+        pages.append([record.id for record in records])
+        if not more:
+            break
+        record = records[-1] if forward else records[0]
+        key = (str(record.completed_at), record.id)
+    if not forward:
+        pages.reverse()
+    return [db_id for page in pages for db_id in page]
+
+
+@pytest.mark.parametrize("forward", [False, True])
+@pytest.mark.parametrize("limit", [1, 4, 7, 100])
+def test_select_page_keyset_across_partitions(partitions, history, forward, limit):
+    partitions.archive(now=NOW)
+    expected = [db_id for db_id, completed_at in sorted(all_results(), key=lambda result: (result[1], result[0]))]
+    assert page_through(partitions, limit, forward) == expected
+
+
+def test_select_page_reads_partitions_only_as_needed(partitions, history):
+    partitions.archive(now=NOW)
+    statements = list()
+    db._adapter.connection.set_trace_callback(statements.append)
+    try:
+        records, more = partitions.select_page(lambda table: table.id > 0, 3)
+    finally:
+        db._adapter.connection.set_trace_callback(None)
+    assert more and [str(record.completed_at)[:10] for record in records] == [
+        "2026-10-01", "2026-10-02", "2026-10-03"]
+    assert not [sql for sql in statements if "results_2026" in sql]
+
+
+def test_retention_drops_old_results(partitions, history, monkeypatch):
+    partitions.archive(now=NOW)
+    monkeypatch.setattr(result_partitions, "retention_months", 4)
+    partitions.archive(now=NOW)
+    assert [table._tablename for table in partitions.tables()] == ["results_202607", "results_202608", "results"]
+    assert len(all_results()) == 12
+    assert db(db.job_results).count() == 12
+    # results chained to a deleted result are unlinked
+    oldest = min(all_results(), key=lambda result: result[1])
+    assert DBResult(db_id=oldest[0]).last_result is None
+    # the payloads of the deleted results are kept for the grace period (see test_result_blobs.py)
+    assert db(db.result_blobs).count() == 6
+
+
+def test_retention_none_keeps_all(partitions, history):
+    partitions.archive(now=NOW)
+    assert partitions.retention_starts_at(NOW) is None
+    assert len(all_results()) == 18
+
+
+def test_expire_chunks(partitions, history, monkeypatch):
+    monkeypatch.setattr(ResultPartitions, "ARCHIVE_CHUNK_SIZE", 2)
+    deleted = partitions.expire(month_start(NOW, -3))
+    assert deleted == 6
+    assert len(all_results()) == 12
+    assert db(db.job_results).count() == 12
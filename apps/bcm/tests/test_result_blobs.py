@@ -0,0 +1,59 @@
+# coding: utf-8
+from datetime import datetime, timedelta
+
+import pytest
+
+from apps.bcm.models import db
+from apps.bcm.modules.partitions import result_partitions
+from apps.bcm.modules.result_blobs import ResultBlobs, result_blobs
+from apps.bcm.modules.results import DBResult, DBResults
+
+USED_BEFORE = datetime.now() - timedelta(days=1)
+
+
+@pytest.fixture
+def saved(make_result):
+    """Results with the payloads 'kept' (used) and 'dropped' (unused), last used a day ago"""
+    ids = DBResults.save_results([make_result("2026-10-01 00:00:00", result="kept"),
+        make_result("2026-10-02 00:00:00", result="dropped")])
+    db(db.results.id == ids[1]).delete()
+    db(db.result_blobs).update(used_at=USED_BEFORE)
+    db.commit()
+    return ids
+
+
+def test_collect_deletes_unused(saved):
+    dropped = ResultBlobs.hash("dropped")
+    result_blobs.cache_put(dropped, "dropped")
+    assert result_blobs.collect(result_partitions.tables()) == 1
+    assert [blob.hash for blob in db(db.result_blobs).select()] == [ResultBlobs.hash("kept")]
+    assert result_blobs.cache_get(dropped) is None
+    assert DBResult(db_id=saved[0]).result == "kept"
+
+
+def test_collect_spares_payloads_within_grace_period(saved):
+    db(db.result_blobs).update(used_at=datetime.now())
+    assert result_blobs.collect(result_partitions.tables()) == 0
+    assert db(db.result_blobs).count() == 2
+
+
+def test_collect_falls_back_to_created_at(saved):
+    db(db.result_blobs).update(used_at=None, created_at=datetime.now())
+    assert result_blobs.collect(result_partitions.tables()) == 0
+    db(db.result_blobs).update(created_at=USED_BEFORE)
+    assert result_blobs.collect(result_partitions.tables()) == 1
+
+
+def test_put_touches_existing_payloads(saved):
+    # a writer re-using the payload before committing its result, collect must not delete it
+    result_hash = result_blobs.put("dropped")
+    assert db(db.result_blobs.hash == result_hash).select().first().used_at > USED_BEFORE
+    assert result_blobs.collect(result_partitions.tables()) == 0
+
+
+def test_put_after_collect_stores_again(saved, make_result):
+    result_blobs.get(ResultBlobs.hash("dropped"))
+    result_blobs.collect(result_partitions.tables())
+    # the cache does not prove the payload exists, it is read from DB
+    db_id, = DBResults.save_results([make_result("2026-10-03 00:00:00", result="dropped")])
+    assert DBResult(db_id=db_id).result == "dropped"
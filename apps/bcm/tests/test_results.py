@@ -0,0 +1,73 @@
+# coding: utf-8
+import time
+
+from apps.bcm.models import db
+from apps.bcm.modules.results import DBResult, DBResults
+from apps.bcm.modules.partitions import result_partitions
+
+
+def test_save_results_skips_existing_and_duplicates(make_result):
+    first = DBResults.save_results([make_result("2026-10-01 00:00:00"), make_result("2026-10-02 00:00:00")])
+    assert len(first) == 2
+    # one existing result and the same new result twice
+    second = DBResults.save_results([make_result("2026-10-01 00:00:00"), make_result("2026-10-03 00:00:00"),
+        make_result("2026-10-03 00:00:00")])
+    assert len(second) == 1
+    assert db(db.results).count() == 3
+
+
+def test_save_results_skips_archived(make_result, monkeypatch):
+    DBResults.save_results([make_result("2024-01-05 00:00:00")])
+    monkeypatch.setattr(result_partitions, "hot_months", 1)
+    assert result_partitions.archive() == 1
+    assert DBResults.save_results([make_result("2024-01-05 00:00:00")]) == list()
+    assert db(db.results).count() == 0
+
+
+def test_save_results_chains_last_result(catalog, make_result):
+    device, other = catalog['devices']
+    # saved out of order, chained by completed_at per (device, command)
+    ids = DBResults.save_results([make_result("2026-10-02 00:00:00", device=device),
+        make_result("2026-10-01 00:00:00", device=device), make_result("2026-10-01 00:00:00", device=other)])
+    results = {(r.device, str(r.completed_at)): r for r in db(db.results).select()}
+    first = results[(device, "2026-10-01 00:00:00")]
+    assert first.last_result is None
+    assert results[(device, "2026-10-02 00:00:00")].last_result == first.id
+    assert results[(other, "2026-10-01 00:00:00")].last_result is None
+    # a later save chains to the latest result in DB
+    later, = DBResults.save_results([make_result("2026-10-05 00:00:00", device=device)])
+    assert DBResult(db_id=later).last_result == results[(device, "2026-10-02 00:00:00")].id
+    assert len(ids) == 3
+
+
+def test_save_results_stores_each_text_once(make_result):
+    ids = DBResults.save_results([make_result("2026-10-01 00:00:00", result="same"),
+        make_result("2026-10-02 00:00:00", result="same"), make_result("2026-10-03 00:00:00", result="other")])
+    assert db(db.result_blobs).count() == 2
+    assert [DBResult(db_id=db_id).result for db_id in ids] == ["same", "same", "other"]
+
+
+def test_save_results_queries_do_not_grow_with_results(catalog, make_result):
+    def count_statements(num_results, day):
+        results = [make_result(f"2026-{day} {idx // 3600 % 24:02d}:{idx // 60 % 60:02d}:{idx % 60:02d}",
+            result=f"r{idx % 10}", device=catalog['devices'][idx % 2]) for idx in range(num_results)]
+        statements = list()
+        db._adapter.connection.set_trace_callback(statements.append)
+        try:
+            DBResults.save_results(results)
+        finally:
+            db._adapter.connection.set_trace_callback(None)
+        # rows and new payloads are inserted one statement each (pydal bulk_insert on SQLite)
+        return len([sql for sql in statements if not sql.startswith("INSERT INTO")])
+    assert count_statements(200, "10-01") == count_statements(2000, "10-02")
+
+
+def test_save_results_10k(catalog, make_result):
+    results = [make_result(f"2026-10-01 {idx // 3600 % 24:02d}:{idx // 60 % 60:02d}:{idx % 60:02d}",
+        result=f"r{idx % 50}", device=catalog['devices'][idx // 5000]) for idx in range(10000)]
+    started = time.monotonic()
+    ids = DBResults.save_results(results)
+    elapsed = time.monotonic() - started
+    assert len(ids) == 10000
+    # generous bound, the save is ~0.3s on SQLite
+    assert elapsed < 5